@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+
+"""
+Move the full Plaid payloads of stored transactions to the cold archive.
+
+With cold_archive set, new and updated transactions keep only the fields
+plaid2text renders and filters on in their database row, and the full Plaid
+payload is stored zlib compressed on the side: the raw_payloads table for
+SQLite, the plaid2text_payloads collection for MongoDB. The payload is only
+read back when a template, an export or a lookup by transaction_id needs a
+field the row does not keep.
+
+This command moves the rows stored whole before that, in batches, so it can
+be interrupted and run again.
+"""
+
+import argparse
+import sys
+
+import plaid2text.config_manager as cm
+from plaid2text.profiler import PROFILER
+import plaid2text.storage_manager as storage_manager
+
+
+def _parse_args(argv):
+    defaults = cm.get_defaults()
+    parser = argparse.ArgumentParser(
+        prog='plaid2text archive',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '--account',
+        dest='accounts',
+        action='append',
+        metavar='NICKNAME',
+        help='account to archive; may be repeated (default: every configured account)'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='rows moved per batch (default: 1000)'
+    )
+    storage_manager.add_storage_arguments(parser, defaults)
+    parser.add_argument('--profile', action='store_true', help='print a per-stage timing breakdown')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = _parse_args(argv)
+    if options.profile:
+        PROFILER.enable()
+
+    accounts = options.accounts or cm.get_configured_accounts()
+    for account in accounts:
+        if not cm.account_exists(account):
+            print('Unknown account: {0}'.format(account), file=sys.stderr)
+            sys.exit(1)
+
+    if options.dbtype == 'sqlite':
+        # SQLite keeps every account in one table
+        accounts = accounts[:1]
+    for account in accounts:
+        sm = storage_manager.open_storage(options, account)
+        with PROFILER.stage('archive'):
+            moved = sm.archive_payloads(options.batch_size)
+        where = options.sqlite_db if options.dbtype == 'sqlite' else account
+        print('{0}: archived {1} transactions'.format(where, moved), file=sys.stderr)
+    PROFILER.report()
@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+
+"""
+Record and replay of Plaid API responses.
+
+With --record FILE every call made through PlaidAccess is appended to a
+cassette, one gzip member per call holding a JSON line with the request key
+and the raw response body (or the error Plaid answered with). With
+--replay FILE the same calls are answered from the cassette without any
+network access, so a sync or a download can be repeated exactly: to debug
+rendering or categorization, or as an offline benchmark fixture.
+
+A request is keyed by its endpoint and parameters (cursor, offset, dates,
+account ids), with the access token replaced by a hash of it. A key
+recorded more than once is replayed in the order it was recorded, the last
+response repeating. Only the final outcome of a call is recorded, after
+any retries.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+
+
+def request_key(endpoint, request):
+    params = request.to_dict()
+    # Credentials are sent as headers, but never keep them if set
+    params.pop('client_id', None)
+    params.pop('secret', None)
+    token = params.pop('access_token', None)
+    if token:
+        params['access_token_sha256'] = hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+    return endpoint + ' ' + json.dumps(params, sort_keys=True, default=str)
+
+
+class Cassette():
+    """
+    path: cassette file
+    mode: 'record' (append to path) or 'replay' (read path)
+    """
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.played = {}
+        if mode == 'replay':
+            with gzip.open(path, mode='rt', encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries.setdefault(entry['key'], []).append(entry)
+
+    def record(self, endpoint, request, status, body, reason=None):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', errors='replace')
+        line = json.dumps({
+            'key': request_key(endpoint, request),
+            'status': status,
+            'reason': reason,
+            'body': body,
+        }) + '\n'
+        # A complete gzip member per call: the cassette stays readable if
+        # the run is interrupted
+        data = gzip.compress(line.encode('utf-8'), compresslevel=6)
+        with self.lock:
+            with open(self.path, mode='ab') as f:
+                f.write(data)
+
+    def play(self, endpoint, request):
+        """
+        The next recorded entry for this request (a dict with status,
+        reason and body), or None if it was never recorded.
+        """
+        key = request_key(endpoint, request)
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                return None
+            n = self.played.get(key, 0)
+            self.played[key] = n + 1
+            return entries[min(n, len(entries) - 1)]
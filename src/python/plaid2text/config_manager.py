@@ -2,22 +2,25 @@
 
 from collections import OrderedDict
 import configparser
+import contextlib
+import functools
+import io
 import os
+import shutil
 import sys
 import re
-
-from plaid2text.interact import prompt, NullValidator, YesNoValidator
-import plaid
-from plaid.api import plaid_api
-from plaid.model.link_token_create_request import LinkTokenCreateRequest
-from plaid.model.link_token_create_request_user import LinkTokenCreateRequestUser
-from plaid.model.country_code import CountryCode
-from plaid.model.products import Products
-from plaid.model.item_public_token_exchange_request import ItemPublicTokenExchangeRequest
-from plaid.model.accounts_get_request import AccountsGetRequest
+import tempfile
 
 import json
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows; locking becomes a no-op
+    fcntl = None
+
+# prompt_toolkit and the plaid SDK are imported inside the functions that
+# need them, so that commands like --help and -p start quickly.
+
 
 class dotdict(dict):
     """
@@ -29,16 +32,20 @@ class dotdict(dict):
     __delattr__ = dict.__delitem__
 
 
+@functools.lru_cache(maxsize=None)
 def get_locale_currency_symbol():
     """
-    Get currency symbol from locale
+    Get currency symbol from locale. This is not part of CONFIG_DEFAULTS
+    because setlocale is slow; it is looked up only when rendering needs it.
     """
     import locale
     locale.setlocale(locale.LC_ALL, '')
     conv = locale.localeconv()
     return conv['int_curr_symbol']
 
-DEFAULT_CONFIG_DIR = os.path.expanduser('~/.config/plaid2text')
+DEFAULT_CONFIG_DIR = os.path.expanduser(
+    os.environ.get('PLAID2TEXT_CONFIG_DIR', '~/.config/plaid2text')
+)
 
 CONFIG_DEFAULTS = dotdict({
     # For configparser, int must be converted to str
@@ -48,16 +55,23 @@ CONFIG_DEFAULTS = dotdict({
     'output_format': 'beancount',
     'clear_screen': False,
     'cleared_character': '*',
-    'currency': get_locale_currency_symbol(),
     'default_expense': 'Expenses:Unknown',
     'encoding': 'utf-8',
     'output_date_format': '%Y/%m/%d',
     'quiet': False,
     'tags': False,
+    'skip_existing': False,
+    'pair_transfers': False,
+    'group_prompts': False,
+    'group_by_amount': False,
+    'transfer_window': '3',
+    'checkpoint_every': '20',
     'dbtype': 'sqlite',
     'mongo_db': 'plaid2text',
     'mongo_db_uri': 'mongodb://localhost:27017',
-    'sqlite_db': os.path.join(DEFAULT_CONFIG_DIR, 'transactions.db')
+    'sqlite_db': os.path.join(DEFAULT_CONFIG_DIR, 'transactions.db'),
+    'segment_dir': os.path.join(DEFAULT_CONFIG_DIR, 'segments'),
+    'cold_archive': False
 })
 
 FILE_DEFAULTS = dotdict({
@@ -67,6 +81,7 @@ FILE_DEFAULTS = dotdict({
     'mapping_file': os.path.join(DEFAULT_CONFIG_DIR, 'mapping'),
     'headers_file': os.path.join(DEFAULT_CONFIG_DIR, 'headers'),
     'template_file': os.path.join(DEFAULT_CONFIG_DIR, 'template'),
+    'journal_ids_cache': os.path.join(DEFAULT_CONFIG_DIR, 'journal_ids.json'),
     'auth_file': os.path.join(DEFAULT_CONFIG_DIR, 'auth.html')})
 
 DEFAULT_LEDGER_TEMPLATE = """\
@@ -97,6 +112,53 @@ def touch(fname, mode=0o666, dir_fd=None, **kwargs):
                  dir_fd=None if os.supports_fd else dir_fd, **kwargs)
 
 
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """
+    Hold an exclusive advisory lock for `path` while the block runs, or a
+    shared one that only keeps exclusive holders out. The lock is taken on a
+    companion `path.lock` file so that it stays valid when `path` itself is
+    atomically replaced. Each file has its own lock, so a config write never
+    waits on a mapping write.
+    """
+    _create_directory_tree(os.path.abspath(path))
+    with open(path + '.lock', mode='a') as lock:
+        if fcntl:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def atomic_write(path, text):
+    """
+    Replace the contents of `path` with `text`. Readers see either the old
+    or the new file, never a partially written one.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, mode='w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _write_config(config):
+    """Atomically replace the config file with `config`. Hold file_lock."""
+    buf = io.StringIO()
+    config.write(buf)
+    atomic_write(FILE_DEFAULTS.config_file, buf.getvalue())
+
+
 def get_custom_file_path(nickname, file_type, create_file=False):
     f = os.path.join(DEFAULT_CONFIG_DIR, nickname, file_type)
     if create_file:
@@ -111,6 +173,7 @@ def get_custom_file_path(nickname, file_type, create_file=False):
 
 def config_exists():
     if not os.path.isfile(FILE_DEFAULTS.config_file):
+        from plaid2text.interact import prompt, YesNoValidator
         print('No configuration file found.')
         create = prompt(
             'Do you want to create one now [Y/n]: ',
@@ -130,8 +193,28 @@ def _get_config_parser():
     return config
 
 
+_config_cache = {}
+
+def _cached_config():
+    """
+    The parsed config file, for read only use. It is parsed again only when
+    the file changed (new inode from atomic_write, size or mtime), so
+    repeated lookups in a sync or a long running daemon are cheap.
+    """
+    path = FILE_DEFAULTS.config_file
+    try:
+        st = os.stat(path)
+        key = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+    except OSError:
+        key = (path, None)
+    if _config_cache.get('key') != key:
+        _config_cache['config'] = _get_config_parser()
+        _config_cache['key'] = key
+    return _config_cache['config']
+
+
 def get_config(account):
-    config = _get_config_parser()
+    config = _cached_config()
     if not config.has_section(account):
         print(
             'Config file {0} does not contain section for account: {1}\n\n'
@@ -156,43 +239,76 @@ def get_config(account):
     return defaults
 
 def get_defaults():
-    config = _get_config_parser()
+    config = _cached_config()
     defaults = OrderedDict(config.items('DEFAULT'))
     defaults['config_file'] = FILE_DEFAULTS.config_file
     return defaults
 
 def get_configured_accounts():
-    config = _get_config_parser()
+    config = _cached_config()
     accts = config.sections()
     accts.remove('PLAID')  # Remove Plaid specific
     return accts
 
 
 def account_exists(account):
-    config = _get_config_parser()
+    config = _cached_config()
     if not config.has_section(account):
         return False
     return True
 
 
 def get_plaid_config():
-    config = _get_config_parser()
+    config = _cached_config()
     plaid_section = config['PLAID']
     return plaid_section['client_id'], plaid_section['secret']
 
 
+def get_plaid_host():
+    """
+    Host of the Plaid API. The optional `host` key of the PLAID section may
+    name an environment (production, development, sandbox) or hold a full URL,
+    e.g. a local stand-in started with `python -m plaid2text.plaid_stub`.
+    """
+    import plaid
+    config = _cached_config()
+    host = config['PLAID'].get('host', 'production')
+    environments = {
+        'production': plaid.Environment.Production,
+        'development': plaid.Environment.Development,
+        'sandbox': plaid.Environment.Sandbox,
+    }
+    return environments.get(host.lower(), host)
+
+
+def get_plaid_limits():
+    """
+    Request limits for the Plaid API from the optional keys of the PLAID
+    section: client_rate and item_rate (requests per minute), max_retries
+    and timeout (seconds per request).
+    """
+    plaid_section = _cached_config()['PLAID']
+    return {
+        'client_rate': float(plaid_section.get('client_rate', '2000')),
+        'item_rate': float(plaid_section.get('item_rate', '50')),
+        'max_retries': int(plaid_section.get('max_retries', '5')),
+        'timeout': int(plaid_section.get('timeout', '60')),
+    }
+
+
 def write_section(section_dict):
-    config = _get_config_parser()
-    try:
-        config.read_dict(section_dict)
-    except Exception as e:
-        raise
-    else:
-        with open(FILE_DEFAULTS.config_file, mode='w') as f:
-            config.write(f)
+    with file_lock(FILE_DEFAULTS.config_file):
+        config = _get_config_parser()
+        try:
+            config.read_dict(section_dict)
+        except Exception as e:
+            raise
+        else:
+            _write_config(config)
 
 
 def init_config():
+    from plaid2text.interact import prompt, NullValidator
     try:
         _create_directory_tree(FILE_DEFAULTS.config_file)
         config = configparser.ConfigParser(interpolation=None)
@@ -205,8 +321,8 @@ def init_config():
     except Exception as e:
         return False
     else:
-        with open(FILE_DEFAULTS.config_file, mode='w') as f:
-            config.write(f)
+        with file_lock(FILE_DEFAULTS.config_file):
+            _write_config(config)
     return True
 
 
@@ -231,6 +347,15 @@ def find_first_file(arg_file, alternatives):
 
 
 def create_account(account):
+    import plaid
+    from plaid.api import plaid_api
+    from plaid.model.link_token_create_request import LinkTokenCreateRequest
+    from plaid.model.link_token_create_request_user import LinkTokenCreateRequestUser
+    from plaid.model.country_code import CountryCode
+    from plaid.model.products import Products
+    from plaid.model.item_public_token_exchange_request import ItemPublicTokenExchangeRequest
+    from plaid.model.accounts_get_request import AccountsGetRequest
+    from plaid2text.interact import prompt, NullValidator
     try:
         _create_directory_tree(FILE_DEFAULTS.config_file)
         config = configparser.ConfigParser(interpolation=None)
@@ -244,7 +369,7 @@ def create_account(account):
 
         # create link token
         configuration = plaid.Configuration(
-            host=plaid.Environment.Production,
+            host=get_plaid_host(),
             api_key={
                 'clientId': client_id,
                 'secret': secret,
@@ -305,18 +430,14 @@ def create_account(account):
         print("    %s" % response['error_message'], file=sys.stderr )
         sys.exit(1)
     else:
-        with open(FILE_DEFAULTS.config_file, mode='a') as f:
-            config.write(f)
+        buf = io.StringIO()
+        config.write(buf)
+        with file_lock(FILE_DEFAULTS.config_file):
+            with open(FILE_DEFAULTS.config_file, mode='r') as f:
+                existing = f.read()
+            atomic_write(FILE_DEFAULTS.config_file, existing + buf.getvalue())
     return True
 
-def update_cursor(account, cursor):
-    config = configparser.ConfigParser()
-    config.read(FILE_DEFAULTS.config_file)
-    section = config[account]
-    section['cursor'] = cursor
-    with open (FILE_DEFAULTS.config_file, 'w') as f:
-        config.write(f)
-
 def generate_auth_page(link_token):
     page = """<html>
     <body>
@@ -361,12 +482,17 @@ def generate_auth_page(link_token):
     f.close()
 
 def update_link_token(access_token):
+    import plaid
+    from plaid.api import plaid_api
+    from plaid.model.link_token_create_request import LinkTokenCreateRequest
+    from plaid.model.link_token_create_request_user import LinkTokenCreateRequestUser
+    from plaid.model.country_code import CountryCode
     print ("Trying to update Plaid Link token")
 
     # Obtain new link token
     client_id, secret = get_plaid_config()
     configuration = plaid.Configuration(
-        host=plaid.Environment.Production,
+        host=get_plaid_host(),
         api_key={
             'clientId': client_id,
             'secret': secret,
@@ -408,8 +534,26 @@ def update_link_token(access_token):
     print('Link token updated for bank login containing ' + account_name +'.\nRun \'python3 -m http.server\' from ',DEFAULT_CONFIG_DIR,' and then visit \'localhost:8000\' in your browser to complete authentication with Plaid. Then, start downloading transactions again.')
     sys.exit(0)
 
+def get_item_id(access_token):
+    config = _cached_config()
+    for section in config.sections():
+        if config.get(section, 'access_token', fallback=None) == access_token:
+            item_id = config.get(section, 'item_id', fallback=None)
+            if item_id:
+                return item_id
+    return None
+
+def get_access_tokens_for_item(item_id):
+    """Access tokens of the configured accounts belonging to a Plaid item."""
+    config = _cached_config()
+    tokens = set()
+    for section in config.sections():
+        if item_id and config.get(section, 'item_id', fallback=None) == item_id:
+            tokens.add(config.get(section, 'access_token'))
+    return tokens
+
 def get_account_in_item(access_token):
-    config = _get_config_parser()
+    config = _cached_config()
     for section in config.sections():
         for (key,val) in config.items(section):
             if key == 'access_token' and val == access_token:
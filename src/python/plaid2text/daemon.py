@@ -0,0 +1,403 @@
+#! /usr/bin/env python3
+
+"""
+Long running sync daemon.
+
+`plaid2text daemon` stays resident and syncs all items every --interval
+seconds (plus a random jitter of up to --jitter seconds, so several
+installations do not hit Plaid in lockstep). The Plaid client and its
+connection pool, and the database connections, are kept open between
+syncs. The config file is parsed again only when it changes.
+
+A unix socket (default ~/.config/plaid2text/daemon.sock) accepts one line
+commands, also available as `plaid2text daemon <command>`:
+
+    status  print the daemon status as JSON
+    sync    sync all items now
+    sync ITEM_ID ...
+            sync only the given Plaid items
+    stop    exit after the current sync
+
+With --webhook-port the daemon also receives Plaid transaction webhooks
+(SYNC_UPDATES_AVAILABLE, DEFAULT_UPDATE, ...) over HTTP and syncs just the
+item named in them. Notifications arriving within --webhook-delay seconds of
+each other, or while a sync runs, are coalesced into one sync.
+"""
+
+import argparse
+from collections import OrderedDict
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import plaid2text.config_manager as cm
+from plaid2text.metrics import METRICS
+import plaid2text.storage_manager as storage_manager
+
+
+COMMANDS = ['run', 'status', 'sync', 'stop']
+
+# Transactions webhook codes that mean there is something new to sync
+WEBHOOK_CODES = [
+    'SYNC_UPDATES_AVAILABLE',
+    'DEFAULT_UPDATE',
+    'INITIAL_UPDATE',
+    'HISTORICAL_UPDATE',
+    'TRANSACTIONS_REMOVED',
+]
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+
+
+def log(message):
+    print('{0} {1}'.format(_now(), message), file=sys.stderr, flush=True)
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline().decode('utf-8').strip()
+        reply = self.server.daemon.command(line)
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Accepts Plaid webhooks. Every request gets a 200 once its body parsed,
+    so Plaid does not keep retrying notifications we chose to ignore.
+    """
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_error(400, 'invalid JSON')
+            return
+        result = self.server.daemon.webhook(payload)
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class Daemon():
+    def __init__(self, options):
+        self.options = options
+        self.plaid = None
+        self.plaid_config = None
+        self.storages = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.sync_all = False
+        self.pending = set()
+        self.pending_due = None
+        self.next_sync = time.time()
+        self.status = OrderedDict([
+            ('pid', os.getpid()),
+            ('started', _now()),
+            ('syncs', 0),
+            ('errors', 0),
+            ('transactions_saved', 0),
+            ('last_sync', None),
+            ('last_duration', None),
+            ('last_error', None),
+            ('next_sync', None),
+            ('syncing', False),
+            ('webhooks', 0),
+            ('pending_items', 0),
+        ])
+
+    def command(self, line):
+        """Handle one control socket command."""
+        if line == 'status':
+            with self.lock:
+                return dict(self.status)
+        if line == 'sync':
+            self.request_sync()
+            return {'ok': True}
+        if line.startswith('sync '):
+            replies = [self._request_item(item_id, 0) for item_id in line.split()[1:]]
+            return {'ok': all(r['ok'] for r in replies), 'items': replies}
+        if line == 'stop':
+            self.stop()
+            return {'ok': True}
+        return {'ok': False, 'error': 'unknown command: {0}'.format(line)}
+
+    def request_sync(self, access_tokens=None, delay=0):
+        """
+        Queue a sync of all items (access_tokens None) or of the given items,
+        to start after `delay` seconds. Items already queued are not added
+        twice, and a queued full sync covers them all.
+        """
+        with self.lock:
+            if access_tokens is None:
+                self.sync_all = True
+                due = time.time()
+            else:
+                self.pending.update(access_tokens)
+                due = time.time() + delay
+            if self.pending_due is None or due < self.pending_due:
+                self.pending_due = due
+            self.status['pending_items'] = len(self.pending)
+        self.wakeup.set()
+
+    def _request_item(self, item_id, delay):
+        access_tokens = cm.get_access_tokens_for_item(item_id)
+        if not access_tokens:
+            log('ignoring sync for unknown item {0}'.format(item_id))
+            return {'ok': False, 'error': 'unknown item: {0}'.format(item_id)}
+        self.request_sync(access_tokens, delay)
+        return {'ok': True}
+
+    def webhook(self, payload):
+        with self.lock:
+            self.status['webhooks'] += 1
+        if payload.get('webhook_type') != 'TRANSACTIONS' or payload.get('webhook_code') not in WEBHOOK_CODES:
+            return {'ok': True, 'ignored': True}
+        log('webhook {0} for item {1}'.format(payload['webhook_code'], payload.get('item_id')))
+        return self._request_item(payload.get('item_id'), self.options.webhook_delay)
+
+    def _take_due(self):
+        """
+        What to sync now: None for every item, a set of access tokens, or an
+        empty set for nothing.
+        """
+        now = time.time()
+        with self.lock:
+            if self.sync_all or now >= self.next_sync:
+                self.sync_all = False
+                self.pending = set()
+                self.pending_due = None
+                access_tokens = None
+            elif self.pending_due is not None and now >= self.pending_due:
+                access_tokens, self.pending, self.pending_due = self.pending, set(), None
+            else:
+                access_tokens = set()
+            self.status['pending_items'] = len(self.pending)
+        return access_tokens
+
+    def stop(self, *args):
+        self.stopping = True
+        self.wakeup.set()
+
+    def _plaid(self):
+        """
+        The Plaid client, created once and kept for its connection pool, or
+        again when the Plaid credentials or host in the config file change.
+        """
+        config = cm.get_plaid_config() + (cm.get_plaid_host(),)
+        if self.plaid is None or config != self.plaid_config:
+            from plaid2text.online_accounts import PlaidAccess
+            self.plaid = PlaidAccess(config[0], config[1], config[2])
+            self.plaid_config = config
+        return self.plaid
+
+    def sync(self, access_tokens=None):
+        start = time.perf_counter()
+        with self.lock:
+            self.status['syncing'] = True
+        error = None
+        saved = 0
+        try:
+            saved = self._plaid().sync_transactions(
+                self.options, access_tokens, interactive=False, storages=self.storages)
+        except SystemExit as e:
+            error = 'exited with {0}'.format(e.code)
+        except Exception as e:
+            error = '{0}: {1}'.format(type(e).__name__, e)
+        duration = time.perf_counter() - start
+        with self.lock:
+            self.status['syncing'] = False
+            self.status['syncs'] += 1
+            self.status['transactions_saved'] += saved
+            self.status['last_sync'] = _now()
+            self.status['last_duration'] = round(duration, 3)
+            if error:
+                self.status['errors'] += 1
+                self.status['last_error'] = error
+        scope = 'all items' if access_tokens is None else '{0} item(s)'.format(len(access_tokens))
+        if error:
+            log('sync of {0} failed: {1}'.format(scope, error))
+        else:
+            log('sync of {0} done in {1:.1f}s, {2} new transactions'.format(scope, duration, saved))
+        if self.options.metrics_file:
+            METRICS.set('plaid2text_run_duration_seconds', duration, command='daemon')
+            METRICS.set('plaid2text_run_last_timestamp_seconds', time.time(), command='daemon')
+            METRICS.set('plaid2text_run_success', int(not error), command='daemon')
+            METRICS.write_textfile(self.options.metrics_file)
+
+    def _schedule(self):
+        self.next_sync = time.time() + self.options.interval + random.uniform(0, self.options.jitter)
+        with self.lock:
+            self.status['next_sync'] = datetime.datetime.fromtimestamp(
+                self.next_sync, datetime.timezone.utc).isoformat(timespec='seconds')
+
+    def run(self):
+        server = _serve(self.options.socket, self)
+        webhooks = None
+        if self.options.webhook_port:
+            webhooks = WebhookServer((self.options.webhook_host, self.options.webhook_port), WebhookHandler)
+            webhooks.daemon = self
+            threading.Thread(target=webhooks.serve_forever, daemon=True).start()
+            log('receiving webhooks on http://{0}:{1}/'.format(*webhooks.server_address[:2]))
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        log('daemon started, control socket {0}'.format(self.options.socket))
+        try:
+            while not self.stopping:
+                with self.lock:
+                    wake = min(self.next_sync, self.pending_due or self.next_sync)
+                self.wakeup.wait(max(wake - time.time(), 0))
+                self.wakeup.clear()
+                if self.stopping:
+                    break
+                access_tokens = self._take_due()
+                if access_tokens is None:
+                    self._schedule()
+                    self.sync()
+                elif access_tokens:
+                    self.sync(access_tokens)
+        finally:
+            if webhooks:
+                webhooks.shutdown()
+                webhooks.server_close()
+            server.shutdown()
+            server.server_close()
+            if os.path.exists(self.options.socket):
+                os.remove(self.options.socket)
+            log('daemon stopped')
+
+
+def _serve(path, daemon):
+    if os.path.exists(path):
+        if _send(path, 'status', quiet=True) is not None:
+            print('A daemon is already listening on {0}'.format(path), file=sys.stderr)
+            sys.exit(1)
+        os.remove(path)
+    old_umask = os.umask(0o077)
+    try:
+        server = ControlServer(path, ControlHandler)
+    finally:
+        os.umask(old_umask)
+    server.daemon = daemon
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _send(path, command, quiet=False):
+    """Send one command to a running daemon and return its reply."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+            s.sendall((command + '\n').encode('utf-8'))
+            reply = s.makefile('r', encoding='utf-8').readline()
+    except OSError as e:
+        if not quiet:
+            print('Cannot reach the daemon at {0}: {1}'.format(path, e), file=sys.stderr)
+        return None
+    return json.loads(reply)
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='plaid2text daemon',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        'command',
+        nargs='?',
+        choices=COMMANDS,
+        default='run',
+        help='run the daemon (default) or send a command to a running one'
+    )
+    parser.add_argument(
+        'items',
+        nargs='*',
+        metavar='ITEM_ID',
+        help='with sync, only sync these Plaid items'
+    )
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=3600.0,
+        metavar='SECONDS',
+        help='time between scheduled syncs (default: 3600)'
+    )
+    parser.add_argument(
+        '--jitter',
+        type=float,
+        default=300.0,
+        metavar='SECONDS',
+        help='random delay of up to SECONDS added to every interval (default: 300)'
+    )
+    parser.add_argument(
+        '--socket',
+        metavar='FILE',
+        default=os.path.join(cm.DEFAULT_CONFIG_DIR, 'daemon.sock'),
+        help='path of the control socket (default: {0})'.format(
+            os.path.join(cm.DEFAULT_CONFIG_DIR, 'daemon.sock'))
+    )
+    parser.add_argument(
+        '--webhook-port',
+        type=int,
+        default=0,
+        metavar='PORT',
+        help='receive Plaid webhooks on PORT (default: off)'
+    )
+    parser.add_argument(
+        '--webhook-host',
+        default='127.0.0.1',
+        metavar='HOST',
+        help='address to receive webhooks on (default: 127.0.0.1)'
+    )
+    parser.add_argument(
+        '--webhook-delay',
+        type=float,
+        default=2.0,
+        metavar='SECONDS',
+        help='wait this long after a webhook so duplicates coalesce (default: 2)'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        metavar='FILE',
+        help='rewrite FILE in the Prometheus textfile-collector format after every sync'
+    )
+    storage_manager.add_storage_arguments(parser, cm.get_defaults())
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = _parse_args(argv)
+    if options.command != 'run':
+        command = ' '.join([options.command] + options.items)
+        reply = _send(options.socket, command)
+        if reply is None:
+            sys.exit(1)
+        print(json.dumps(reply, indent=2))
+        return
+    METRICS.enabled = bool(options.metrics_file)
+    Daemon(options).run()
@@ -0,0 +1,331 @@
+#! /usr/bin/env python3
+
+"""
+Columnar export of stored transactions for analytics tools.
+
+Writes Parquet (or Arrow IPC) files partitioned Hive style by account and
+month, e.g. DEST/account=boa_checking/month=2024-05/part-20240601T120000Z-1f0c9a3e.parquet,
+which pandas, polars, DuckDB and Spark can read as a single dataset.
+
+Exports are incremental: the newest `updated` stamp exported for each account,
+and the ids exported with exactly that stamp, are kept in
+DEST/_plaid2text_watermark.json, and the next run only exports rows changed
+since. A transaction modified after it was exported shows up again in a later
+part file, so readers should keep the row with the latest `updated` per
+transaction_id.
+
+Needs pyarrow (pip install pyarrow).
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import uuid
+
+import plaid2text.config_manager as cm
+from plaid2text.profiler import PROFILER
+from plaid2text.records import to_date
+import plaid2text.storage_manager as storage_manager
+
+
+WATERMARK_FILE = '_plaid2text_watermark.json'
+
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# column name, type, path into the stored transaction
+COLUMNS = [
+    ('transaction_id', 'string', ('transaction_id',)),
+    ('account_id', 'string', ('account_id',)),
+    ('date', 'date', ('date',)),
+    ('authorized_date', 'date', ('authorized_date',)),
+    ('datetime', 'timestamp', ('datetime',)),
+    ('authorized_datetime', 'timestamp', ('authorized_datetime',)),
+    ('name', 'string', ('name',)),
+    ('merchant_name', 'string', ('merchant_name',)),
+    ('amount', 'float', ('amount',)),
+    ('iso_currency_code', 'string', ('iso_currency_code',)),
+    ('unofficial_currency_code', 'string', ('unofficial_currency_code',)),
+    ('pending', 'bool', ('pending',)),
+    ('pending_transaction_id', 'string', ('pending_transaction_id',)),
+    ('payment_channel', 'string', ('payment_channel',)),
+    ('transaction_type', 'string', ('transaction_type',)),
+    ('transaction_code', 'string', ('transaction_code',)),
+    ('check_number', 'string', ('check_number',)),
+    ('account_owner', 'string', ('account_owner',)),
+    ('category', 'list', ('category',)),
+    ('category_id', 'string', ('category_id',)),
+    ('pfc_primary', 'string', ('personal_finance_category', 'primary')),
+    ('pfc_detailed', 'string', ('personal_finance_category', 'detailed')),
+    ('location_address', 'string', ('location', 'address')),
+    ('location_city', 'string', ('location', 'city')),
+    ('location_region', 'string', ('location', 'region')),
+    ('location_postal_code', 'string', ('location', 'postal_code')),
+    ('location_country', 'string', ('location', 'country')),
+    ('location_lat', 'float', ('location', 'lat')),
+    ('location_lon', 'float', ('location', 'lon')),
+    ('location_store_number', 'string', ('location', 'store_number')),
+    ('payment_meta_payee', 'string', ('payment_meta', 'payee')),
+    ('payment_meta_payer', 'string', ('payment_meta', 'payer')),
+    ('payment_meta_payment_method', 'string', ('payment_meta', 'payment_method')),
+    ('payment_meta_payment_processor', 'string', ('payment_meta', 'payment_processor')),
+    ('payment_meta_reference_number', 'string', ('payment_meta', 'reference_number')),
+    ('payment_meta_reason', 'string', ('payment_meta', 'reason')),
+    ('plaid2text_payee', 'string', ('plaid2text', 'payee')),
+    ('plaid2text_posting_account', 'string', ('plaid2text', 'posting_account')),
+    ('plaid2text_associated_account', 'string', ('plaid2text', 'associated_account')),
+    ('plaid2text_tags', 'list', ('plaid2text', 'tags')),
+    ('plaid2text_pulled_to_file', 'bool', ('plaid2text', 'pulled_to_file')),
+    ('plaid2text_date_downloaded', 'timestamp', ('plaid2text', 'date_downloaded')),
+    ('updated', 'timestamp', ('updated',)),
+]
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time())
+    value = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _string(value):
+    return None if value is None else str(value)
+
+
+def _float(value):
+    return None if value is None else float(value)
+
+
+def _bool(value):
+    return None if value is None else bool(value)
+
+
+def _list(value):
+    return None if value is None else [str(v) for v in value]
+
+
+CONVERTERS = {
+    'string': _string,
+    'date': to_date,
+    'timestamp': _timestamp,
+    'float': _float,
+    'bool': _bool,
+    'list': _list,
+}
+
+
+def _lookup(t, path):
+    for key in path:
+        if not isinstance(t, dict):
+            return None
+        t = t.get(key)
+    return t
+
+
+def flatten(t):
+    """One stored transaction as a flat {column: value} row."""
+    return {name: CONVERTERS[kind](_lookup(t, path)) for name, kind, path in COLUMNS}
+
+
+def arrow_schema(pa):
+    types = {
+        'string': pa.string(),
+        'date': pa.date32(),
+        'timestamp': pa.timestamp('us'),
+        'float': pa.float64(),
+        'bool': pa.bool_(),
+        'list': pa.list_(pa.string()),
+    }
+    return pa.schema([(name, types[kind]) for name, kind, _ in COLUMNS])
+
+
+def read_watermarks(dest):
+    path = os.path.join(dest, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, mode='r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_watermarks(dest, watermarks):
+    cm.atomic_write(os.path.join(dest, WATERMARK_FILE), json.dumps(watermarks, indent=2, sort_keys=True) + '\n')
+
+
+class PartitionWriter():
+    """
+    Writes one account's rows, which arrive in date order, into one part file
+    per month. Each file is written under a temporary name and renamed into
+    place when its month is complete, so readers never see a partial file.
+    """
+    def __init__(self, pa, dest, account, fmt, part_name, batch_size):
+        self.pa = pa
+        self.schema = arrow_schema(pa)
+        self.dest = dest
+        self.account = account
+        self.fmt = fmt
+        self.part_name = part_name
+        self.batch_size = batch_size
+        self.month = None
+        self.writer = None
+        self.path = None
+        self.rows = []
+        self.files = []
+        self.row_count = 0
+
+    def write(self, row):
+        month = row['date'].strftime('%Y-%m')
+        if month != self.month:
+            self._close_month()
+            self._open_month(month)
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self._flush()
+
+    def _open_month(self, month):
+        directory = os.path.join(self.dest, 'account=' + self.account, 'month=' + month)
+        os.makedirs(directory, exist_ok=True)
+        self.month = month
+        self.path = os.path.join(directory, self.part_name + FORMATS[self.fmt])
+        tmp = self.path + '.tmp'
+        if self.fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(tmp, self.schema, compression='zstd')
+        else:
+            self.writer = self.pa.ipc.new_file(tmp, self.schema)
+
+    def _flush(self):
+        if not self.rows:
+            return
+        batch = self.pa.RecordBatch.from_pylist(self.rows, schema=self.schema)
+        if self.fmt == 'parquet':
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write(batch)
+        self.row_count += len(self.rows)
+        self.rows = []
+
+    def _close_month(self):
+        if self.writer is None:
+            return
+        self._flush()
+        self.writer.close()
+        os.replace(self.path + '.tmp', self.path)
+        self.files.append(self.path)
+        self.writer = None
+
+    def close(self):
+        self._close_month()
+
+
+def export_account(pa, options, account, watermark, part_name):
+    """
+    Export one account's rows changed since the watermark (all rows if None).
+    Returns (rows written, files written, new watermark).
+
+    Stamps only have a one second resolution in SQLite, so rows are fetched
+    from the watermark stamp on and the ids already exported at exactly that
+    stamp are skipped.
+    """
+    with PROFILER.stage('db_open'):
+        sm = storage_manager.open_storage(options, account)
+    account_id = None
+    if options.dbtype == 'sqlite':
+        # SQLite keeps every account in one table keyed by Plaid account_id
+        account_id = cm.get_config(account).get('account')
+    writer = PartitionWriter(pa, options.dest, account, options.format, part_name, options.batch_size)
+    since = watermark['updated'] if watermark else None
+    seen = set(watermark['ids']) if watermark else set()
+    newest, newest_ids = since, set(seen)
+    with PROFILER.stage('export'):
+        for t in sm.iter_transactions(account_id=account_id, changed_since=since,
+                                      batch_size=options.batch_size):
+            updated = t.get('updated')
+            if updated == since and t['transaction_id'] in seen:
+                continue
+            writer.write(flatten(t))
+            if not updated:
+                continue
+            if newest is None or updated > newest:
+                newest, newest_ids = updated, set()
+            if updated == newest:
+                newest_ids.add(t['transaction_id'])
+        writer.close()
+    PROFILER.count('rows_exported', writer.row_count)
+    if newest is None:
+        return writer.row_count, writer.files, None
+    return writer.row_count, writer.files, {'updated': newest, 'ids': sorted(newest_ids)}
+
+
+def _parse_args(argv):
+    defaults = cm.get_defaults()
+    parser = argparse.ArgumentParser(
+        prog='plaid2text export',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('dest', metavar='DIR', help='directory to write the dataset to')
+    parser.add_argument(
+        '--account',
+        dest='accounts',
+        action='append',
+        metavar='NICKNAME',
+        help='account to export; may be repeated (default: every configured account)'
+    )
+    parser.add_argument(
+        '--format',
+        choices=sorted(FORMATS),
+        default='parquet',
+        help='file format to write (default: parquet)'
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='ignore the stored watermark and export every row'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=5000,
+        help='rows fetched and written per batch (default: 5000)'
+    )
+    storage_manager.add_storage_arguments(parser, defaults)
+    parser.add_argument('--profile', action='store_true', help='print a per-stage timing breakdown')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = _parse_args(argv)
+    try:
+        import pyarrow as pa
+    except ImportError:
+        print('The export command needs pyarrow: pip install pyarrow', file=sys.stderr)
+        sys.exit(1)
+    if options.profile:
+        PROFILER.enable()
+
+    accounts = options.accounts or cm.get_configured_accounts()
+    for account in accounts:
+        if not cm.account_exists(account):
+            print('Unknown account: {0}'.format(account), file=sys.stderr)
+            sys.exit(1)
+
+    os.makedirs(options.dest, exist_ok=True)
+    watermarks = read_watermarks(options.dest)
+    # Unique per run: runs in the same second must not replace each other's
+    # files, whose rows the watermark has already moved past
+    part_name = 'part-{0:%Y%m%dT%H%M%SZ}-{1}'.format(datetime.datetime.now(datetime.timezone.utc),
+                                                    uuid.uuid4().hex[:8])
+    for account in accounts:
+        watermark = None if options.full else watermarks.get(account)
+        rows, files, watermark = export_account(pa, options, account, watermark, part_name)
+        print('{0}: exported {1} transactions to {2} files'.format(account, rows, len(files)), file=sys.stderr)
+        if watermark:
+            watermarks[account] = watermark
+            # Saved per account so an interrupted run keeps finished accounts
+            write_watermarks(options.dest, watermarks)
+    PROFILER.report()
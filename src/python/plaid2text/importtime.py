@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+
+"""
+Import-time regression check for the CLI entry point.
+
+Imports plaid2text.plaid2text in fresh interpreters and fails if any of the
+heavy dependencies (plaid SDK, pymongo, prompt_toolkit, dateutil, beancount)
+got loaded or the locale was set at import, or if the best-of-N import time exceeds the budget.
+
+Run with: python -m plaid2text.importtime [--budget-ms 150] [--runs 5]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+ENTRY_POINT = 'plaid2text.plaid2text'
+
+HEAVY_MODULES = ['plaid', 'pymongo', 'prompt_toolkit', 'dateutil', 'beancount']
+
+# LC_MONETARY only leaves "C" once setlocale(LC_ALL, '') has run, which is
+# what get_locale_currency_symbol does.
+PROBE = """
+import json, locale, sys, time
+start = time.perf_counter()
+import {0}
+elapsed = time.perf_counter() - start
+loaded = [m for m in {1!r} if m in sys.modules]
+if locale.setlocale(locale.LC_MONETARY) != 'C':
+    loaded.append('setlocale')
+print(json.dumps({{'seconds': elapsed, 'loaded': loaded}}))
+"""
+
+
+def measure(runs):
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [src, env.get('PYTHONPATH')]))
+    results = []
+    for _ in range(runs):
+        p = subprocess.run([sys.executable, '-c', PROBE.format(ENTRY_POINT, HEAVY_MODULES)],
+                           env=env, stdout=subprocess.PIPE, check=True)
+        results.append(json.loads(p.stdout.decode('utf-8')))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='importtime', description=__doc__)
+    parser.add_argument('--budget-ms', type=float, default=150.0,
+                        help='fail if the best import time exceeds this (default: 150)')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='number of fresh interpreters to measure (default: 5)')
+    args = parser.parse_args()
+
+    results = measure(args.runs)
+    best = min(r['seconds'] for r in results) * 1000
+    loaded = sorted(set(m for r in results for m in r['loaded']))
+    print('import %s: best %.1f ms of %d runs (budget %.1f ms)' % (ENTRY_POINT, best, args.runs, args.budget_ms))
+    failed = False
+    if loaded:
+        print('FAIL: heavy modules loaded at import: %s' % ', '.join(loaded), file=sys.stderr)
+        failed = True
+    if best > args.budget_ms:
+        print('FAIL: import time over budget', file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
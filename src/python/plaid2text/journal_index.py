@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+
+"""
+The set of Plaid transaction ids already written to a journal.
+
+The default templates record the Plaid transaction id of every entry, as
+`; _id: ...` for ledger and `plaid_id: "..."` for beancount. journal_ids()
+streams the journal and every file it includes once, collecting those ids so
+that regenerating (--all-transactions, --no-mark-pulled) can skip entries the
+journal already has.
+
+Results are cached per file, keyed by its size and modification time, so
+only journal files that changed since the last run are read again.
+"""
+
+import glob
+import json
+import os
+import re
+
+import plaid2text.config_manager as cm
+
+
+ID_RE = re.compile(r'^\s*;?\s*(?:_id|plaid_id)\s*:\s*"?([^"\s]+)"?\s*$')
+
+INCLUDE_RE = re.compile(r'^\s*!?include\s+"?([^"]+?)"?\s*$')
+
+
+def fingerprint(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def scan_file(path):
+    """The transaction ids and the resolved include paths in one file."""
+    ids = []
+    includes = []
+    base = os.path.dirname(path)
+    with open(path, mode='r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            mo = ID_RE.match(line)
+            if mo:
+                ids.append(mo.group(1))
+                continue
+            mo = INCLUDE_RE.match(line)
+            if mo:
+                pattern = os.path.join(base, os.path.expanduser(mo.group(1)))
+                includes.extend(sorted(glob.glob(pattern)) or [pattern])
+    return ids, includes
+
+
+def _read_cache(cache_file):
+    try:
+        with open(cache_file, mode='r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def journal_ids(journal_file, cache_file=None):
+    """
+    The transaction ids in journal_file and, recursively, its includes.
+    Included files that do not exist are ignored.
+    """
+    cache_file = cache_file or cm.FILE_DEFAULTS.journal_ids_cache
+    cache = _read_cache(cache_file)
+    ids = set()
+    seen = set()
+    stale = False
+    pending = [os.path.abspath(journal_file)]
+    while pending:
+        path = pending.pop()
+        if path in seen or not os.path.isfile(path):
+            continue
+        seen.add(path)
+        fp = fingerprint(path)
+        cached = cache.get(path)
+        if not cached or cached['fingerprint'] != fp:
+            file_ids, includes = scan_file(path)
+            cached = cache[path] = {'fingerprint': fp, 'ids': file_ids, 'includes': includes}
+            stale = True
+        ids.update(cached['ids'])
+        pending.extend(cached['includes'])
+    if stale:
+        # Drop entries for journal files that have been deleted
+        cache = {p: v for p, v in cache.items() if p in seen or os.path.isfile(p)}
+        with cm.file_lock(cache_file):
+            cm.atomic_write(cache_file, json.dumps(cache))
+    return ids
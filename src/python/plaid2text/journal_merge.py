@@ -0,0 +1,161 @@
+#! /usr/bin/env python3
+
+"""
+Date ordered merge of rendered entries into an existing journal.
+
+With --merge-into JOURNAL the entries of a run are first appended to
+JOURNAL.<account>.pending, so that, as with --outfile, an entry is written
+before its transaction is marked pulled. merge_pending() then splices them
+into the journal:
+
+- one pass over the mmapped journal finds the offset and date of every line
+  that starts with a date (entries and dated directives), the only parse the
+  journal gets;
+- each new entry goes after the last journal entry dated on or before it,
+  found by bisecting the suffix minima of those dates, so already sorted
+  journals and journals with a few dated directives out of order (e.g.
+  beancount `open` lines at the top) both merge sensibly;
+- the journal is copied to a temporary file in big slices, with the new
+  entries written at their offsets, and atomically renamed over it.
+
+A pending file left by an interrupted run is merged by the next one.
+Dates are recognised as YYYY-MM-DD, YYYY/MM/DD or YYYY.MM.DD.
+"""
+
+from bisect import bisect_right
+from collections import OrderedDict
+import mmap
+import os
+import re
+import shutil
+import tempfile
+
+import plaid2text.config_manager as cm
+from plaid2text.profiler import PROFILER
+
+
+DATE_LINE_RE = re.compile(rb'^(\d{4})[-/.](\d{2})[-/.](\d{2})(?=[\s=])', re.M)
+
+
+COPY_BLOCK = 1 << 20
+
+
+def pending_path(journal_file, account):
+    return '{0}.{1}.pending'.format(journal_file, account)
+
+
+def date_index(data):
+    """
+    ([yyyymmdd, ...], [offset, ...]) of the lines of data (bytes or mmap)
+    that start with a date, in file order.
+    """
+    dates = []
+    offsets = []
+    for mo in DATE_LINE_RE.finditer(data):
+        y, m, d = mo.groups()
+        dates.append(int(y) * 10000 + int(m) * 100 + int(d))
+        offsets.append(mo.start())
+    return dates, offsets
+
+
+def split_entries(text):
+    """
+    [(yyyymmdd, entry), ...] of text cut at every line starting with a date.
+    Text before the first such line is dropped; entries end with one blank
+    line.
+    """
+    data = text.encode('utf-8')
+    dates, offsets = date_index(data)
+    offsets.append(len(data))
+    return [
+        (date, data[start:end].rstrip(b'\n') + b'\n\n')
+        for date, start, end in zip(dates, offsets, offsets[1:])
+    ]
+
+
+def _insertion_offsets(dates, offsets, size, entries):
+    """{offset: [entry, ...]} for entries [(yyyymmdd, entry), ...]."""
+    # floor[i] = min(dates[i:]): non-decreasing, so it can be bisected even
+    # if the journal is not sorted
+    floor = list(dates)
+    for i in range(len(floor) - 2, -1, -1):
+        if floor[i + 1] < floor[i]:
+            floor[i] = floor[i + 1]
+    positions = OrderedDict()
+    # sorted() is stable: entries of one day keep their rendering order
+    for date, entry in sorted(entries, key=lambda e: e[0]):
+        i = bisect_right(floor, date)
+        if not offsets:
+            offset = size
+        elif i == 0:
+            offset = offsets[0]
+        else:
+            offset = offsets[i] if i < len(offsets) else size
+        positions.setdefault(offset, []).append(entry)
+    return positions
+
+
+def _copy(out, data, start, end):
+    for block in range(start, end, COPY_BLOCK):
+        out.write(data[block:min(block + COPY_BLOCK, end)])
+
+
+def merge_entries(journal_file, entries):
+    """
+    Splice entries [(yyyymmdd, entry bytes), ...] into journal_file in date
+    order with a single streaming rewrite.
+    """
+    directory = os.path.dirname(os.path.abspath(journal_file))
+    with cm.file_lock(journal_file):
+        with open(journal_file, mode='a+b') as src:
+            size = os.fstat(src.fileno()).st_size
+            data = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            try:
+                with PROFILER.stage('merge_index'):
+                    dates, offsets = date_index(data)
+                positions = _insertion_offsets(dates, offsets, size, entries)
+                fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(journal_file) + '.')
+                try:
+                    with PROFILER.stage('merge_write'), os.fdopen(fd, mode='wb') as out:
+                        done = 0
+                        for offset in sorted(positions):
+                            _copy(out, data, done, offset)
+                            done = offset
+                            if offset == size and size:
+                                # Appending: keep a blank line after the
+                                # last journal line
+                                tail = data[max(size - 2, 0):size]
+                                if not tail.endswith(b'\n'):
+                                    out.write(b'\n\n')
+                                elif not tail.endswith(b'\n\n'):
+                                    out.write(b'\n')
+                            out.writelines(positions[offset])
+                        _copy(out, data, done, size)
+                        out.flush()
+                        os.fsync(out.fileno())
+                    shutil.copymode(journal_file, tmp)
+                    os.replace(tmp, journal_file)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.unlink(tmp)
+                    raise
+            finally:
+                if size:
+                    data.close()
+    PROFILER.count('entries_merged', len(entries))
+
+
+def merge_pending(journal_file, account):
+    """
+    Merge the entries of account waiting in the pending file of
+    journal_file and remove it. Returns the number of entries merged.
+    """
+    path = pending_path(journal_file, account)
+    if not os.path.isfile(path):
+        return 0
+    with open(path, mode='r', encoding='utf-8') as f:
+        entries = split_entries(f.read())
+    if entries:
+        merge_entries(journal_file, entries)
+    os.unlink(path)
+    return len(entries)
@@ -0,0 +1,149 @@
+#! /usr/bin/env python3
+
+"""
+End-to-end load harness for the sync and download paths.
+
+Starts the local Plaid stand-in (see plaid2text.plaid_stub), writes a
+throwaway configuration pointing at it, then runs `plaid2text -s` and
+`plaid2text <account> --download-transactions` as real subprocesses and
+reports wall time and throughput for each.
+
+Run with: python -m plaid2text.loadtest --items 4 --transactions 2000
+"""
+
+import argparse
+import configparser
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from plaid2text.plaid_stub import add_stub_arguments, server_from_args
+
+
+def write_config(config_dir, server, dbtype='sqlite'):
+    config = configparser.ConfigParser(interpolation=None)
+    config['DEFAULT'] = {
+        'dbtype': dbtype,
+        'sqlite_db': os.path.join(config_dir, 'transactions.db'),
+        'mongo_db': 'plaid2text_loadtest',
+    }
+    config['PLAID'] = {
+        'client_id': 'stub-client',
+        'secret': 'stub-secret',
+        'host': server.url,
+    }
+    accounts = []
+    for access_token, item in sorted(server.data.items.items()):
+        for account_id in item['accounts']:
+            nickname = account_id.replace('-', '_')
+            config[nickname] = {
+                'access_token': access_token,
+                'item_id': item['item_id'],
+                'account': account_id,
+                'posting_account': 'Assets:Stub:' + nickname,
+                'cursor': '',
+            }
+            accounts.append(nickname)
+    with open(os.path.join(config_dir, 'config'), mode='w') as f:
+        config.write(f)
+    # update_link_token rewrites the token inside an existing auth page
+    with open(os.path.join(config_dir, 'auth.html'), mode='w') as f:
+        f.write("token: 'link-stub'\n")
+    return accounts
+
+
+def run_cli(config_dir, *cli_args):
+    env = dict(os.environ)
+    env['PLAID2TEXT_CONFIG_DIR'] = config_dir
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [src, env.get('PYTHONPATH')]))
+    cmd = [sys.executable, '-c', 'from plaid2text.plaid2text import main; main()']
+    start = time.perf_counter()
+    p = subprocess.run(cmd + list(cli_args), env=env, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    return p, elapsed
+
+
+def count_rows(config_dir):
+    db = os.path.join(config_dir, 'transactions.db')
+    if not os.path.exists(db):
+        return 0
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute('select count(*) from transactions').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def report(label, p, elapsed, served, rows, requests):
+    status = 'ok' if p.returncode == 0 else 'exit %d' % p.returncode
+    print('{:<10} {:>8.2f}s {:>8} req {:>9} served {:>9} rows {:>10.1f} txn/s  [{}]'.format(
+        label, elapsed, requests, served, rows, served / elapsed if elapsed else 0.0, status))
+    if p.returncode != 0:
+        for line in p.stderr.decode('utf-8', 'replace').strip().splitlines()[-5:]:
+            print('    ' + line)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='loadtest', description=__doc__)
+    add_stub_arguments(parser)
+    parser.add_argument('--from-date', default='2000-01-01',
+                        help='start date for the download run (default: 2000-01-01)')
+    parser.add_argument('--to-date', default='2023-01-01',
+                        help='end date for the download run (default: 2023-01-01)')
+    parser.add_argument('--skip-sync', action='store_true',
+                        help='do not run the sync phase')
+    parser.add_argument('--skip-download', action='store_true',
+                        help='do not run the download phase')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary config directory')
+    args = parser.parse_args()
+
+    server = server_from_args(args)
+    config_dir = tempfile.mkdtemp(prefix='plaid2text-loadtest-')
+    try:
+        print('Plaid stand-in at %s, config in %s' % (server.url, config_dir))
+        if not args.skip_sync:
+            accounts = write_config(config_dir, server)
+            before = dict(server.stats)
+            p, elapsed = run_cli(config_dir, '-s')
+            report('sync', p, elapsed,
+                   server.stats['transactions_served'] - before['transactions_served'],
+                   count_rows(config_dir),
+                   server.stats['requests'] - before['requests'])
+
+        if not args.skip_download:
+            os.remove(os.path.join(config_dir, 'config'))
+            db = os.path.join(config_dir, 'transactions.db')
+            if os.path.exists(db):
+                os.remove(db)
+            accounts = write_config(config_dir, server)
+            before = dict(server.stats)
+            total = 0.0
+            failed = None
+            for account in accounts:
+                p, elapsed = run_cli(config_dir, account, '-d',
+                                     '--from-date', args.from_date,
+                                     '--to-date', args.to_date)
+                total += elapsed
+                if p.returncode != 0 and failed is None:
+                    failed = p
+            report('download', failed or p, total,
+                   server.stats['transactions_served'] - before['transactions_served'],
+                   count_rows(config_dir),
+                   server.stats['requests'] - before['requests'])
+    finally:
+        server.shutdown()
+        if args.keep:
+            print('Kept %s' % config_dir)
+        else:
+            shutil.rmtree(config_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#! /usr/bin/env python3
+
+"""
+Run metrics for monitoring sync, download and render runs.
+
+Instrumented code records into the module level METRICS registry, which is
+disabled (and close to free) unless --metrics-file or --metrics-log is
+given. At the end of a run the registry is written as a Prometheus
+textfile-collector file and/or appended as one line to a JSON-lines log.
+"""
+
+from collections import OrderedDict
+import datetime
+import json
+import os
+import threading
+
+
+# name: (type, help)
+METRIC_INFO = OrderedDict([
+    ('plaid2text_api_calls_total', ('counter', 'Plaid API calls made')),
+    ('plaid2text_api_errors_total', ('counter', 'Plaid API calls that failed')),
+    ('plaid2text_api_latency_seconds', ('summary', 'Plaid API call latency')),
+    ('plaid2text_api_retries_total', ('counter', 'Plaid API calls retried after a transient error')),
+    ('plaid2text_api_throttled_total', ('counter', 'Plaid API calls delayed by the client side rate limiter')),
+    ('plaid2text_api_throttle_seconds_total', ('counter', 'Seconds Plaid API calls waited for the rate limiter')),
+    ('plaid2text_sync_pages_total', ('counter', 'Pages fetched from /transactions/sync')),
+    ('plaid2text_sync_transactions_total', ('counter', 'Transactions returned by /transactions/sync')),
+    ('plaid2text_sync_cursor_lag_transactions', ('gauge', 'Changes the stored cursor was behind by at sync time')),
+    ('plaid2text_download_pages_total', ('counter', 'Pages fetched from /transactions/get')),
+    ('plaid2text_storage_rows_upserted_total', ('counter', 'Transactions written by save_transactions')),
+    ('plaid2text_storage_rows_modified_total', ('counter', 'Transactions updated by update_transaction')),
+    ('plaid2text_storage_rows_read_total', ('counter', 'Transactions read by get_transactions')),
+    ('plaid2text_render_transactions_total', ('counter', 'Transactions rendered to the output file')),
+    ('plaid2text_render_seconds', ('summary', 'Time spent processing transactions for output')),
+    ('plaid2text_render_transactions_per_second', ('gauge', 'Render throughput')),
+    ('plaid2text_run_duration_seconds', ('gauge', 'Wall time of the whole run')),
+    ('plaid2text_run_last_timestamp_seconds', ('gauge', 'Unix time the run finished')),
+    ('plaid2text_run_success', ('gauge', '1 if the run finished without error')),
+])
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metrics():
+    def __init__(self):
+        self.enabled = False
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _add(self, name, key, value, replace=False):
+        with self.lock:
+            series = self.values.setdefault(name, OrderedDict())
+            series[key] = value if replace else series.get(key, 0) + value
+
+    def inc(self, name, value=1, **labels):
+        if self.enabled:
+            self._add(name, _label_key(labels), value)
+
+    def set(self, name, value, **labels):
+        if self.enabled:
+            self._add(name, _label_key(labels), value, replace=True)
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            key = _label_key(labels)
+            self._add(name + '_sum', key, value)
+            self._add(name + '_count', key, 1)
+
+    def samples(self):
+        """Yield (metric name, series name, labels, value) in a stable order."""
+        for name in METRIC_INFO:
+            for suffix in ('', '_sum', '_count'):
+                for key, value in self.values.get(name + suffix, {}).items():
+                    yield name, name + suffix, OrderedDict(key), value
+
+    def write_textfile(self, path):
+        """
+        Write all series in the Prometheus text exposition format. The file is
+        written next to its destination and renamed into place, so the
+        node_exporter textfile collector never reads a partial file.
+        """
+        lines = []
+        seen = set()
+        for name, series, labels, value in self.samples():
+            if name not in seen:
+                seen.add(name)
+                kind, help_text = METRIC_INFO[name]
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+            label_text = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items())
+            lines.append('{}{} {}'.format(series, '{' + label_text + '}' if label_text else '', value))
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, mode='w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+    def write_jsonl(self, path, **run):
+        """Append one JSON object describing this run to path."""
+        record = OrderedDict(run)
+        record['timestamp'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        record['metrics'] = [
+            OrderedDict([('name', series), ('labels', labels), ('value', value)])
+            for name, series, labels, value in self.samples()
+        ]
+        with open(path, mode='a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+METRICS = Metrics()
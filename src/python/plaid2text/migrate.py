@@ -0,0 +1,242 @@
+#! /usr/bin/env python3
+
+"""
+Copy the stored transactions from one backend to another.
+
+The source is the configured storage (or the usual storage options), the
+target is given with --to and the --to-* options. Each account is streamed
+in the order the source keeps it, batch by batch, and written with bulk
+upserts carrying the plaid2text metadata along, dates converted to what the
+target stores. Memory holds one batch at a time.
+
+The position after every written batch is saved, so an interrupted run
+picks up from the last batch when started again (--restart starts over).
+At the end both sides are read again and compared per account: the number
+of transactions and an order independent checksum of their contents.
+
+  plaid2text migrate --dbtype mongodb --to sqlite --to-sqlite-db ~/transactions.db
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sys
+
+import plaid2text.config_manager as cm
+from plaid2text.profiler import PROFILER
+import plaid2text.storage_manager as storage_manager
+
+
+# Positions of the runs not completed yet, by source and target
+CHECKPOINT_FILE = os.path.join(cm.DEFAULT_CONFIG_DIR, 'migrate.json')
+
+CHECKSUM_BITS = 128
+
+
+def _parse_args(argv):
+    defaults = cm.get_defaults()
+    parser = argparse.ArgumentParser(
+        prog='plaid2text migrate',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    storage_manager.add_storage_arguments(parser, defaults)
+    parser.add_argument(
+        '--to',
+        required=True,
+        choices=['mongodb', 'sqlite', 'segments'],
+        help='the type of database to copy the transactions to'
+    )
+    parser.add_argument('--to-mongo-db', metavar='STR', default=defaults['mongo_db'],
+                        help='the name of the target Mongo database')
+    parser.add_argument('--to-mongo-db-uri', metavar='STR', default=defaults['mongo_db_uri'],
+                        help='the URI of the target Mongo database')
+    parser.add_argument('--to-sqlite-db', metavar='STR', default=os.path.expanduser(defaults['sqlite_db']),
+                        help='the path of the target SQLite database')
+    parser.add_argument('--to-segment-dir', metavar='DIR', default=os.path.expanduser(defaults['segment_dir']),
+                        help='the directory of the target segment store')
+    parser.add_argument('--to-cold-archive', action='store_true', default=defaults['cold_archive'],
+                        help='write lean rows and archive the full payloads in the target')
+    parser.add_argument(
+        '--account',
+        dest='accounts',
+        action='append',
+        metavar='NICKNAME',
+        help='only migrate this account; may be repeated (default: every configured account)'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='transactions read and written at a time (default: 1000)'
+    )
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the position of an interrupted run and copy everything')
+    parser.add_argument('--verify-only', action='store_true',
+                        help='only compare the source and the target')
+    parser.add_argument('--profile', action='store_true', help='print a per-stage timing breakdown')
+    return parser.parse_args(argv)
+
+
+def _target_options(options):
+    return argparse.Namespace(
+        dbtype=options.to,
+        mongo_db=options.to_mongo_db,
+        mongo_db_uri=options.to_mongo_db_uri,
+        sqlite_db=options.to_sqlite_db,
+        segment_dir=options.to_segment_dir,
+        cold_archive=options.to_cold_archive,
+    )
+
+
+def _describe(options):
+    if options.dbtype == 'mongodb':
+        return 'mongodb:{0}/{1}'.format(options.mongo_db_uri, options.mongo_db)
+    if options.dbtype == 'segments':
+        return 'segments:' + os.path.abspath(os.path.expanduser(options.segment_dir))
+    return 'sqlite:' + os.path.abspath(os.path.expanduser(options.sqlite_db))
+
+
+def _read_checkpoints():
+    try:
+        with open(CHECKPOINT_FILE, mode='r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_checkpoints(checkpoints):
+    cm.atomic_write(CHECKPOINT_FILE, json.dumps(checkpoints, indent=2, sort_keys=True) + '\n')
+
+
+def fingerprint(t):
+    """
+    A hash of a portable transaction that does not depend on how the
+    backend stored it: key order, fields stored as null or left out (cold
+    archived rows keep every hot field) and the time zone of datetimes.
+    """
+    t = dict((k, v) for k, v in t.items() if v is not None)
+    for field in ('datetime', 'authorized_datetime'):
+        if t.get(field):
+            d = datetime.datetime.fromisoformat(t[field])
+            if d.tzinfo:
+                d = d.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            t[field] = d.isoformat()
+    data = json.dumps(t, sort_keys=True, separators=(',', ':'), default=str)
+    return int.from_bytes(hashlib.sha256(data.encode('utf-8')).digest()[:CHECKSUM_BITS // 8], 'big')
+
+
+def digest(sm, account_id, batch_size):
+    """(count, checksum) of the transactions stored for an account."""
+    count = 0
+    checksum = 0
+    for _, t in sm.iter_stored(account_id, batch_size=batch_size):
+        count += 1
+        # A sum: the backends' orders differ
+        checksum = (checksum + fingerprint(t)) % (1 << CHECKSUM_BITS)
+    return count, '{0:032x}'.format(checksum)
+
+
+def copy_account(source, target, account_id, position, save, batch_size):
+    """
+    Stream an account from source to target after position (a dict with
+    the last key written and the number of rows), calling save(position)
+    after every batch. Returns the number of rows copied in this run.
+    """
+    copied = 0
+    batch = []
+    last = position.get('after')
+
+    def flush():
+        with PROFILER.stage('migrate_write'):
+            target.import_transactions(batch)
+        position['after'] = last
+        position['rows'] = position.get('rows', 0) + len(batch)
+        save(position)
+        PROFILER.count('rows_migrated', len(batch))
+
+    for key, t in source.iter_stored(account_id, after=position.get('after'), batch_size=batch_size):
+        batch.append(t)
+        last = key
+        if len(batch) >= batch_size:
+            flush()
+            copied += len(batch)
+            batch = []
+    if batch:
+        flush()
+        copied += len(batch)
+    return copied
+
+
+def main(argv):
+    options = _parse_args(argv)
+    if options.profile:
+        PROFILER.enable()
+    target_options = _target_options(options)
+    run = '{0} -> {1}'.format(_describe(options), _describe(target_options))
+    if _describe(options) == _describe(target_options):
+        print('The source and the target are the same: {0}'.format(_describe(options)), file=sys.stderr)
+        sys.exit(1)
+
+    accounts = options.accounts or cm.get_configured_accounts()
+    for account in accounts:
+        if not cm.account_exists(account):
+            print('Unknown account: {0}'.format(account), file=sys.stderr)
+            sys.exit(1)
+
+    checkpoints = _read_checkpoints()
+    if options.restart:
+        checkpoints.pop(run, None)
+    positions = checkpoints.setdefault(run, {})
+
+    mismatched = []
+    for account in accounts:
+        account_id = cm.get_config(account).get('account')
+        if not account_id and 'sqlite' in (options.dbtype, options.to):
+            # SQLite keeps every account in one table, told apart by id
+            print('Skipping {0}: no Plaid account id configured'.format(account), file=sys.stderr)
+            continue
+        source = storage_manager.open_storage(options, account)
+        target = storage_manager.open_storage(target_options, account)
+
+        if not options.verify_only:
+            position = positions.setdefault(account, {})
+            if position.get('done'):
+                print('{0}: already copied'.format(account))
+            else:
+                if position.get('rows'):
+                    print('{0}: resuming after {1} transactions'.format(account, position['rows']))
+
+                def save(position, account=account):
+                    positions[account] = position
+                    _write_checkpoints(checkpoints)
+
+                copied = copy_account(source, target, account_id, position, save, options.batch_size)
+                position['done'] = True
+                save(position)
+                print('{0}: copied {1} transactions'.format(account, copied))
+
+        with PROFILER.stage('verify'):
+            source_digest = digest(source, account_id, options.batch_size)
+            target_digest = digest(target, account_id, options.batch_size)
+        if source_digest == target_digest:
+            print('{0}: {1} transactions, checksum {2} matches'.format(account, *source_digest))
+        else:
+            print('{0}: source has {1} transactions (checksum {2}), target {3} ({4})'.format(
+                account, source_digest[0], source_digest[1], target_digest[0], target_digest[1]),
+                file=sys.stderr)
+            mismatched.append(account)
+    PROFILER.report()
+
+    if mismatched:
+        print('Verification failed for: {0}'.format(', '.join(mismatched)), file=sys.stderr)
+        sys.exit(1)
+    if not options.verify_only:
+        # Done: a new run starts from scratch
+        checkpoints.pop(run, None)
+        if checkpoints:
+            _write_checkpoints(checkpoints)
+        elif os.path.exists(CHECKPOINT_FILE):
+            os.unlink(CHECKPOINT_FILE)
@@ -2,12 +2,15 @@
 
 from collections import OrderedDict
 import datetime
+import hashlib
 import os
 import sys
 import textwrap
 import json
+import time
 
 import plaid
+import urllib3
 from plaid.api import plaid_api
 from plaid.model.transactions_get_request import TransactionsGetRequest
 from plaid.model.transactions_get_request_options import TransactionsGetRequestOptions
@@ -15,12 +18,47 @@ from plaid.model.transactions_sync_request import TransactionsSyncRequest
 
 import plaid2text.config_manager as cm
 import plaid2text.storage_manager as storage_manager
+from plaid2text.metrics import METRICS
+from plaid2text.profiler import PROFILER
+from plaid2text.ratelimit import backoff, get_limiter
 from plaid2text.interact import prompt, clear_screen, NullValidator
 from plaid2text.interact import NumberValidator, NumLengthValidator, YesNoValidator, PATH_COMPLETER
 
 
+def _error_response(ex):
+    """The Plaid error object of a failed call, also for non JSON bodies."""
+    try:
+        return json.loads(ex.body)
+    except (TypeError, ValueError):
+        return {'error_type': None, 'error_code': str(ex.status), 'error_message': ex.reason}
+
+
+def _retry_reason(ex, error):
+    """Why a failed call is worth retrying, or None if it is not."""
+    if ex.status == 429 or error.get('error_type') == 'RATE_LIMIT_EXCEEDED':
+        return 'rate_limit'
+    if ex.status and ex.status >= 500:
+        return 'server_error'
+    return None
+
+
+def _retry_after(ex):
+    """Seconds asked for by a Retry-After header, 0 without one."""
+    try:
+        return float(ex.headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return 0.0
+
+
+class _RecordedResponse():
+    """Stands in for the HTTP response when deserializing a recorded body."""
+    def __init__(self, data):
+        self.data = data
+
+
 class PlaidAccess():
-    def __init__(self, client_id=None, secret=None):
+    def __init__(self, client_id=None, secret=None, host=None, cassette=None):
+        """cassette: optional Cassette to record calls to or replay them from"""
         if client_id and secret:
             self.client_id = client_id
             self.secret = secret
@@ -28,7 +66,7 @@ class PlaidAccess():
             self.client_id, self.secret = cm.get_plaid_config()
 
         configuration = plaid.Configuration(
-            host = plaid.Environment.Production,
+            host = host or cm.get_plaid_host(),
             api_key = {
                 'clientId':self.client_id,
                 'secret': self.secret,
@@ -36,6 +74,98 @@ class PlaidAccess():
         )
         self.api_client = plaid.ApiClient(configuration)
         self.client = plaid_api.PlaidApi(self.api_client)
+        self._item_labels = {}
+        limits = cm.get_plaid_limits()
+        self.limiter = get_limiter(self.client_id, limits['client_rate'], limits['item_rate'])
+        self.max_retries = limits['max_retries']
+        self.timeout = limits['timeout']
+        self.cassette = cassette
+
+    def _item_label(self, access_token):
+        """The item_id for metric labels, never the access token itself."""
+        if access_token not in self._item_labels:
+            item_id = cm.get_item_id(access_token)
+            if not item_id:
+                item_id = hashlib.sha256(access_token.encode('utf-8')).hexdigest()[:12]
+            self._item_labels[access_token] = item_id
+        return self._item_labels[access_token]
+
+    def _call(self, endpoint, request):
+        """
+        Make a single Plaid API call through self.client, first waiting for
+        the rate limiter. Rate limit errors, 5xx answers and network errors
+        (including timeouts) are retried with backoff, up to max_retries
+        times. Records call counts, errors, retries, throttling and latency
+        per endpoint and item.
+        """
+        item = self._item_label(request.access_token)
+        if self.cassette is not None and self.cassette.mode == 'replay':
+            return self._replay(endpoint, request, item)
+        recording = self.cassette is not None
+        attempt = 0
+        while True:
+            waited = self.limiter.acquire(item)
+            if waited:
+                PROFILER.count('api_throttled')
+                METRICS.inc('plaid2text_api_throttled_total', endpoint=endpoint, item=item)
+                METRICS.inc('plaid2text_api_throttle_seconds_total', waited, endpoint=endpoint, item=item)
+            start = time.perf_counter()
+            try:
+                if recording:
+                    raw = getattr(self.client, endpoint)(request, _request_timeout=self.timeout, _preload_content=False)
+                    response = self._deserialize(endpoint, raw.data)
+                    self.cassette.record(endpoint, request, raw.status, raw.data)
+                else:
+                    response = getattr(self.client, endpoint)(request, _request_timeout=self.timeout)
+            except plaid.ApiException as ex:
+                error = _error_response(ex)
+                METRICS.inc('plaid2text_api_errors_total', endpoint=endpoint, item=item, error_code=error['error_code'])
+                reason = _retry_reason(ex, error)
+                if reason == 'rate_limit':
+                    self.limiter.limited(item, client_wide=error.get('error_code') == 'RATE_LIMIT')
+                if reason is None or attempt >= self.max_retries:
+                    if recording:
+                        self.cassette.record(endpoint, request, ex.status, ex.body, ex.reason)
+                    raise
+                delay = max(backoff(attempt), _retry_after(ex))
+            except (urllib3.exceptions.HTTPError, OSError) as ex:
+                reason = 'timeout' if 'timeout' in type(ex).__name__.lower() or 'timed out' in str(ex) else 'network'
+                METRICS.inc('plaid2text_api_errors_total', endpoint=endpoint, item=item, error_code=reason)
+                if attempt >= self.max_retries:
+                    # Reported like any other failed call
+                    error = plaid.ApiException(status=0, reason='{0}: {1}'.format(type(ex).__name__, ex))
+                    if recording:
+                        self.cassette.record(endpoint, request, 0, None, error.reason)
+                    raise error from ex
+                delay = backoff(attempt)
+            else:
+                self.limiter.succeeded(item)
+                return response
+            finally:
+                METRICS.inc('plaid2text_api_calls_total', endpoint=endpoint, item=item)
+                METRICS.observe('plaid2text_api_latency_seconds', time.perf_counter() - start, endpoint=endpoint, item=item)
+            self.limiter.retried()
+            PROFILER.count('api_retries')
+            METRICS.inc('plaid2text_api_retries_total', endpoint=endpoint, item=item, reason=reason)
+            time.sleep(delay)
+            attempt += 1
+
+    def _deserialize(self, endpoint, body):
+        response_type = getattr(self.client, endpoint).settings['response_type']
+        return self.api_client.deserialize(_RecordedResponse(body), response_type, True)
+
+    def _replay(self, endpoint, request, item):
+        """Answer a call from the cassette, raising recorded errors again."""
+        entry = self.cassette.play(endpoint, request)
+        if entry is None:
+            print('No recorded {0} response for this request in {1}'.format(endpoint, self.cassette.path), file=sys.stderr)
+            sys.exit(1)
+        METRICS.inc('plaid2text_api_calls_total', endpoint=endpoint, item=item)
+        if not 200 <= entry['status'] <= 299:
+            ex = plaid.ApiException(status=entry['status'], reason=entry['reason'])
+            ex.body = entry['body']
+            raise ex
+        return self._deserialize(endpoint, entry['body'])
 
     def get_transactions(self,
                          access_token,
@@ -52,23 +182,19 @@ class PlaidAccess():
             end_date=end_date,
             options=options
         )
+        item = self._item_label(access_token)
         try:
-            response = self.client.transactions_get(request)
+            response = self._call('transactions_get', request)
         except plaid.ApiException as ex:
-            response = json.loads(ex.body)
+            response = _error_response(ex)
             if response['error_code'] == 'ITEM_LOGIN_REQUIRED':
-                try:
-                    cm.update_link_token(access_token)
-                except BaseException as e:
-                    if e.code == 0:
-                        sys.exit(0)
-                    print("Unable to update plaid account [%s] due to: " % account_ids, file=sys.stderr)
-                    print("    %s" % response['error_message'], file=sys.stderr )
-                    sys.exit(1)                        
-            else:
-                print("Unable to update plaid account [%s] due to: " % account_ids, file=sys.stderr)
-                print("    %s" % response['error_message'], file=sys.stderr )
-                sys.exit(1)        
+                # Writes a new link token for the browser login and exits:
+                # the download is run again once the login is done
+                cm.update_link_token(access_token)
+            print("Unable to update plaid account [%s] due to: " % account_ids, file=sys.stderr)
+            print("    %s" % response['error_message'], file=sys.stderr )
+            sys.exit(1)
+        METRICS.inc('plaid2text_download_pages_total', item=item)
         transactions = response['transactions']
         total_transactions = response['total_transactions']
         while len(transactions) < total_transactions:
@@ -81,149 +207,137 @@ class PlaidAccess():
             options=options
             )
             try:
-                response = self.client.transactions_get(request)
+                response = self._call('transactions_get', request)
             except plaid.ApiException as ex:
-                response = json.loads(ex.body)
+                response = _error_response(ex)
                 print("Unable to update plaid account [%s] due to: " % account_ids, file=sys.stderr)
                 print("    %s" % response['error_message'], file=sys.stderr )
                 sys.exit(1)
+            METRICS.inc('plaid2text_download_pages_total', item=item)
             transactions.extend(response['transactions'])
         print("Downloaded %d transactions for %s - %s" % ( len(transactions), start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")))
         return transactions
 
-    def sync_transactions(self, options):
-        # Get all account configs
-        accounts = cm.get_configured_accounts()
-        configs = []
-        for account in accounts:
+    def sync_transactions(self, options, access_tokens=None, interactive=True, storages=None):
+        """
+        Sync every configured item (or only those in access_tokens) into the
+        database. Each item is synced once, whatever number of accounts it
+        holds, and its cursor is kept in the database next to the rows.
+        Returns the number of new transactions saved.
+
+        With interactive False nothing prompts or exits: items syncing for the
+        first time fetch their whole history, and items that fail (e.g. need a
+        new login) are reported and skipped, keeping their cursor.
+        storages: dict of open storage managers by account, reused across calls
+        """
+        # Group the configured accounts by item (access token)
+        items = OrderedDict()
+        for account in cm.get_configured_accounts():
             config = cm.get_config(account)
-            config['account_name'] = account
-            configs.append(config)
-        # Retrieve unique access tokens (since each item has a unique access token)
-        items=[]
-        for config in configs:
-            if 'cursor' in config:
-                item = {'access_token': config['access_token'], 'cursor': config['cursor']}
-                items.append(item)
-            else:
-                item = {'access_token': config['access_token']}
-                items.append(item)
-        
-        items = list({tuple(sorted(d.items())): d for d in items}.values())  # deduplicating items
-
-        newTxns = []
-        for item in items:
-            if len(item) == 2:
-                request = TransactionsSyncRequest(
-                    access_token=item['access_token'],
-                    cursor=item['cursor']
-                )
-                startDate = None
+            item = items.setdefault(config['access_token'], {
+                'access_token': config['access_token'],
+                'item_id': config.get('item_id') or self._item_label(config['access_token']),
+                'accounts': OrderedDict(),
+                'config_cursor': None,
+            })
+            item['accounts'][config['account']] = account
+            # Cursors used to be kept in the config file; an empty one there
+            # still means "sync everything without asking for a start date"
+            if 'cursor' in config and not item['config_cursor']:
+                item['config_cursor'] = config['cursor']
+        if access_tokens is not None:
+            items = OrderedDict((k, v) for k, v in items.items() if k in access_tokens)
+        if storages is None:
+            storages = {}
+
+        stats = dict(self.limiter.stats)
+        saved = 0
+        for item in items.values():
+            saved += self._sync_item(options, item, interactive, storages)
+        if saved == 0:
+            print("Checked all accounts, no new transactions")
+        else:
+            print("Local database synced with bank data for all accounts")
+        retries = self.limiter.stats['retries'] - stats['retries']
+        throttled = self.limiter.stats['throttled'] - stats['throttled']
+        if retries or throttled:
+            print("Retried %d Plaid calls, waited %.1fs for the rate limit on %d calls" % (
+                retries, self.limiter.stats['throttle_seconds'] - stats['throttle_seconds'], throttled))
+        return saved
+
+    def _sync_item(self, options, item, interactive, storages):
+        """
+        Sync one item page by page, saving each page's rows together with
+        the cursor that follows it, so an interrupted sync resumes from the
+        last saved page.
+        """
+        access_token = item['access_token']
+        account = next(iter(item['accounts'].values()))
+        sm = storages.get(account)
+        if sm is None:
+            sm = storages[account] = storage_manager.open_storage(options, account)
+        first_cursor = cursor = sm.get_cursor(item['item_id']) or item['config_cursor']
 
+        startDate = None
+        if cursor is None and interactive:
+            account_name = ', '.join(item['accounts'].values())
+            startDateStr = prompt('This is the first time you are syncing with the institution containing ' + account_name + ' using these credentials.\nEnter the start date for transactions you wish to download in YYYY-MM-DD format.\nLeave blank if you want to download all transactions:\n')
+            if len(startDateStr) > 0:
+                startDate = datetime.datetime.strptime(startDateStr, '%Y-%m-%d').date()
+
+        item_label = self._item_label(access_token)
+        changes = OrderedDict((kind, 0) for kind in ('added', 'modified', 'removed'))
+        saved = OrderedDict()
+        pages = 0
+        restarts = 0
+        has_more = True
+        while has_more:
+            if cursor:
+                request = TransactionsSyncRequest(access_token=access_token, cursor=cursor)
             else:
-                request = TransactionsSyncRequest(
-                    access_token=item['access_token']
-                )
-                account_name = cm.get_account_in_item(item['access_token'])
-                startDateStr = prompt('This is the first time you are syncing with the institution containing ' + account_name + ' using these credentials.\nEnter the start date for transactions you wish to download in YYYY-MM-DD format.\nLeave blank if you want to download all transactions:\n')
-                if len(startDateStr) == 0:
-                    startDate = None
-                else:
-                    startDate = datetime.datetime.strptime(startDateStr, '%Y-%m-%d').date()
+                request = TransactionsSyncRequest(access_token=access_token)
             try:
-                response = self.client.transactions_sync(request)
+                response = self._call('transactions_sync', request)
             except plaid.ApiException as ex:
-                response = json.loads(ex.body)
+                response = _error_response(ex)
+                if response['error_code'] == 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION' and restarts < 3:
+                    # Plaid wants the whole loop restarted from its first
+                    # cursor; pages saved so far are simply upserted again
+                    restarts += 1
+                    cursor = first_cursor
+                    continue
+                if not interactive:
+                    print("Unable to sync plaid account [%s] due to: " % cm.get_account_in_item(access_token), file=sys.stderr)
+                    print("    %s" % response['error_message'], file=sys.stderr)
+                    break
                 if response['error_code'] == 'ITEM_LOGIN_REQUIRED':
-                    try:
-                        cm.update_link_token(item['access_token'])
-                    except BaseException as e:
-                        if e.code == 0:
-                            sys.exit(0)
-                        print("Unable to update plaid account [%s] due to: " % account_ids, file=sys.stderr)
-                        print("    %s" % response['error_message'], file=sys.stderr )
-                        sys.exit(1)                        
-                else:
-                    print("Unable to update plaid account [%s] due to: " % account_ids, file=sys.stderr)
-                    print("    %s" % response['error_message'], file=sys.stderr )
-                    sys.exit(1)
-
-            transactions = response['added']
-            while (response['has_more']):
-                request = TransactionsSyncRequest(
-                    access_token=item['access_token'],
-                    cursor=response['next_cursor']
-                )
-                response = self.client.transactions_sync(request)
-                transactions += response['added']
-
-        #Organize transactions by account
-            uniqueAccounts = []
-            for t in transactions:
-                if not t['account_id'] in uniqueAccounts:
-                    uniqueAccounts.append(t['account_id'])
-            for a in uniqueAccounts:
-                acTxns = []
-                for t in transactions:
-                    if t['account_id'] == a and t['pending'] == False:
-                        if startDate == None or t['date'] >= startDate:
-                            acTxns.append(t)
-                accountIncr = SyncResponse(a, acTxns, response['next_cursor'])
-                if len(accountIncr.transactions) > 0:
-                    newTxns.append(accountIncr)
-            item['cursor'] = response['next_cursor']
-            if not startDate == None:
-                pass
-        store_transactions(options, newTxns)
-        if len(newTxns) == 0:
-            print("Checked all accounts, no new transactions")
-        else:
-            print("Local database synced with bank data for all accounts")
-        for item in items:
-            for config in configs:
-                if config['access_token'] == item['access_token']:
-                    cm.update_cursor(config['account_name'], item['cursor'])
-        
-        sys.exit(0)
-
-def store_transactions (options, accounts):
-    for account in accounts:
-        if options.dbtype == 'mongodb':
-            sm = storage_manager.MongoDBStorage(
-                options.mongo_db,
-                options.mongo_db_uri,
-                account.plaid_account,
-                account.posting_account
-            )
-        else:
-            sm = storage_manager.SQLiteStorage(
-                options.sqlite_db,
-                account.plaid_account,
-                account.posting_account
-            )
-        print("New transactions in "+account.plaid_account+", saving to database now")
-        sm.save_transactions(account.transactions)
-
-class SyncResponse():
-    def __init__(self, account_id, acTxns, cursor):
-        self.account_id = account_id
-        self.transactions = acTxns
-        self.plaid_account = self.plaid_account_lookup()
-        self.posting_account = self.posting_account_lookup()
-        self.next_cursor = cursor
-    
-    def plaid_account_lookup(self):
-        accounts = cm.get_configured_accounts()
-        for account in accounts:
-            config = cm.get_config(account)
-            if config['account'] == self.account_id:
-                return account
-                break
+                    # Writes a new link token for the browser login and
+                    # exits: the sync is run again once the login is done
+                    cm.update_link_token(access_token)
+                print("Unable to update plaid account [%s] due to: " % cm.get_account_in_item(access_token), file=sys.stderr)
+                print("    %s" % response['error_message'], file=sys.stderr )
+                sys.exit(1)
+            pages += 1
+            for kind in changes:
+                changes[kind] += len(response[kind])
 
-    def posting_account_lookup(self):
-        accounts = cm.get_configured_accounts()
-        for account in accounts:
-            config = cm.get_config(account)
-            if config['account'] == self.account_id:
-                return config['posting_account']
-                break
+            # Organize transactions by account
+            by_account = OrderedDict()
+            for t in response['added']:
+                if t['pending'] or t['account_id'] not in item['accounts']:
+                    continue
+                if startDate == None or t['date'] >= startDate:
+                    by_account.setdefault(item['accounts'][t['account_id']], []).append(t)
+            cursor = response['next_cursor']
+            sm.save_sync(item['item_id'], cursor, by_account)
+            for name, transactions in by_account.items():
+                saved[name] = saved.get(name, 0) + len(transactions)
+            has_more = response['has_more']
+
+        METRICS.inc('plaid2text_sync_pages_total', pages, item=item_label)
+        for kind, n in changes.items():
+            METRICS.inc('plaid2text_sync_transactions_total', n, item=item_label, kind=kind)
+        METRICS.set('plaid2text_sync_cursor_lag_transactions', sum(changes.values()), item=item_label)
+        for name, n in saved.items():
+            print("Saved %d new transactions in %s" % (n, name))
+        return sum(saved.values())
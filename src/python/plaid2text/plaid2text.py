@@ -11,15 +11,20 @@ https://github.com/quentinsf/icsv2ledger
 """
 
 import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, date
 from operator import attrgetter
+import os
 import re
 import sys
+import time
 
-from plaid2text.renderers import LedgerRenderer, BeancountRenderer
+from plaid2text.renderers import LedgerRenderer, BeancountRenderer, RendererStartup, payload_fields, read_template
 import plaid2text.config_manager as cm
 import plaid2text.storage_manager as storage_manager
-from plaid2text.online_accounts import PlaidAccess
+from plaid2text.metrics import METRICS
+from plaid2text.profiler import PROFILER
 
 
 class FileType(object):
@@ -223,9 +228,9 @@ def _parse_args_and_config_file():
 
     parser.add_argument(
         '--dbtype',
-        choices=['mongodb', 'sqlite'],
+        choices=['mongodb', 'sqlite', 'segments'],
         help=(
-            'The type of database to use for storing transactions [mongodb | sqlite]'
+            'The type of database to use for storing transactions [mongodb | sqlite | segments]'
             ' (default: {0})'.format(cm.CONFIG_DEFAULTS.dbtype)
         )
     )
@@ -256,6 +261,25 @@ def _parse_args_and_config_file():
             ' (default: {0})'.format(cm.CONFIG_DEFAULTS.sqlite_db)
         )
     )
+
+    parser.add_argument(
+        '--segment-dir',
+        metavar='DIR',
+        help=(
+            'The directory of the append-only segment store, if --dbtype is segments'
+            ' (default: {0})'.format(cm.CONFIG_DEFAULTS.segment_dir)
+        )
+    )
+
+    parser.add_argument(
+        '--cold-archive',
+        action='store_true',
+        help=(
+            'store only the fields plaid2text renders and filters on in the'
+            ' database rows, and the full Plaid payloads compressed on the side'
+            ' (default: {0})'.format(cm.CONFIG_DEFAULTS.cold_archive)
+        )
+    )
     parser.add_argument(
         '--default-expense',
         metavar='STR',
@@ -287,7 +311,7 @@ def _parse_args_and_config_file():
         metavar='STR',
         help=(
             'the currency of amounts'
-            ' (default: {0})'.format(cm.CONFIG_DEFAULTS.currency)
+            ' (default: currency of the current locale)'
         )
     )
 
@@ -318,6 +342,67 @@ def _parse_args_and_config_file():
             ' (default: {0})'.format(cm.CONFIG_DEFAULTS.tags)
         )
     )
+    parser.add_argument(
+        '--checkpoint-every',
+        type=int,
+        metavar='N',
+        help=(
+            'write entries and mark them pulled every N transactions'
+            ' (default: {0})'.format(cm.CONFIG_DEFAULTS.checkpoint_every)
+        )
+    )
+    parser.add_argument(
+        '--group-prompts',
+        action='store_true',
+        help=(
+            'prompt once for all transactions with the same description,'
+            ' ignoring numbers, and apply the answer to each'
+            ' (default: {0})'.format(cm.CONFIG_DEFAULTS.group_prompts)
+        )
+    )
+    parser.add_argument(
+        '--group-by-amount',
+        action='store_true',
+        help=(
+            'like --group-prompts, but only group transactions of the same'
+            ' amount (default: {0})'.format(cm.CONFIG_DEFAULTS.group_by_amount)
+        )
+    )
+    parser.add_argument(
+        '--merge-into',
+        metavar='FILE',
+        help=(
+            'merge the new entries into the journal FILE in date order'
+            ' instead of writing them to the output file'
+        )
+    )
+    parser.add_argument(
+        '--skip-existing',
+        action='store_true',
+        help=(
+            'skip transactions whose id is already in the journal file'
+            ' or the files it includes'
+            ' (default: {0})'.format(cm.CONFIG_DEFAULTS.skip_existing)
+        )
+    )
+    parser.add_argument(
+        '--pair-transfers',
+        action='store_true',
+        help=(
+            'render transfers to and from the other configured accounts as one'
+            ' entry against their posting account, and mark the other side pulled'
+            ' (default: {0})'.format(cm.CONFIG_DEFAULTS.pair_transfers)
+        )
+    )
+    parser.add_argument(
+        '--transfer-window',
+        type=int,
+        metavar='DAYS',
+        help=(
+            'days the two sides of a transfer may be apart'
+            ' (default: {0})'.format(cm.CONFIG_DEFAULTS.transfer_window)
+        )
+    )
     parser.add_argument(
         '--clear-screen',
         '-C',
@@ -339,6 +424,16 @@ def _parse_args_and_config_file():
             ' (default: False)'
         )
     )
+    parser.add_argument(
+        '--no-suggestions',
+        action='store_true',
+        default=False,
+        help=(
+            'Do not default the payee and account of unmapped transactions '
+            'to the choices made for similar transactions already pulled'
+            ' (default: False)'
+        )
+    )
     parser.add_argument(
         '--pending-accounts',
         '-p',
@@ -378,6 +473,60 @@ def _parse_args_and_config_file():
         )
     )
 
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        default=False,
+        help=(
+            'print a per-stage wall/CPU time breakdown to stderr when done'
+            ' (default: False)'
+        )
+    )
+
+    parser.add_argument(
+        '--profile-output',
+        metavar='FILE',
+        help=(
+            'also write the profile to FILE, as JSON if FILE ends in .json, '
+            'otherwise as cProfile stats; implies --profile'
+        )
+    )
+
+    parser.add_argument(
+        '--metrics-file',
+        metavar='FILE',
+        help=(
+            'write run metrics to FILE in the Prometheus textfile-collector '
+            'format (FILE should end in .prom)'
+        )
+    )
+
+    parser.add_argument(
+        '--metrics-log',
+        metavar='FILE',
+        help=(
+            'append run metrics to FILE as one JSON object per line'
+        )
+    )
+
+    parser.add_argument(
+        '--record',
+        metavar='FILE',
+        help=(
+            'append every Plaid request and response of this run to the '
+            'cassette FILE'
+        )
+    )
+
+    parser.add_argument(
+        '--replay',
+        metavar='FILE',
+        help=(
+            'answer Plaid requests from the cassette FILE written by '
+            '--record instead of the network'
+        )
+    )
+
         # TODO NEED TO FIX - USING PARENTS causes file to be opened twice
     args = parser.parse_args()
 
@@ -413,11 +562,89 @@ def _parse_args_and_config_file():
     return args
 
 
+# Threads reading the journal and the mapping file while the database is queried
+STARTUP_WORKERS = 4
+
+# Subcommands have their own parsers and are dispatched on the first argument
+SUBCOMMANDS = {
+    'export': 'plaid2text.export',
+    'daemon': 'plaid2text.daemon',
+    'archive': 'plaid2text.archive',
+    'report': 'plaid2text.report',
+    'search': 'plaid2text.search',
+    'migrate': 'plaid2text.migrate',
+}
+
+
 def main():
     # Make sure we have config file
     if not cm.config_exists():
         return
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        import importlib
+        importlib.import_module(SUBCOMMANDS[sys.argv[1]]).main(sys.argv[2:])
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
     options = _parse_args_and_config_file()
+    METRICS.enabled = bool(options.metrics_file or options.metrics_log)
+    if options.profile_output:
+        options.profile = True
+    if options.profile:
+        cprofile = bool(options.profile_output) and not options.profile_output.endswith('.json')
+        PROFILER.enable(cprofile=cprofile)
+        PROFILER.add('config', time.perf_counter() - wall, time.process_time() - cpu)
+    success = False
+    try:
+        _run(options)
+        success = True
+    except SystemExit as e:
+        success = not e.code
+        raise
+    finally:
+        if options.profile:
+            PROFILER.report()
+            if options.profile_output:
+                PROFILER.dump(options.profile_output)
+        if METRICS.enabled:
+            _write_metrics(options, time.perf_counter() - wall, success)
+
+
+def _open_cassette(options):
+    """The Cassette asked for by --record or --replay, or None."""
+    if options.record and options.replay:
+        print('--record and --replay cannot be used together', file=sys.stderr)
+        sys.exit(1)
+    if not (options.record or options.replay):
+        return None
+    from plaid2text.cassette import Cassette
+    if options.record:
+        return Cassette(os.path.expanduser(options.record), 'record')
+    path = os.path.expanduser(options.replay)
+    if not os.path.isfile(path):
+        print('Cassette not found: {0}'.format(path), file=sys.stderr)
+        sys.exit(1)
+    return Cassette(path, 'replay')
+
+
+def _write_metrics(options, duration, success):
+    if options.sync_all_transactions:
+        command = 'sync'
+    elif options.pending_accounts:
+        command = 'pending'
+    elif options.download_transactions:
+        command = 'download'
+    else:
+        command = 'render'
+    METRICS.set('plaid2text_run_duration_seconds', duration, command=command)
+    METRICS.set('plaid2text_run_last_timestamp_seconds', time.time(), command=command)
+    METRICS.set('plaid2text_run_success', int(success), command=command)
+    if options.metrics_file:
+        METRICS.write_textfile(options.metrics_file)
+    if options.metrics_log:
+        METRICS.write_jsonl(options.metrics_log, command=command, account=options.plaid_account)
+
+
+def _run(options):
     truthy = ['true', 'yes', '1', 't']
     
     # Convert config values to Boolean if pulled from file
@@ -427,23 +654,19 @@ def main():
         options.tags = options.tags.lower() in truthy
     if not isinstance(options.clear_screen, bool):
         options.clear_screen = options.clear_screen.lower() in truthy
+    if not isinstance(options.skip_existing, bool):
+        options.skip_existing = options.skip_existing.lower() in truthy
+    if not isinstance(options.pair_transfers, bool):
+        options.pair_transfers = options.pair_transfers.lower() in truthy
+    if not isinstance(options.group_prompts, bool):
+        options.group_prompts = options.group_prompts.lower() in truthy
+    if not isinstance(options.group_by_amount, bool):
+        options.group_by_amount = options.group_by_amount.lower() in truthy
     if options.pending_accounts:
         accounts = cm.get_configured_accounts()
         pending = []
         for account in accounts:
-            if options.dbtype == 'mongodb':
-                sm = storage_manager.MongoDBStorage(
-                    options.mongo_db,
-                    options.mongo_db_uri,
-                    account,
-                    options.posting_account
-                )
-            else:
-                sm = storage_manager.SQLiteStorage(
-                    options.sqlite_db,
-                    options.plaid_account,
-                    options.posting_account
-                )
+            sm = storage_manager.open_storage(options, account, options.posting_account)
             include = sm.check_pending()
             if include:
                 pending.append(account)
@@ -457,31 +680,24 @@ def main():
                 sys.exit(0)
     
     if options.sync_all_transactions:
+        from plaid2text.online_accounts import PlaidAccess
         print('Syncing all accounts...')
-        PlaidAccess().sync_transactions(options)
+        PlaidAccess(cassette=_open_cassette(options)).sync_transactions(options)
+        sys.exit(0)
 
     if options.plaid_account == None:
         raise BaseException("You must provide an account unless using '-p' or '-s'")
 
-    if options.dbtype == 'mongodb':
-        sm = storage_manager.MongoDBStorage(
-            options.mongo_db,
-            options.mongo_db_uri,
-            options.plaid_account,
-            options.posting_account
-        )
-    else:
-        sm = storage_manager.SQLiteStorage(
-            options.sqlite_db,
-            options.plaid_account,
-            options.posting_account
-        )
+    with PROFILER.stage('db_open'):
+        sm = storage_manager.open_storage(options, options.plaid_account, options.posting_account)
     if options.download_transactions:
         if options.to_date==None or options.from_date==None:
             print('When downloading, both start and end date are required', file=sys.stderr)
             sys.exit(1)
 
-        trans = PlaidAccess().get_transactions(options.access_token, start_date=options.from_date, end_date=options.to_date,account_ids=options.account)
+        from plaid2text.online_accounts import PlaidAccess
+        with PROFILER.stage('download'):
+            trans = PlaidAccess(cassette=_open_cassette(options)).get_transactions(options.access_token, start_date=options.from_date, end_date=options.to_date,account_ids=options.account)
         sm.save_transactions(trans)
         print('Transactions successfully downloaded and saved into %s' % options.dbtype, file=sys.stdout)
         sys.exit(0)
@@ -490,25 +706,154 @@ def main():
         print('Configuration file is required.', file=sys.stderr)
         sys.exit(1)
     print("Processing "+options.plaid_account)
+    if not options.currency:
+        options.currency = cm.get_locale_currency_symbol()
     to_date = options.to_date
     from_date = options.from_date
     only_new = not options.all_transactions
 
-    trxs = sm.get_transactions(to_date=to_date,
-                            from_date=from_date,
-                            only_new=only_new)
-
     if options.output_format == 'beancount':
-        out = BeancountRenderer(trxs, options)
+        renderer_class = BeancountRenderer
     else:
-        out = LedgerRenderer(trxs, options)
+        renderer_class = LedgerRenderer
+
+    # The mapping file, the journal vocabulary (ledger or beancount runs) and
+    # the journal ids are read on the pool while this thread does the
+    # database work, which stays here with the connection
+    executor = ThreadPoolExecutor(max_workers=STARTUP_WORKERS, thread_name_prefix='startup')
+    startup = RendererStartup(renderer_class, options, executor)
+    existing_ids = None
+    if options.skip_existing and options.journal_file:
+        existing_ids = executor.submit(_journal_ids, options.journal_file)
 
-    callback = lambda txns: sm.update_transaction(txns, mark_pulled=not options.no_mark_pulled)
+    trxs = sm.get_transactions(to_date=to_date,
+                            from_date=from_date,
+                            only_new=only_new,
+                            fields=payload_fields(read_template(options)))
+
+    from plaid2text.session import Session
+    session = Session(options.plaid_account)
+    resume = False
+    if session.read():
+        if options.quiet or not sys.stdin.isatty():
+            # Nobody to ask: keep the decisions already made
+            resume = True
+            print('Resuming an interrupted session with {0} decisions'.format(len(session.decisions)),
+                  file=sys.stderr)
+        else:
+            from plaid2text.interact import prompt, YesNoValidator
+            try:
+                answer = prompt(
+                    'Found an interrupted session with {0} decisions. Resume it [Y/n]: '.format(
+                        len(session.decisions)),
+                    validator=YesNoValidator()
+                ).lower()
+                resume = not answer or answer.startswith('y')
+            except (EOFError, KeyboardInterrupt):
+                resume = False
+    session.start(resume)
+
+    suggestions = None
+    if not options.no_suggestions:
+        from plaid2text.suggestions import SuggestionIndex
+        with PROFILER.stage('suggest_index'):
+            suggestions = SuggestionIndex.from_history(sm.iter_history())
+        PROFILER.count('history_rows', suggestions.size)
+
+    transfers = None
+    counterpart_storage = {}
+    if options.pair_transfers:
+        with PROFILER.stage('pair_transfers'):
+            transfers, counterpart_storage = _find_transfers(options, sm, trxs)
+        PROFILER.count('transfers', len(transfers))
+
+    merge_into = None
+    if options.merge_into:
+        from plaid2text.journal_merge import pending_path
+        merge_into = os.path.expanduser(options.merge_into)
+        # Entries are kept next to the journal until they are merged; the
+        # journal has its headers already
+        options.outfile = open(pending_path(merge_into, options.plaid_account), mode='a', encoding='utf-8')
+        options.headers_file = None
+
+    if existing_ids is not None:
+        with PROFILER.stage('startup_wait'):
+            existing_ids = existing_ids.result()
+        PROFILER.count('journal_ids', len(existing_ids))
+    out = renderer_class(trxs, options, suggestions, existing_ids, session, transfers, startup=startup)
+    executor.shutdown()
+
+    def callback(txns):
+        # The other sides of transfers are marked pulled in their own account
+        by_storage = OrderedDict([(sm, [])])
+        for txn in txns:
+            by_storage.setdefault(counterpart_storage.get(txn['transaction_id'], sm), []).append(txn)
+        for storage, group in by_storage.items():
+            if group:
+                storage.update_transaction(group, mark_pulled=not options.no_mark_pulled)
 
     try:
         update_dict = out.process_transactions(callback=callback)
     except (KeyboardInterrupt, EOFError):
-        print("\nProcess interrupted by keyboard interrupt.");
+        print("\nProcess interrupted by keyboard interrupt. "
+              "Run again to resume where you stopped.")
+    finally:
+        if merge_into:
+            from plaid2text.journal_merge import merge_pending
+            options.outfile.close()
+            merged = merge_pending(merge_into, options.plaid_account)
+            print('Merged {0} entries into {1}'.format(merged, merge_into), file=sys.stderr)
+
+
+def _journal_ids(journal_file):
+    from plaid2text.journal_index import journal_ids
+    with PROFILER.stage('journal_ids'):
+        return journal_ids(journal_file)
+
+
+def _find_transfers(options, sm, trxs):
+    """
+    Pair the transactions of the account being rendered with opposite ones
+    in the other configured accounts. Returns the transfers, by
+    transaction_id, and the storage of each transaction on the other side.
+    """
+    from plaid2text.transfers import find_transfers
+    window = int(options.transfer_window)
+    accounts = OrderedDict()
+    for account in cm.get_configured_accounts():
+        config = cm.get_config(account)
+        if config.get('account'):
+            accounts[config['account']] = (account, config.get('posting_account'))
+
+    candidates = OrderedDict((t['transaction_id'], t) for t in trxs)
+    storages = {}
+    for account_id, (account, _) in accounts.items():
+        if account == options.plaid_account:
+            continue
+        if options.dbtype == 'sqlite':
+            # SQLite keeps every account in one table: trxs has them all
+            storages[account_id] = sm
+            continue
+        storages[account_id] = storage_manager.open_storage(options, account)
+        # The other side may be dated a few days outside the range
+        from_date = options.from_date - timedelta(days=window) if options.from_date else None
+        to_date = options.to_date + timedelta(days=window) if options.to_date else None
+        for t in storages[account_id].get_transactions(from_date=from_date, to_date=to_date,
+                                                       only_new=not options.all_transactions):
+            candidates.setdefault(t['transaction_id'], t)
+
+    transfers = OrderedDict()
+    counterpart_storage = {}
+    pairs = find_transfers(candidates.values(), accounts, window)
+    for t in trxs:
+        transfer = pairs.get(t['transaction_id'])
+        if transfer is None or t['account_id'] != options.account:
+            continue
+        transfers[t['transaction_id']] = transfer
+        other = transfer.counterpart
+        counterpart_storage[other['transaction_id']] = storages[other['account_id']]
+    return transfers, counterpart_storage
+
 
 if __name__ == '__main__':
     main()
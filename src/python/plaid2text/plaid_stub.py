@@ -0,0 +1,462 @@
+#! /usr/bin/env python3
+
+"""
+A local stand-in for the parts of the Plaid API used by plaid2text.
+
+Serves deterministic synthetic data for /transactions/sync,
+/transactions/get, /accounts/get and /link/token/create (plus
+/item/public_token/exchange so --create-account can be walked through),
+with configurable latency, page sizes and error injection. Point plaid2text
+at it by adding `host = http://127.0.0.1:<port>` to the PLAID section of the
+config file.
+
+With --webhook-url it also posts transaction webhooks there, as Plaid does:
+/sandbox/item/fire_webhook adds a new transaction to every account of the
+item and posts SYNC_UPDATES_AVAILABLE (or the given webhook_code), and
+--webhook-interval does the same for a random item periodically.
+
+Run with: python -m plaid2text.plaid_stub --port 8765
+"""
+
+import argparse
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import sys
+import threading
+import time
+import urllib.request
+
+
+CATEGORIES = [
+    (['Food and Drink', 'Restaurants'], '13005000'),
+    (['Shops', 'Supermarkets and Groceries'], '19047000'),
+    (['Travel', 'Public Transportation Services'], '22014000'),
+    (['Service', 'Utilities'], '18068000'),
+    (['Transfer', 'Debit'], '21006000'),
+]
+
+MERCHANTS = [
+    'Starbucks', 'Whole Foods', 'Metro Transit', 'City Power', 'Netflix',
+    'Amazon', 'Shell', 'Uber', 'Target', 'Costco',
+]
+
+
+class StubPlaidData():
+    """
+    Deterministic synthetic Plaid items, accounts and transactions.
+
+    Every item has `accounts_per_item` accounts holding
+    `transactions_per_account` transactions each, spread one per day
+    backwards from `end_date`. The same seed always yields the same data.
+    """
+    def __init__(self,
+                 items=1,
+                 accounts_per_item=1,
+                 transactions_per_account=500,
+                 end_date=None,
+                 seed=0):
+        self.end_date = end_date or datetime.date(2023, 1, 1)
+        self.items = {}
+        for i in range(items):
+            access_token = 'access-stub-{}'.format(i)
+            accounts = ['acct-{}-{}'.format(i, j) for j in range(accounts_per_item)]
+            rng = random.Random('{}:{}'.format(seed, i))
+            transactions = []
+            for account_id in accounts:
+                for n in range(transactions_per_account):
+                    transactions.append(self._transaction(rng, account_id, n))
+            transactions.sort(key=lambda t: (t['date'], t['transaction_id']))
+            self.items[access_token] = {
+                'item_id': 'item-stub-{}'.format(i),
+                'accounts': accounts,
+                'transactions': transactions,
+            }
+
+    def _transaction(self, rng, account_id, n):
+        category, category_id = rng.choice(CATEGORIES)
+        merchant = rng.choice(MERCHANTS)
+        d8 = (self.end_date - datetime.timedelta(days=n)).isoformat()
+        return {
+            'account_id': account_id,
+            'account_owner': None,
+            'amount': round(rng.uniform(-500, 500), 2),
+            'authorized_date': d8,
+            'authorized_datetime': None,
+            'category': category,
+            'category_id': category_id,
+            'check_number': None,
+            'date': d8,
+            'datetime': None,
+            'iso_currency_code': 'USD',
+            'location': {
+                'address': None, 'city': None, 'country': None, 'lat': None,
+                'lon': None, 'postal_code': None, 'region': None,
+                'store_number': None,
+            },
+            'merchant_name': merchant,
+            'name': '{} #{}'.format(merchant.upper(), rng.randint(100, 999)),
+            'payment_channel': 'in store',
+            'payment_meta': {
+                'by_order_of': None, 'payee': None, 'payer': None,
+                'payment_method': None, 'payment_processor': None,
+                'ppd_id': None, 'reason': None, 'reference_number': None,
+            },
+            'pending': False,
+            'pending_transaction_id': None,
+            'transaction_code': None,
+            'transaction_id': '{}-txn-{:08d}'.format(account_id, n),
+            'transaction_type': 'place',
+            'unofficial_currency_code': None,
+        }
+
+    def item(self, access_token):
+        return self.items.get(access_token)
+
+    def add_transactions(self, access_token, rng):
+        """Append one transaction, dated after the others, to every account of the item."""
+        item = self.items[access_token]
+        added = []
+        for account_id in item['accounts']:
+            n = sum(1 for t in item['transactions'] if t['account_id'] == account_id)
+            t = self._transaction(rng, account_id, n)
+            t['date'] = t['authorized_date'] = (self.end_date + datetime.timedelta(days=n)).isoformat()
+            added.append(t)
+        item['transactions'].extend(added)
+        return added
+
+    def account(self, account_id):
+        return {
+            'account_id': account_id,
+            'balances': {
+                'available': 100.0, 'current': 110.0, 'limit': None,
+                'iso_currency_code': 'USD', 'unofficial_currency_code': None,
+            },
+            'mask': account_id[-4:],
+            'name': 'Stub account {}'.format(account_id),
+            'official_name': None,
+            'subtype': 'checking',
+            'type': 'depository',
+        }
+
+    def item_meta(self, item):
+        return {
+            'item_id': item['item_id'],
+            'webhook': None,
+            'error': None,
+            'available_products': [],
+            'billed_products': ['transactions'],
+            'consent_expiration_time': None,
+            'update_type': 'background',
+        }
+
+
+def webhook_payload(item_id, webhook_code='SYNC_UPDATES_AVAILABLE', new_transactions=1):
+    payload = {
+        'webhook_type': 'TRANSACTIONS',
+        'webhook_code': webhook_code,
+        'item_id': item_id,
+        'environment': 'sandbox',
+    }
+    if webhook_code == 'SYNC_UPDATES_AVAILABLE':
+        payload['initial_update_complete'] = True
+        payload['historical_update_complete'] = True
+    else:
+        payload['new_transactions'] = new_transactions
+    return payload
+
+
+def post_webhook(url, payload, timeout=10):
+    """POST a webhook payload to url and return the response status."""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status
+
+
+class PlaidError(Exception):
+    def __init__(self, status, error_type, error_code, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.body = {
+            'error_type': error_type,
+            'error_code': error_code,
+            'error_message': message,
+            'display_message': None,
+        }
+
+
+class StubPlaidServer(ThreadingHTTPServer):
+    """
+    HTTP server holding the stub data, the knobs and the request counters.
+
+    latency: seconds slept before answering every request
+    page_size: maximum transactions per sync/get page
+    login_error_rate, rate_limit_rate: fraction of requests answered with
+        ITEM_LOGIN_REQUIRED and RATE_LIMIT_EXCEEDED errors respectively
+    """
+    daemon_threads = True
+
+    def __init__(self,
+                 address,
+                 data,
+                 latency=0.0,
+                 page_size=100,
+                 login_error_rate=0.0,
+                 rate_limit_rate=0.0,
+                 seed=0,
+                 quiet=True,
+                 webhook_url=None):
+        ThreadingHTTPServer.__init__(self, address, StubPlaidHandler)
+        self.webhook_url = webhook_url
+        self.data = data
+        self.latency = latency
+        self.page_size = page_size
+        self.login_error_rate = login_error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.quiet = quiet
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'transactions_served': 0}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def inject_error(self):
+        with self.lock:
+            roll = self.rng.random()
+        if roll < self.rate_limit_rate:
+            raise PlaidError(429, 'RATE_LIMIT_EXCEEDED', 'TRANSACTIONS_LIMIT',
+                             'rate limit exceeded for stub item')
+        if roll < self.rate_limit_rate + self.login_error_rate:
+            raise PlaidError(400, 'ITEM_ERROR', 'ITEM_LOGIN_REQUIRED',
+                             'the login details of this item have changed')
+
+    def get_item(self, body):
+        item = self.data.item(body.get('access_token'))
+        if item is None:
+            raise PlaidError(400, 'INVALID_INPUT', 'INVALID_ACCESS_TOKEN',
+                             'provided access token is in an invalid format')
+        return item
+
+    def transactions_sync(self, body):
+        item = self.get_item(body)
+        cursor = body.get('cursor') or ''
+        offset = int(cursor[1:]) if cursor.startswith('c') else 0
+        count = min(int(body.get('count') or 100), self.page_size)
+        page = item['transactions'][offset:offset + count]
+        next_offset = offset + len(page)
+        self.count('transactions_served', len(page))
+        return {
+            'added': page,
+            'modified': [],
+            'removed': [],
+            'next_cursor': 'c{}'.format(next_offset),
+            'has_more': next_offset < len(item['transactions']),
+        }
+
+    def transactions_get(self, body):
+        item = self.get_item(body)
+        options = body.get('options') or {}
+        start = body['start_date']
+        end = body['end_date']
+        account_ids = options.get('account_ids')
+        matching = [
+            t for t in item['transactions']
+            if start <= t['date'] <= end
+            and (not account_ids or t['account_id'] in account_ids)
+        ]
+        matching.reverse()  # Plaid returns newest first
+        offset = int(options.get('offset') or 0)
+        count = min(int(options.get('count') or 100), self.page_size)
+        page = matching[offset:offset + count]
+        self.count('transactions_served', len(page))
+        return {
+            'accounts': [self.data.account(a) for a in item['accounts']],
+            'transactions': page,
+            'total_transactions': len(matching),
+            'item': self.data.item_meta(item),
+        }
+
+    def accounts_get(self, body):
+        item = self.get_item(body)
+        return {
+            'accounts': [self.data.account(a) for a in item['accounts']],
+            'item': self.data.item_meta(item),
+        }
+
+    def link_token_create(self, body):
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=4)
+        return {
+            'link_token': 'link-stub-{}'.format(self.rng.randint(0, 10 ** 9)),
+            'expiration': expiration.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+
+    def fire_webhook(self, access_token, webhook_code='SYNC_UPDATES_AVAILABLE'):
+        """Add new transactions to the item and post a webhook about them."""
+        with self.lock:
+            added = self.data.add_transactions(access_token, self.rng)
+        item = self.data.item(access_token)
+        self.count('webhooks')
+        if self.webhook_url:
+            payload = webhook_payload(item['item_id'], webhook_code, len(added))
+            # Posted from another thread, like Plaid does after answering
+            threading.Thread(target=self._post_webhook, args=(payload,), daemon=True).start()
+
+    def _post_webhook(self, payload):
+        try:
+            post_webhook(self.webhook_url, payload)
+        except OSError as e:
+            self.count('webhook_errors')
+            if not self.quiet:
+                print('webhook to %s failed: %s' % (self.webhook_url, e), file=sys.stderr)
+
+    def sandbox_item_fire_webhook(self, body):
+        self.get_item(body)
+        self.fire_webhook(body['access_token'], body.get('webhook_code') or 'SYNC_UPDATES_AVAILABLE')
+        return {'webhook_fired': True}
+
+    def item_public_token_exchange(self, body):
+        access_token = sorted(self.data.items)[0]
+        return {
+            'access_token': access_token,
+            'item_id': self.data.items[access_token]['item_id'],
+        }
+
+
+ROUTES = {
+    '/transactions/sync': StubPlaidServer.transactions_sync,
+    '/transactions/get': StubPlaidServer.transactions_get,
+    '/accounts/get': StubPlaidServer.accounts_get,
+    '/link/token/create': StubPlaidServer.link_token_create,
+    '/item/public_token/exchange': StubPlaidServer.item_public_token_exchange,
+    '/sandbox/item/fire_webhook': StubPlaidServer.sandbox_item_fire_webhook,
+}
+
+
+class StubPlaidHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        server.count('requests')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        route = ROUTES.get(self.path)
+        if server.latency:
+            time.sleep(server.latency)
+        request_id = 'stub-{}'.format(server.stats['requests'])
+        try:
+            if route is None:
+                raise PlaidError(404, 'INVALID_REQUEST', 'UNKNOWN_ENDPOINT',
+                                 'unknown endpoint {}'.format(self.path))
+            if route not in (StubPlaidServer.link_token_create, StubPlaidServer.sandbox_item_fire_webhook):
+                server.inject_error()
+            status, payload = 200, route(server, body)
+        except PlaidError as e:
+            server.count('errors')
+            status, payload = e.status, e.body
+        payload['request_id'] = request_id
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def start_server(data, host='127.0.0.1', port=0, **kwargs):
+    """
+    Start a StubPlaidServer on a background thread and return it.
+    Port 0 picks a free port; see `server.url`.
+    """
+    server = StubPlaidServer((host, port), data, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def add_stub_arguments(parser):
+    parser.add_argument('--items', type=int, default=1,
+                        help='number of Plaid items (default: 1)')
+    parser.add_argument('--accounts-per-item', type=int, default=1,
+                        help='accounts per item (default: 1)')
+    parser.add_argument('--transactions', type=int, default=500,
+                        help='transactions per account (default: 500)')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='maximum transactions per page (default: 100)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds of latency per request (default: 0)')
+    parser.add_argument('--login-error-rate', type=float, default=0.0,
+                        help='fraction of requests failing with ITEM_LOGIN_REQUIRED')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                        help='fraction of requests failing with RATE_LIMIT_EXCEEDED')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for data and error injection (default: 0)')
+    parser.add_argument('--webhook-url',
+                        help='post transaction webhooks to this URL')
+
+
+def server_from_args(args, host='127.0.0.1', port=0, quiet=True):
+    data = StubPlaidData(
+        items=args.items,
+        accounts_per_item=args.accounts_per_item,
+        transactions_per_account=args.transactions,
+        seed=args.seed
+    )
+    return start_server(
+        data,
+        host=host,
+        port=port,
+        latency=args.latency,
+        page_size=args.page_size,
+        login_error_rate=args.login_error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        seed=args.seed,
+        quiet=quiet,
+        webhook_url=args.webhook_url
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='plaid_stub', description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--webhook-interval', type=float, default=0.0,
+                        help='fire a webhook for a random item every this many seconds (default: off)')
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    server = server_from_args(args, host=args.host, port=args.port, quiet=False)
+    print('Plaid stand-in listening on %s' % server.url, file=sys.stderr)
+    for access_token, item in sorted(server.data.items.items()):
+        print('  %s  %s  %s' % (item['item_id'], access_token, ' '.join(item['accounts'])),
+              file=sys.stderr)
+    try:
+        if args.webhook_interval:
+            tokens = sorted(server.data.items)
+            while True:
+                time.sleep(args.webhook_interval)
+                server.fire_webhook(server.rng.choice(tokens))
+        else:
+            threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
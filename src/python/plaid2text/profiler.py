@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+
+"""
+Per-stage wall/CPU timing used by the --profile option.
+
+The module level PROFILER is disabled by default, in which case `stage()`
+and `count()` do next to nothing, so instrumented code pays no real cost on
+normal runs.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import sys
+import threading
+import time
+
+
+class Profiler():
+    def __init__(self):
+        self.enabled = False
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.lock = threading.Lock()
+        self._cprofile = None
+
+    def enable(self, cprofile=False):
+        self.enabled = True
+        if cprofile:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def add(self, name, wall, cpu, calls=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+            stage['calls'] += calls
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block and add it to the named stage."""
+        if not self.enabled:
+            yield
+            return
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self, file=sys.stderr):
+        if not self.enabled:
+            return
+        print('\nProfile (stages in order of first use):', file=file)
+        print('  {:<16} {:>10} {:>10} {:>8}'.format('stage', 'wall (s)', 'cpu (s)', 'calls'), file=file)
+        for name, s in self.stages.items():
+            print('  {:<16} {:>10.4f} {:>10.4f} {:>8}'.format(name, s['wall'], s['cpu'], s['calls']), file=file)
+        if self.counters:
+            print('  ' + ', '.join('{}={}'.format(k, v) for k, v in self.counters.items()), file=file)
+
+    def dump(self, path):
+        """
+        Write the report to path: JSON if path ends with .json, otherwise
+        cProfile stats readable with pstats/snakeviz.
+        """
+        if path.endswith('.json'):
+            with open(path, mode='w', encoding='utf-8') as f:
+                json.dump({'stages': self.stages, 'counters': self.counters}, f, indent=2)
+        elif self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(path)
+
+
+PROFILER = Profiler()
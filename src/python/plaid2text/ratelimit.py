@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+
+"""
+Client side rate limiting and retry backoff for Plaid API calls.
+
+Plaid limits requests both per client (our client_id) and per item. Every
+call first takes a token from the client's bucket and from the bucket of its
+item, sleeping until both have one. The buckets adapt: a RATE_LIMIT_EXCEEDED
+answer halves the rate of the bucket it concerns, and each successful call
+gives a little of it back, up to the configured rate.
+
+Limiters are shared by client_id (get_limiter), so every PlaidAccess of a
+process, in any thread, draws from the same buckets.
+"""
+
+import random
+import threading
+import time
+
+
+class TokenBucket():
+    """
+    A token bucket refilled at `rate` tokens per second, holding at most
+    `burst`. Thread safe.
+    """
+    def __init__(self, rate, burst):
+        self.max_rate = self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return the seconds to wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 64, self.rate / 2)
+            # Whatever burst was left is what got us limited
+            self.tokens = min(self.tokens, 0)
+
+    def speed_up(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 32)
+
+
+class RateLimiter():
+    """
+    One bucket for the client and one per item.
+
+    client_rate, item_rate: requests per minute; each bucket holds up to ten
+    seconds' worth of requests (at least one).
+    """
+    def __init__(self, client_rate, item_rate):
+        self.item_rate = item_rate / 60.0
+        self.client = TokenBucket(client_rate / 60.0, max(1.0, client_rate / 6.0))
+        self.items = {}
+        self.lock = threading.Lock()
+        self.stats = {'throttled': 0, 'throttle_seconds': 0.0, 'retries': 0}
+
+    def _bucket(self, item):
+        with self.lock:
+            bucket = self.items.get(item)
+            if bucket is None:
+                bucket = self.items[item] = TokenBucket(self.item_rate, max(1.0, self.item_rate * 10))
+            return bucket
+
+    def acquire(self, item):
+        """
+        Block until a call for item may be made. Returns the seconds waited.
+        """
+        wait = max(self.client.reserve(), self._bucket(item).reserve())
+        if wait > 0:
+            with self.lock:
+                self.stats['throttled'] += 1
+                self.stats['throttle_seconds'] += wait
+            time.sleep(wait)
+        return wait
+
+    def limited(self, item, client_wide=False):
+        """Plaid answered RATE_LIMIT_EXCEEDED for item (or the whole client)."""
+        (self.client if client_wide else self._bucket(item)).slow_down()
+
+    def succeeded(self, item):
+        self.client.speed_up()
+        self._bucket(item).speed_up()
+
+    def retried(self):
+        with self.lock:
+            self.stats['retries'] += 1
+
+
+def backoff(attempt, base=0.5, cap=30.0):
+    """
+    Seconds to wait before retry number `attempt` (from 0): exponential
+    backoff with full jitter, so clients limited together do not retry
+    together.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(client_id, client_rate, item_rate):
+    """The process wide limiter of client_id, created on first use."""
+    with _limiters_lock:
+        limiter = _limiters.get(client_id)
+        if limiter is None:
+            limiter = _limiters[client_id] = RateLimiter(client_rate, item_rate)
+        return limiter
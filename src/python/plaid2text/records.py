@@ -0,0 +1,180 @@
+#! /usr/bin/env python3
+
+"""
+Compact transaction records passed from the storage managers to the renderers.
+
+A TransactionRecord keeps only the fields rendering needs. Anything else a
+template asks for is read from the full Plaid payload, which is fetched from
+the backend on first use and then cached on the record.
+"""
+
+import datetime
+import functools
+import re
+import string
+
+
+# The first name of a format field, and the .attr and [key] parts after it
+FIELD_NAME_RE = re.compile(r'[^.[]*')
+FIELD_PART_RE = re.compile(r'\.([^.[]*)|\[([^\]]*)\]')
+
+
+RECORD_FIELDS = (
+    'transaction_id',
+    'account_id',
+    'date',
+    'name',
+    'merchant_name',
+    'amount',
+    'iso_currency_code',
+    'pending',
+    'plaid2text',
+)
+
+
+def to_date(value):
+    """Decode a stored date (date, datetime or ISO string) into a date."""
+    if value is None or type(value) is datetime.date:
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return datetime.date.fromisoformat(value[:10])
+
+
+@functools.lru_cache(maxsize=32)
+def template_fields(template):
+    """
+    The top level field names a format template references, e.g.
+    '{location[city]} {amount:>10}' gives frozenset({'location', 'amount'}).
+    """
+    fields = set()
+    for _, field_name, format_spec, _ in string.Formatter().parse(template):
+        if field_name:
+            fields.add(field_name.split('.')[0].split('[')[0])
+        if format_spec and '{' in format_spec:
+            fields.update(template_fields(format_spec))
+    return frozenset(fields)
+
+
+def _field_paths(template):
+    for _, field_name, format_spec, _ in string.Formatter().parse(template):
+        if field_name:
+            first = FIELD_NAME_RE.match(field_name).group()
+            path = [first]
+            for part in FIELD_PART_RE.finditer(field_name, len(first)):
+                key = part.group(2)
+                if key is None:
+                    # An attribute of a value, not a payload field
+                    break
+                # An array index: project the key below it in every element
+                if key.isdigit():
+                    continue
+                path.append(key)
+            yield '.'.join(path)
+        if format_spec and '{' in format_spec:
+            yield from _field_paths(format_spec)
+
+
+@functools.lru_cache(maxsize=32)
+def payload_paths(template, exclude=frozenset()):
+    """
+    The dotted payload paths a format template reads, leaving out fields
+    whose top level name is in exclude, e.g. '{location[city]} {amount}'
+    with exclude=RECORD_FIELDS gives ('location.city',). A path covered by
+    a shorter one is dropped, as MongoDB rejects overlapping projections.
+    """
+    paths = []
+    for path in sorted(set(_field_paths(template))):
+        if path.split('.')[0] in exclude:
+            continue
+        if paths and path.startswith(paths[-1] + '.'):
+            continue
+        paths.append(path)
+    return tuple(paths)
+
+
+class TransactionRecord():
+    """
+    Parameters:
+    loader: called with the transaction_id to fetch the full Plaid payload
+            the first time a field outside RECORD_FIELDS is looked up
+    extra: additional fields already fetched along with the record
+    """
+    __slots__ = RECORD_FIELDS + ('extra', 'loader', '_raw')
+
+    def __init__(self,
+                 transaction_id,
+                 account_id,
+                 date,
+                 name,
+                 merchant_name=None,
+                 amount=0.0,
+                 iso_currency_code=None,
+                 pending=False,
+                 plaid2text=None,
+                 extra=None,
+                 loader=None,
+                 raw=None):
+        self.transaction_id = transaction_id
+        self.account_id = account_id
+        self.date = to_date(date)
+        self.name = name
+        self.merchant_name = merchant_name
+        self.amount = amount
+        self.iso_currency_code = iso_currency_code
+        self.pending = bool(pending)
+        self.plaid2text = plaid2text
+        self.extra = extra
+        self.loader = loader
+        self._raw = raw
+
+    @classmethod
+    def from_dict(cls, t, loader=None):
+        """Build a record from a (possibly projected) Plaid transaction dict."""
+        extra = {k: v for k, v in t.items() if k not in RECORD_FIELDS and k != '_id'}
+        return cls(
+            t['transaction_id'],
+            t.get('account_id'),
+            t['date'],
+            t.get('name'),
+            t.get('merchant_name'),
+            t.get('amount'),
+            t.get('iso_currency_code'),
+            t.get('pending'),
+            t.get('plaid2text'),
+            extra=extra or None,
+            loader=loader
+        )
+
+    @property
+    def raw(self):
+        """The full Plaid payload, loaded on first access."""
+        if self._raw is None:
+            if self.loader is None:
+                raise KeyError('no payload loader for transaction %s' % self.transaction_id)
+            self._raw = self.loader(self.transaction_id)
+        return self._raw
+
+    def __getitem__(self, key):
+        if key in RECORD_FIELDS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        return self.raw[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return 'TransactionRecord(%r, %s, %r, %r)' % (
+            self.transaction_id, self.date, self.name, self.amount)
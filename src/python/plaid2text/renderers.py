@@ -1,14 +1,97 @@
 #! /usr/bin/env python3
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future
 import csv
+import functools
+import io
 import os
 import re
+import stat
 import subprocess
 import sys
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import plaid2text.config_manager as cm
-from plaid2text.interact import separator_completer, prompt
+from plaid2text.metrics import METRICS
+from plaid2text.profiler import PROFILER
+from plaid2text.records import RECORD_FIELDS, payload_paths, template_fields, to_date
+from plaid2text.suggestions import tokenize
+
+
+# Fields Entry provides to templates on top of the Plaid ones
+ENTRY_FIELDS = frozenset((
+    'associated_account',
+    'payee',
+    'tags',
+    'negAmount',
+    'negamount',
+    'transaction_date',
+    'currency',
+    'posting_account',
+    'cleared_character',
+))
+
+
+def read_template(options):
+    """
+    The transaction template: the contents of the template file if one is
+    configured, otherwise the default for the output format.
+    """
+    if options.template_file:
+        with open(options.template_file, 'r', encoding='utf-8') as f:
+            template = f.read()
+        if template:
+            return template
+    if options.output_format == 'ledger':
+        return cm.DEFAULT_LEDGER_TEMPLATE
+    return cm.DEFAULT_BEANCOUNT_TEMPLATE
+
+
+def payload_fields(template):
+    """
+    The Plaid fields to fetch with each transaction on top of RECORD_FIELDS:
+    those the template reads. Mapping rules and suggestions only look at the
+    name and merchant name, which records always carry.
+    """
+    return payload_paths(template, frozenset(RECORD_FIELDS) | ENTRY_FIELDS)
+
+
+def group_key(transaction, by_amount=False):
+    """
+    The bucket of a transaction for --group-prompts: its description without
+    case, punctuation and tokens without letters (dates, store and
+    reference numbers), and with by_amount also its amount in cents.
+    """
+    key = tokenize(transaction['name']) or (transaction['name'],)
+    if by_amount:
+        key += (round(transaction['amount'] * 100),)
+    return key
+
+
+def group_pattern(descriptions):
+    """
+    A mapping file pattern matching every one of descriptions: the
+    description itself if they are all the same, otherwise a regex of the
+    words of the first, in order. None if that regex does not match them
+    all.
+    """
+    descriptions = set(descriptions)
+    if len(descriptions) == 1:
+        return descriptions.pop()
+    tokens = tokenize(next(iter(descriptions)))
+    if not tokens:
+        return None
+    pattern = ''.join(r'.*?\b{0}\b'.format(re.escape(t)) for t in tokens)
+    regex = re.compile(pattern, re.I)
+    if all(regex.match(d) for d in descriptions):
+        return '/{0}/'.format(pattern)
+    return None
 
 
 class Entry:
@@ -16,48 +99,42 @@ class Entry:
     This represents one entry (transaction) from Plaid.
     """
 
-    def __init__(self, transaction, options={}):
+    def __init__(self, transaction, options={}, template=None):
         """Parameters:
-        transaction: a plaid transaction
+        transaction: a TransactionRecord (or a plaid transaction dict)
 
         options: from CLI args and config file
+
+        template: the transaction template, read with read_template(options)
+                  when not given
         """
         self.options = options
 
         self.transaction = transaction
         # TODO: document this
         if 'addons' in options:
-            self.transaction['addons'] = dict(
+            self.addons = dict(
                 (k, fields[v - 1]) for k, v in options.addons.items()  # NOQA
             )
         else:
-            self.transaction['addons'] = {}
-
-        # The id for the transaction
-        self.transaction['transaction_id'] = self.transaction['transaction_id']
+            self.addons = {}
 
         # Get the date and convert it into a ledger/beancount formatted date.
-        d8 = self.transaction['date']
+        d8 = to_date(self.transaction['date'])
         d8_format = options.output_date_format if options and 'output_date_format' in options else '%Y-%m-%d'
-        self.transaction['transaction_date'] = d8.date().strftime(d8_format)
 
         self.desc = self.transaction['name']
 
-        # amnt = self.transaction['amount']
-        self.transaction['currency'] = options.currency
-        # self.transaction['debit_amount'] = amnt
-        # self.transaction['debit_currency'] = currency
-        # self.transaction['credit_amount'] = ''
-        # self.transaction['credit_currency'] = ''
-
-        self.transaction['posting_account'] = options.posting_account
-        self.transaction['cleared_character'] = options.cleared_character
+        # Fields plaid2text provides to templates on top of the Plaid ones.
+        # These are kept here rather than written into the transaction.
+        self.fields = {
+            'transaction_date': d8.strftime(d8_format),
+            'currency': options.currency,
+            'posting_account': options.posting_account,
+            'cleared_character': options.cleared_character,
+        }
 
-        if options.template_file:
-            with open(options.template_file, 'r', encoding='utf-8') as f:
-                self.transaction['transaction_template'] = f.read()
-        else:
-            self.transaction['transaction_template'] = ''
+        self.template = template if template is not None else read_template(options)
 
     def query(self):
         """
@@ -75,46 +152,145 @@ class Entry:
         Return a formatted journal entry recording this Entry against
         the specified posting account
         """
-        if self.options.output_format == 'ledger':
-            def_template = cm.DEFAULT_LEDGER_TEMPLATE
-        else:
-            def_template = cm.DEFAULT_BEANCOUNT_TEMPLATE
-        if self.transaction['transaction_template']:
-            template = (self.transaction['transaction_template'])
-        else:
-            template = (def_template)
         if self.options.output_format == 'beancount':
             ret_tags = ' {}'.format(tags) if tags else ''
         else:
             ret_tags = ' ; {}'.format(tags) if tags else ''
 
+        neg_amount = self.transaction['amount'] * -1
         format_data = {
             'associated_account': account,
             'payee': payee,
             'tags': ret_tags,
-            'negAmount': self.transaction['amount'] *-1
+            'negAmount': neg_amount,
+            'negamount': neg_amount,
         }
-        format_data.update(self.transaction['addons'])
-        format_data.update(self.transaction)
-        return template.format(**format_data)
+        format_data.update(self.addons)
+        format_data.update(self.fields)
+        # Only look up the Plaid fields the template uses, so the full
+        # payload is loaded only for templates that reach beyond the record.
+        for field in template_fields(self.template):
+            if field not in format_data:
+                format_data[field] = self.transaction[field]
+        return self.template.format(**format_data)
+
+
+def read_mappings(map_file):
+    """
+    Mappings are simply a CSV file with three columns.
+    The first is a string to be matched against an entry description.
+    The second is the payee against which such entries should be posted.
+    The third is the account against which such entries should be posted.
+
+    If the match string begins and ends with '/' it is taken to be a
+    regular expression.
+
+    Returns the (pattern, payee, account, tags) rules, regexes compiled.
+    """
+    mappings = []
+    if not map_file:
+        return mappings
+
+    with open(map_file, 'r', encoding='utf-8', newline='') as f:
+        map_reader = csv.reader(f)
+        for row in map_reader:
+            if len(row) > 1:
+                pattern = row[0].strip()
+                payee = row[1].strip()
+                account = row[2].strip()
+                tags = row[3:]
+                if pattern.startswith('/') and pattern.endswith('/'):
+                    try:
+                        pattern = re.compile(pattern[1:-1], re.I)
+                    except re.error as e:
+                        print(
+                            "Invalid regex '{0}' in '{1}': {2}"
+                            .format(pattern, map_file, e),
+                            file=sys.stderr)
+                        sys.exit(1)
+                mappings.append((pattern, payee, account, tags))
+    return mappings
+
+
+def _starts_empty(f):
+    """
+    Whether the output f was emptied when it was opened: a regular file not
+    opened for appending.
+    """
+    try:
+        st = os.fstat(f.fileno())
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+    if not stat.S_ISREG(st.st_mode) or 'a' in getattr(f, 'mode', ''):
+        return False
+    if fcntl:
+        return not fcntl.fcntl(f.fileno(), fcntl.F_GETFL) & os.O_APPEND
+    return True
+
+
+def _timed(stage, fn, *args):
+    with PROFILER.stage(stage):
+        return fn(*args)
+
+
+def _start(executor, fn, *args):
+    """fn(*args) submitted to executor, or run now if there is none."""
+    if executor:
+        return executor.submit(fn, *args)
+    future = Future()
+    future.set_result(fn(*args))
+    return future
+
+
+class RendererStartup():
+    """
+    The reads a renderer needs before its first prompt: the mapping rules
+    and the journal vocabulary. Given an executor they run on it, alongside
+    each other and the caller's database work, and the renderer waits for
+    them when it is built.
+    """
+    def __init__(self, renderer_class, options, executor=None):
+        self.mappings = _start(executor, _timed, 'mapping_load', read_mappings, options.mapping_file)
+        self.vocabulary = [
+            _start(executor, _timed, 'journal_load', loader)
+            for loader in renderer_class.vocabulary_loaders(options)
+        ]
 
 
 class OutputRenderer(metaclass=ABCMeta):
     """
     Base class for output rendering.
     """
-    def __init__(self, transactions, options):
+    def __init__(self, transactions, options, suggestions=None, existing_ids=None, session=None,
+                 transfers=None, startup=None):
         self.transactions = transactions
+        self.suggestions = suggestions
+        self.existing_ids = existing_ids or set()
+        self.session = session
+        self.transfers = transfers or {}
+        # --group-prompts: group key by transaction_id, members by group key
+        # and the answer given for each group
+        self.group_of = {}
+        self.groups = OrderedDict()
+        self.group_answers = {}
         self.possible_accounts = set([])
         self.possible_payees = set([])
         self.possible_tags = set([])
-        self.mappings = []
         self.map_file = options.mapping_file
-        self.read_mapping_file()
+        # Reads started early by the caller, or done now
+        startup = startup or RendererStartup(type(self), options)
+        with PROFILER.stage('startup_wait'):
+            self.mappings = startup.mappings.result()
+            for vocabulary in startup.vocabulary:
+                vocabulary = vocabulary.result()
+                self.possible_payees.update(vocabulary.get('payees', ()))
+                self.possible_accounts.update(vocabulary.get('accounts', ()))
+                self.possible_tags.update(vocabulary.get('tags', ()))
+        PROFILER.count('mapping_rules', len(self.mappings))
         self.journal_file = options.journal_file
         self.journal_lines = []
         self.options = options
-        self.get_possible_accounts_and_payees()
+        self.template = read_template(options)
         # Add payees/accounts/tags from mappings
         for m in self.mappings:
             self.possible_payees.add(m[1])
@@ -125,44 +301,26 @@ class OutputRenderer(metaclass=ABCMeta):
                 else:
                     self.possible_tags.update([t.replace('#', '') for t in m[3][0].split(' ')])
 
-    def read_mapping_file(self):
+    @classmethod
+    @abstractmethod
+    def vocabulary_loaders(cls, options):
         """
-        Mappings are simply a CSV file with three columns.
-        The first is a string to be matched against an entry description.
-        The second is the payee against which such entries should be posted.
-        The third is the account against which such entries should be posted.
-
-        If the match string begins and ends with '/' it is taken to be a
-        regular expression.
+        Functions reading the payees, accounts and tags the journal already
+        uses, each returning a dict of some of those sets. They do not depend
+        on each other, so RendererStartup can run them at the same time.
         """
-        if not self.map_file:
-            return
-
-        with open(self.map_file, 'r', encoding='utf-8', newline='') as f:
-            map_reader = csv.reader(f)
-            for row in map_reader:
-                if len(row) > 1:
-                    pattern = row[0].strip()
-                    payee = row[1].strip()
-                    account = row[2].strip()
-                    tags = row[3:]
-                    if pattern.startswith('/') and pattern.endswith('/'):
-                        try:
-                            pattern = re.compile(pattern[1:-1], re.I)
-                        except re.error as e:
-                            print(
-                                "Invalid regex '{0}' in '{1}': {2}"
-                                .format(pattern, self.map_file, e),
-                                file=sys.stderr)
-                            sys.exit(1)
-                    self.mappings.append((pattern, payee, account, tags))
+        pass
 
     def append_mapping_file(self, desc, payee, account, tags):
         if self.map_file:
-            with open(self.map_file, 'a', encoding='utf-8', newline='') as f:
-                writer = csv.writer(f)
-                ret_tags = tags if len(tags) > 0 else ''
-                writer.writerow([desc, payee, account, ret_tags])
+            ret_tags = tags if len(tags) > 0 else ''
+            row = io.StringIO()
+            csv.writer(row).writerow([desc, payee, account, ret_tags])
+            # One locked, single write per row: concurrent runs appending to
+            # a shared mapping file never interleave partial rows.
+            with cm.file_lock(self.map_file):
+                with open(self.map_file, 'a', encoding='utf-8', newline='') as f:
+                    f.write(row.getvalue())
 
     def process_transactions(self, callback=None):
         """
@@ -174,45 +332,168 @@ class OutputRenderer(metaclass=ABCMeta):
         callback: A function taking a single transaction update object to store
                   in the DB immediately after collecting the information from the user.
         """
+        if self.options.headers_file:
+            with PROFILER.stage('output_write'):
+                headers = ''.join(open(self.options.headers_file, mode='r').readlines())
+                self._write(headers + '\n')
+        start = time.perf_counter()
         out = self._process_plaid_transactions(callback=callback)
+        elapsed = time.perf_counter() - start
+        METRICS.observe('plaid2text_render_seconds', elapsed, account=self.options.plaid_account)
+        METRICS.inc('plaid2text_render_transactions_total', len(out), account=self.options.plaid_account)
+        if elapsed > 0:
+            METRICS.set('plaid2text_render_transactions_per_second', len(out) / elapsed,
+                        account=self.options.plaid_account)
+        return out
 
-        if self.options.headers_file:
-            headers = ''.join(open(self.options.headers_file, mode='r').readlines())
-            print(headers, file=self.options.outfile)
-        print(*self.journal_lines, sep='\n', file=self.options.outfile)
-        return out 
+    def _write(self, text):
+        self.options.outfile.write(text)
+        self.options.outfile.flush()
+        if PROFILER.enabled:
+            PROFILER.count('bytes_written', len(text.encode('utf-8')))
+
+    def _flush(self, lines, updates, callback, written=None):
+        """
+        Write a batch of entries to the output, then mark them pulled. Output
+        comes first so a transaction is never marked pulled without its entry
+        having been written. The session notes which of its decisions the
+        written entries came from.
+        """
+        if lines:
+            with PROFILER.stage('output_write'):
+                self._write(''.join(line + '\n' for line in lines))
+        if self.session and written:
+            self.session.flushed(written)
+            del written[:]
+        if callback and updates:
+            with PROFILER.stage('mark_pulled'):
+                callback(updates)
+        del lines[:]
+        del updates[:]
 
     def _process_plaid_transactions(self, callback=None):
         """Process plaid transaction and return beancount/ledger formatted
         lines.
+
+        Entries are written and marked pulled every checkpoint_every
+        transactions, and when the session is interrupted, so the decisions
+        made so far are kept. With a session, decisions it already holds are
+        reused instead of prompting again.
         """
+        batch_size = max(int(self.options.checkpoint_every or 0), 1)
+        decisions = self.session.decisions if self.session else {}
+        transactions = list(self.transactions)
+        ids = set(t['transaction_id'] for t in transactions)
+        # The other sides of transfers are rendered with their own side. They
+        # can be among the transactions too (SQLite reads every account) and
+        # sort before it; if the transfer is not taken they stay pending
+        paired = set(transfer.counterpart['transaction_id'] for transfer in self.transfers.values())
+        if self.options.group_prompts or self.options.group_by_amount:
+            for t in transactions:
+                if (t['transaction_id'] in self.existing_ids or t['transaction_id'] in self.transfers
+                        or t['transaction_id'] in paired):
+                    continue
+                key = group_key(t, self.options.group_by_amount)
+                self.group_of[t['transaction_id']] = key
+                self.groups.setdefault(key, []).append(t)
         out = []
-        for t in self.transactions:
-            entry = Entry(t, self.options)
-            payee, account, tags = self.get_payee_and_account(entry)
-            dic = {}
-            dic['transaction_id'] = t['transaction_id']
-            dic['tags'] = tags
-            dic['payee'] = payee
-            dic['posting_account'] = self.options.posting_account
-            dic['associated_account'] = account
-            dic['date_downloaded'] = t['plaid2text']['date_downloaded']
-            dic['date_last_pulled'] = t['plaid2text']['date_last_pulled']
-            out.append(dic)
-
-            self.journal_lines.append(entry.journal_entry(payee, account, tags))
-        # update database all at once. Previously transactions were updated one by one but 
-        # if the process was interrupted, txns prior to the interrupt would be marked as pulled 
-        # without ever having their output sent to the outfile.
-        if callback: callback(out)
+        lines = []
+        updates = []
+        written = []
+        # Entries a resumed session already wrote are written again only when
+        # the output starts empty (not when appending to the merge pending
+        # file or to stdout redirected with >>); entries it decided but did
+        # not write yet are written now
+        replay = _starts_empty(self.options.outfile)
+        for d in decisions.values():
+            if d['transaction_id'] in self.existing_ids:
+                continue
+            if d.get('flushed'):
+                if replay:
+                    self.journal_lines.append(d['text'])
+                    lines.append(d['text'])
+            elif d['transaction_id'] not in ids:
+                self.journal_lines.append(d['text'])
+                lines.append(d['text'])
+                written.append(d['transaction_id'])
+        completed = False
+        try:
+            for t in transactions:
+                if t['transaction_id'] in self.existing_ids:
+                    PROFILER.count('skipped_existing')
+                    if not self.options.no_mark_pulled:
+                        # Already in the journal: marked pulled so later runs
+                        # do not read it again
+                        updates.append({'transaction_id': t['transaction_id']})
+                    continue
+                if t['transaction_id'] in paired:
+                    # The other side of a transfer
+                    continue
+                entry = Entry(t, self.options, self.template)
+                d = decisions.get(t['transaction_id'])
+                if d:
+                    payee, account, tags = d['payee'], d['account'], d['tags']
+                    PROFILER.count('resumed')
+                else:
+                    payee, account, tags = self.get_payee_and_account(entry)
+                dic = {}
+                dic['transaction_id'] = t['transaction_id']
+                dic['tags'] = tags
+                dic['payee'] = payee
+                dic['posting_account'] = self.options.posting_account
+                dic['associated_account'] = account
+                dic['date_downloaded'] = t['plaid2text']['date_downloaded']
+                dic['date_last_pulled'] = t['plaid2text']['date_last_pulled']
+                out.append(dic)
+                updates.append(dict(dic))
+                transfer = self.transfers.get(t['transaction_id'])
+                if transfer and account == transfer.posting_account:
+                    # One balanced entry covers both sides: the other side
+                    # is marked pulled with it
+                    other = transfer.counterpart
+                    updates.append({
+                        'transaction_id': other['transaction_id'],
+                        'tags': tags,
+                        'payee': payee,
+                        'posting_account': transfer.posting_account,
+                        'associated_account': self.options.posting_account,
+                        'date_downloaded': other['plaid2text']['date_downloaded'],
+                        'date_last_pulled': other['plaid2text']['date_last_pulled'],
+                    })
+                    PROFILER.count('transfers_paired')
+
+                # The entry of a flushed decision is in the output already,
+                # only marking it pulled is left
+                if not (d and d.get('flushed')):
+                    with PROFILER.stage('render'):
+                        text = entry.journal_entry(payee, account, tags)
+                    self.journal_lines.append(text)
+                    lines.append(text)
+                    if self.session:
+                        if not d:
+                            self.session.record(t['transaction_id'], payee, account, tags, text)
+                        written.append(t['transaction_id'])
+                if len(updates) >= batch_size:
+                    self._flush(lines, updates, callback, written)
+            completed = True
+        finally:
+            # Also runs on KeyboardInterrupt, keeping the finished decisions
+            self._flush(lines, updates, callback, written)
+            if self.session:
+                if completed:
+                    self.session.finish()
+                else:
+                    self.session.close()
         return out
 
     def prompt_for_value(self, text_prompt, values, default):
+        from plaid2text.interact import separator_completer, prompt
         sep = ':' if text_prompt == 'Payee' else ' '
-        a = prompt(
-            '{} [{}]: '.format(text_prompt, default),
-            completer=separator_completer(values, sep=sep)
-        )
+        with PROFILER.stage('prompt'):
+            a = prompt(
+                '{} [{}]: '.format(text_prompt, default),
+                completer=separator_completer(values, sep=sep)
+            )
         # Handle tag returning none if accepting
         return a if (a or text_prompt == 'Tag') else default
 
@@ -221,18 +502,48 @@ class OutputRenderer(metaclass=ABCMeta):
         account = self.options.default_expense
         tags = ''
         found = False
+        transfer = self.transfers.get(entry.transaction['transaction_id'])
+        if transfer:
+            # A transfer is posted against the other account, and never
+            # becomes a mapping: the same description may move money to
+            # different accounts
+            account = transfer.posting_account
+            if self.options.quiet:
+                return (payee, account, tags)
+            if self.options.clear_screen:
+                print('\033[2J\033[;H')
+            print('\n' + entry.query())
+            print('Transfer with {0}'.format(transfer.account))
+            payee = self.prompt_for_value('Payee', self.possible_payees, payee)
+            account = self.prompt_for_value('Account', self.possible_accounts, account)
+            if self.options.tags:
+                tags = self.prompt_for_tags('Tag', self.possible_tags, tags) or tags
+            return (payee, account, tags)
+        key = self.group_of.get(entry.transaction['transaction_id'])
+        if key in self.group_answers:
+            PROFILER.count('grouped')
+            return self.group_answers[key]
+        group = self.groups.get(key, ())
         # Try to match entry desc with mappings patterns
-        for m in self.mappings:
-            pattern = m[0]
-            if isinstance(pattern, str):
-                if entry.desc == pattern:
-                    payee, account, tags = m[1], m[2], m[3]
-                    found = True  # do not break here, later mapping must win
-            else:
-                # If the pattern isn't a string it's a regex
-                if m[0].match(entry.desc):
-                    payee, account, tags = m[1], m[2], m[3]
-                    found = True
+        with PROFILER.stage('mapping_match'):
+            for m in self.mappings:
+                pattern = m[0]
+                if isinstance(pattern, str):
+                    if entry.desc == pattern:
+                        payee, account, tags = m[1], m[2], m[3]
+                        found = True  # do not break here, later mapping must win
+                else:
+                    # If the pattern isn't a string it's a regex
+                    if m[0].match(entry.desc):
+                        payee, account, tags = m[1], m[2], m[3]
+                        found = True
+        PROFILER.count('rules_evaluated', len(self.mappings))
+        if not found and self.suggestions:
+            # Default to what was chosen for similar transactions before
+            with PROFILER.stage('suggest'):
+                suggestion = self.suggestions.suggest(entry.desc, entry.transaction.get('merchant_name'))
+            if suggestion:
+                payee, account = suggestion
         # Tags gets read in as a list, but just contains one string
         if tags:
             tags = tags[0]
@@ -244,6 +555,8 @@ class OutputRenderer(metaclass=ABCMeta):
             if self.options.clear_screen:
                 print('\033[2J\033[;H')
             print('\n' + entry.query())
+            if len(group) > 1:
+                print(self.group_summary(group))
 
             value = self.prompt_for_value('Payee', self.possible_payees, payee)
             if value:
@@ -260,11 +573,23 @@ class OutputRenderer(metaclass=ABCMeta):
                 if value:
                     modified = modified if modified else value != tags
                     tags = value
+            if group:
+                # The answer holds for the whole group
+                self.group_answers[key] = (payee, account, tags)
 
         if not found or (found and modified):
-            # Add new or changed mapping to mappings and append to file
-            self.mappings.append((entry.desc, payee, account, tags))
-            self.append_mapping_file(entry.desc, payee, account, tags)
+            # Add new or changed mapping to mappings and append to file; one
+            # row covers a group
+            pattern = group_pattern(t['name'] for t in group) if group else None
+            if pattern and pattern.startswith('/'):
+                self.mappings.append((re.compile(pattern[1:-1], re.I), payee, account, tags))
+            else:
+                pattern = entry.desc
+                self.mappings.append((pattern, payee, account, tags))
+            self.append_mapping_file(pattern, payee, account, tags)
+
+            if self.suggestions:
+                self.suggestions.learn(entry.desc, entry.transaction.get('merchant_name'), payee, account)
 
             # Add new possible_values to possible values lists
             self.possible_payees.add(payee)
@@ -272,12 +597,15 @@ class OutputRenderer(metaclass=ABCMeta):
 
         return (payee, account, tags)
 
-    @abstractmethod
-    def tagify(self, value):
-        pass
+    def group_summary(self, group):
+        """One line describing the group the prompt answers for."""
+        dates = sorted(to_date(t['date']) for t in group)
+        total = sum(t['amount'] for t in group)
+        return '  and {0} more like it from {1} to {2}, {3:.2f} in total'.format(
+            len(group) - 1, dates[0], dates[-1], total)
 
     @abstractmethod
-    def get_possible_accounts_and_payees(self):
+    def tagify(self, value):
         pass
 
     @abstractmethod
@@ -285,17 +613,92 @@ class OutputRenderer(metaclass=ABCMeta):
         pass
 
 
+def _from_ledger(journal_file, command):
+    ledger = 'ledger'
+    for f in ['/usr/bin/ledger', '/usr/local/bin/ledger']:
+        if os.path.exists(f):
+            ledger = f
+            break
+
+    cmd = [ledger, '-f', journal_file, command]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (stdout_data, stderr_data) = p.communicate()
+    items = set()
+    for item in stdout_data.decode('utf-8').splitlines():
+        items.add(item)
+    return items
+
+
+def _ledger_vocabulary(journal_file, command):
+    """{command: the output of `ledger payees` or `ledger accounts`}"""
+    return {command: _from_ledger(journal_file, command)}
+
+
+def read_accounts_file(accounts_file):
+    """ Process each line in the specified account file looking for account
+        definitions. An account definition is a line containing the word
+        'account' followed by a valid account name, e.g:
+
+            account Expenses
+            account Expenses:Utilities
+
+        All other lines are ignored.
+    """
+    accounts = []
+    pattern = re.compile('^\s*account\s+([:A-Za-z0-9-_ ]+)$')
+    with open(accounts_file, 'r', encoding='utf-8') as f:
+        for line in f.readlines():
+            mo = pattern.match(line)
+            if mo:
+                accounts.append(mo.group(1))
+    return {'accounts': set(accounts)}
+
+
+def _beancount_vocabulary(journal_file):
+    try:
+        payees = set()
+        accounts = set()
+        tags = set()
+        from beancount import loader
+        from beancount.core.data import Transaction, Open
+        entries, errors, options = loader.load_file(journal_file)
+
+    except Exception as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    else:
+        for e in entries:
+            if type(e) is Transaction:
+                if e.payee:
+                    payees.add(e.payee)
+                if e.tags:
+                    for t in e.tags:
+                        tags.add(t)
+                if e.postings:
+                    for p in e.postings:
+                        accounts.add(p.account)
+            elif type(e) is Open:
+                accounts.add(e.account)
+
+    return {'payees': payees, 'accounts': accounts, 'tags': tags}
+
+
 class LedgerRenderer(OutputRenderer):
     def tagify(self, value):
         if value.find(':') < 0 and value[0] != '[' and value[-1] != ']':
             value = ':{0}:'.format(value.replace(' ', '-').replace(',', ''))
             return value
 
-    def get_possible_accounts_and_payees(self):
-        if self.journal_file:
-            self.possible_payees = self._payees_from_ledger()
-            self.possible_accounts = self._accounts_from_ledger()
-        self.read_accounts_file()
+    @classmethod
+    def vocabulary_loaders(cls, options):
+        loaders = []
+        if options.journal_file:
+            # Two ledger runs, which can go in parallel
+            loaders.append(functools.partial(_ledger_vocabulary, options.journal_file, 'payees'))
+            loaders.append(functools.partial(_ledger_vocabulary, options.journal_file, 'accounts'))
+        if options.accounts_file:
+            loaders.append(functools.partial(read_accounts_file, options.accounts_file))
+        return loaders
 
     def prompt_for_tags(self, prompt, values, default):
         # tags = list(default[0].split(':'))
@@ -313,91 +716,17 @@ class LedgerRenderer(OutputRenderer):
             value = self.prompt_for_value(prompt, values, ''.join(tags).replace('::', ':'))
         return ''.join(tags).replace('::', ':')
 
-    def _payees_from_ledger(self):
-        return self._from_ledger('payees')
-
-    def _accounts_from_ledger(self):
-        return self._from_ledger('accounts')
-
-    def _from_ledger(self, command):
-        ledger = 'ledger'
-        for f in ['/usr/bin/ledger', '/usr/local/bin/ledger']:
-            if os.path.exists(f):
-                ledger = f
-                break
-
-        cmd = [ledger, '-f', self.journal_file, command]
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (stdout_data, stderr_data) = p.communicate()
-        items = set()
-        for item in stdout_data.decode('utf-8').splitlines():
-            items.add(item)
-        return items
-
-    def read_accounts_file(self):
-        """ Process each line in the specified account file looking for account
-            definitions. An account definition is a line containing the word
-            'account' followed by a valid account name, e.g:
-
-                account Expenses
-                account Expenses:Utilities
-
-            All other lines are ignored.
-        """
-        if not self.options.accounts_file:
-            return
-        accounts = []
-        pattern = re.compile('^\s*account\s+([:A-Za-z0-9-_ ]+)$')
-        with open(self.options.accounts_file, 'r', encoding='utf-8') as f:
-            for line in f.readlines():
-                mo = pattern.match(line)
-                if mo:
-                    accounts.append(mo.group(1))
-
-        self.possible_accounts.update(accounts)
-
 
 class BeancountRenderer(OutputRenderer):
-    import beancount
-
     def tagify(self, value):
         # No spaces or commas allowed
         return value.replace(' ', '-').replace(',', '')
 
-    def get_possible_accounts_and_payees(self):
-        if self.journal_file:
-            self._payees_and_accounts_from_beancount()
-
-    def _payees_and_accounts_from_beancount(self):
-        try:
-            payees = set()
-            accounts = set()
-            tags = set()
-            from beancount import loader
-            from beancount.core.data import Transaction, Open
-            import sys
-            entries, errors, options = loader.load_file(self.journal_file)
-
-        except Exception as e:
-            print(e.message, file=sys.stderr)
-            sys.exit(1)
-        else:
-            for e in entries:
-                if type(e) is Transaction:
-                    if e.payee:
-                        payees.add(e.payee)
-                    if e.tags:
-                        for t in e.tags:
-                            tags.add(t)
-                    if e.postings:
-                        for p in e.postings:
-                            accounts.add(p.account)
-                elif type(e) is Open:
-                    accounts.add(e.account)
-
-        self.possible_accounts.update(accounts)
-        self.possible_tags.update(tags)
-        self.possible_payees.update(payees)
+    @classmethod
+    def vocabulary_loaders(cls, options):
+        if options.journal_file:
+            return [functools.partial(_beancount_vocabulary, options.journal_file)]
+        return []
 
     def prompt_for_tags(self, prompt, values, default):
         tags = ' '.join(['#{}'.format(t) for t in default.split() if t]) if default else []
@@ -0,0 +1,161 @@
+#! /usr/bin/env python3
+
+"""
+Summaries of stored transactions, computed by the database.
+
+Counts and totals transactions grouped by month, account, item, category
+(Plaid's personal finance category, or its legacy category) and/or the
+associated account assigned when they were pulled, and always by currency.
+The grouping runs in the backend: a pre-aggregated table kept current by
+triggers for SQLite, an aggregation pipeline for MongoDB, an index scan for
+the segment store. Totals are sums of Plaid amounts: positive for money
+leaving the account.
+
+  plaid2text report --by month --by category --from 2024-01
+  plaid2text report --by account --only-new --format json
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import sys
+
+import plaid2text.config_manager as cm
+from plaid2text.profiler import PROFILER
+import plaid2text.storage_manager as storage_manager
+
+
+# --by choice: aggregate() dimension it is computed from
+DIMENSIONS = {
+    'month': 'month',
+    'account': 'account_id',
+    'item': 'account_id',
+    'category': 'category',
+    'associated_account': 'associated_account',
+}
+
+
+def _month(value):
+    try:
+        return '{0:%Y-%m}'.format(datetime.datetime.strptime(value, '%Y-%m'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a YYYY-MM month: {0}'.format(value))
+
+
+def _parse_args(argv):
+    defaults = cm.get_defaults()
+    parser = argparse.ArgumentParser(
+        prog='plaid2text report',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '--by',
+        action='append',
+        choices=sorted(DIMENSIONS),
+        help='group by this; may be repeated (default: --by month --by account)'
+    )
+    parser.add_argument(
+        '--account',
+        dest='accounts',
+        action='append',
+        metavar='NICKNAME',
+        help='only report this account; may be repeated (default: every configured account)'
+    )
+    parser.add_argument('--from', dest='from_month', type=_month, metavar='YYYY-MM',
+                        help='first month to report')
+    parser.add_argument('--to', dest='to_month', type=_month, metavar='YYYY-MM',
+                        help='last month to report')
+    parser.add_argument(
+        '--only-new',
+        action='store_true',
+        help='only count transactions not pulled to file yet'
+    )
+    parser.add_argument(
+        '--format',
+        choices=['csv', 'json'],
+        default='csv',
+        help='output format (default: csv)'
+    )
+    parser.add_argument(
+        '--output',
+        metavar='FILE',
+        help='write the report to FILE (default: stdout)'
+    )
+    storage_manager.add_storage_arguments(parser, defaults)
+    parser.add_argument('--profile', action='store_true', help='print a per-stage timing breakdown')
+    return parser.parse_args(argv)
+
+
+def _write(rows, columns, fmt, out):
+    if fmt == 'json':
+        json.dump(rows, out, indent=2)
+        out.write('\n')
+        return
+    writer = csv.DictWriter(out, fieldnames=columns, lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main(argv):
+    options = _parse_args(argv)
+    if options.profile:
+        PROFILER.enable()
+    by = options.by or ['month', 'account']
+    group_by = []
+    for b in by:
+        if DIMENSIONS[b] not in group_by:
+            group_by.append(DIMENSIONS[b])
+
+    accounts = options.accounts or cm.get_configured_accounts()
+    names = {}
+    items = {}
+    for account in accounts:
+        if not cm.account_exists(account):
+            print('Unknown account: {0}'.format(account), file=sys.stderr)
+            sys.exit(1)
+        config = cm.get_config(account)
+        if config.get('account'):
+            names[config['account']] = account
+            items[config['account']] = config.get('item_id') or ''
+    account_ids = sorted(names) if options.accounts else None
+
+    with PROFILER.stage('report'):
+        if options.dbtype == 'sqlite':
+            # SQLite keeps every account in one table
+            stores = [storage_manager.open_storage(options, accounts[0])]
+        else:
+            stores = [storage_manager.open_storage(options, account) for account in accounts]
+        # Backend groups of separate stores (or of accounts of one item) are
+        # merged here: a handful of rows
+        columns = list(by) + ['currency']
+        merged = {}
+        for sm in stores:
+            for row in sm.aggregate(group_by, options.from_month, options.to_month,
+                                    options.only_new, account_ids):
+                values = {
+                    'month': row.get('month'),
+                    'account': names.get(row.get('account_id'), row.get('account_id')),
+                    'item': items.get(row.get('account_id'), ''),
+                    'category': row.get('category'),
+                    'associated_account': row.get('associated_account'),
+                    'currency': row['currency'],
+                }
+                key = tuple(values[c] for c in columns)
+                total = merged.setdefault(key, [0, 0.0])
+                total[0] += row['count']
+                total[1] += row['total'] or 0
+    rows = [
+        dict(zip(columns, key), count=n, total=round(total, 2))
+        for key, (n, total) in sorted(merged.items(), key=lambda kv: tuple(str(k) for k in kv[0]))
+    ]
+    PROFILER.count('report_rows', len(rows))
+
+    columns += ['count', 'total']
+    if options.output:
+        with open(options.output, mode='w', encoding='utf-8', newline='') as out:
+            _write(rows, columns, options.format, out)
+    else:
+        _write(rows, columns, options.format, sys.stdout)
+    PROFILER.report()
@@ -0,0 +1,143 @@
+#! /usr/bin/env python3
+
+"""
+Full-text search of stored transactions.
+
+Matches the words given against the name, merchant name, payee and tags of
+every stored transaction and lists the best matches first. Every word must
+match; a word ending in * matches words starting with it (SQLite and the
+segment store only). The search runs on an FTS5 index for SQLite and a text
+index for MongoDB, both kept current as transactions are saved and pulled;
+the segment store is scanned. Amounts are Plaid amounts: positive for money
+leaving the account.
+
+  plaid2text search amazon --from 2024-03-01 --to 2024-05-31
+  plaid2text search 'coffee*' --account chase_checking --max-amount 10
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import sys
+
+import plaid2text.config_manager as cm
+from plaid2text.profiler import PROFILER
+import plaid2text.storage_manager as storage_manager
+
+
+COLUMNS = ['date', 'account', 'amount', 'currency', 'name', 'merchant_name', 'payee',
+           'associated_account', 'tags', 'score', 'transaction_id']
+
+
+def _date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a YYYY-MM-DD date: {0}'.format(value))
+
+
+def _parse_args(argv):
+    defaults = cm.get_defaults()
+    parser = argparse.ArgumentParser(
+        prog='plaid2text search',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('terms', nargs='+', metavar='WORD', help='words to search for')
+    parser.add_argument(
+        '--account',
+        dest='accounts',
+        action='append',
+        metavar='NICKNAME',
+        help='only search this account; may be repeated (default: every configured account)'
+    )
+    parser.add_argument('--from', dest='from_date', type=_date, metavar='YYYY-MM-DD',
+                        help='only transactions on or after this date')
+    parser.add_argument('--to', dest='to_date', type=_date, metavar='YYYY-MM-DD',
+                        help='only transactions on or before this date')
+    parser.add_argument('--min-amount', type=float, metavar='AMOUNT',
+                        help='only transactions of at least AMOUNT')
+    parser.add_argument('--max-amount', type=float, metavar='AMOUNT',
+                        help='only transactions of at most AMOUNT')
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=50,
+        help='number of matches to list (default: 50)'
+    )
+    parser.add_argument(
+        '--format',
+        choices=['csv', 'json'],
+        default='csv',
+        help='output format (default: csv)'
+    )
+    parser.add_argument(
+        '--output',
+        metavar='FILE',
+        help='write the matches to FILE (default: stdout)'
+    )
+    storage_manager.add_storage_arguments(parser, defaults)
+    parser.add_argument('--profile', action='store_true', help='print a per-stage timing breakdown')
+    return parser.parse_args(argv)
+
+
+def _write(rows, fmt, out):
+    if fmt == 'json':
+        json.dump(rows, out, indent=2)
+        out.write('\n')
+        return
+    writer = csv.DictWriter(out, fieldnames=COLUMNS, lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main(argv):
+    options = _parse_args(argv)
+    if options.profile:
+        PROFILER.enable()
+    if not storage_manager._search_terms(options.terms):
+        print('Nothing to search for', file=sys.stderr)
+        sys.exit(1)
+
+    accounts = options.accounts or cm.get_configured_accounts()
+    names = {}
+    for account in accounts:
+        if not cm.account_exists(account):
+            print('Unknown account: {0}'.format(account), file=sys.stderr)
+            sys.exit(1)
+        config = cm.get_config(account)
+        if config.get('account'):
+            names[config['account']] = account
+    account_ids = sorted(names) if options.accounts else None
+
+    with PROFILER.stage('search'):
+        if options.dbtype == 'sqlite':
+            # SQLite keeps every account in one table
+            stores = [storage_manager.open_storage(options, accounts[0])]
+        else:
+            stores = [storage_manager.open_storage(options, account) for account in accounts]
+        found = []
+        for sm in stores:
+            try:
+                found += sm.search(options.terms, options.from_date, options.to_date,
+                                   options.min_amount, options.max_amount, account_ids,
+                                   options.limit)
+            except RuntimeError as ex:
+                print('Cannot search: {0}'.format(ex), file=sys.stderr)
+                sys.exit(1)
+        # Best of the stores' best matches
+        found.sort(key=lambda r: (r['score'], r['date']), reverse=True)
+        rows = []
+        for r in found[:options.limit]:
+            r = dict(r, account=names.get(r['account_id'], r['account_id']),
+                     score=round(r['score'], 3))
+            rows.append(dict((c, r[c]) for c in COLUMNS))
+    PROFILER.count('search_matches', len(rows))
+
+    if options.output:
+        with open(options.output, mode='w', encoding='utf-8', newline='') as out:
+            _write(rows, options.format, out)
+    else:
+        _write(rows, options.format, sys.stdout)
+    PROFILER.report()
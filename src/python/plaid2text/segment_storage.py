@@ -0,0 +1,761 @@
+#! /usr/bin/env python3
+
+"""
+Append-only segment store, the `segments` dbtype.
+
+Each account has a directory of JSON lines segments (seg-000001.jsonl, ...)
+that are only ever appended to. A line holds either the Plaid payload of a
+transaction ("k": "t") or its plaid2text metadata ("k": "m"), and the latest
+line of each kind wins, so a sync is a run of sequential appends and marking
+transactions pulled appends small metadata lines.
+
+The `index` file maps every live transaction to the position of its two
+lines: a header, fixed size entries sorted by (date, transaction_id), then
+the entry numbers sorted by transaction_id. It is memory-mapped, so date
+ranges and id lookups are binary searches. Lines appended after the index
+was written (the tail) are scanned on open and kept in memory, and the index
+is rewritten once the tail reaches a quarter of its size.
+
+When dead lines outweigh live ones, a background thread copies the live
+lines into one new segment and drops the old ones. Appends, index rewrites
+and compaction hold the account's lock file, and reads hold it shared so no
+segment is dropped under them, so processes can share a store.
+"""
+
+import bisect
+from collections import namedtuple
+import contextlib
+import datetime
+import functools
+import glob
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+
+import plaid2text.config_manager as cm
+from plaid2text.metrics import METRICS
+from plaid2text.profiler import PROFILER
+from plaid2text.records import TransactionRecord
+from plaid2text.storage_manager import (
+    StorageManager, TEXT_DOC, SEARCH_COLUMNS, _category, _decode_dates, _search_terms, _tags_text
+)
+
+
+# A new segment is started once the active one reaches this size
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+# The index is rewritten once the tail holds more than this many
+# transactions and a quarter of the indexed ones
+TAIL_MIN = 2000
+
+# Dead bytes needed, on top of outweighing the live ones, for a compaction
+COMPACT_MIN_BYTES = 4 * 1024 * 1024
+
+ID_BYTES = 64
+
+STAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+INDEX_MAGIC = b'P2TSEG1\n'
+
+# magic, entry count, covered segment and offset, first live segment
+HEADER = struct.Struct('<8sIIQI')
+
+# transaction_id, date as YYYYMMDD, pulled, updated (epoch seconds),
+# payload line segment/offset/length, metadata line segment/offset/length
+ENTRY = struct.Struct('<%dsIBdIQIIQI' % ID_BYTES)
+
+POSITION = struct.Struct('<I')
+
+# Words search() matches terms against
+WORD_RE = re.compile(r'\w+')
+
+Entry = namedtuple('Entry', 'id date pulled updated tseg toff tlen mseg moff mlen')
+
+
+def _stamp():
+    return datetime.datetime.now(datetime.timezone.utc).strftime(STAMP_FORMAT)
+
+
+# Every line of a batch shares its stamp
+@functools.lru_cache(maxsize=64)
+def _epoch(stamp):
+    return datetime.datetime.strptime(stamp, STAMP_FORMAT).replace(
+        tzinfo=datetime.timezone.utc).timestamp()
+
+
+def _date_int(value):
+    """'2024-05-31', a date or a datetime as 20240531."""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.year * 10000 + value.month * 100 + value.day
+    return int(value[:4] + value[5:7] + value[8:10])
+
+
+def _id_key(transaction_id):
+    key = transaction_id.encode('utf-8')
+    if len(key) > ID_BYTES:
+        raise ValueError('transaction_id longer than %d bytes: %s' % (ID_BYTES, transaction_id))
+    return key.ljust(ID_BYTES, b'\0')
+
+
+class SegmentStorage(StorageManager):
+    def __init__(self, directory, account, posting_account=None):
+        self.root = directory
+        self.account_name = account
+        self.path = os.path.join(directory, account)
+        os.makedirs(self.path, exist_ok=True)
+        self.index_path = os.path.join(self.path, 'index')
+        self.lock_path = os.path.join(self.path, 'store')
+        self._lock = threading.RLock()
+        self._files = {}
+        self._siblings = {}
+        self._compactor = None
+        self._mm = None
+        self._positions = None
+        with cm.file_lock(self.lock_path, shared=True), self._lock:
+            self._load()
+
+    # Files
+
+    def _segment_path(self, seg):
+        return os.path.join(self.path, 'seg-%06d.jsonl' % seg)
+
+    def _segments(self):
+        segs = []
+        for path in glob.glob(os.path.join(self.path, 'seg-*.jsonl')):
+            seg = int(os.path.basename(path)[4:-6])
+            if seg >= self._first_seg:
+                segs.append(seg)
+        return sorted(segs)
+
+    def _read_line(self, seg, offset, length):
+        f = self._files.get(seg)
+        if f is None:
+            f = self._files[seg] = open(self._segment_path(seg), mode='rb')
+        return json.loads(os.pread(f.fileno(), length, offset))
+
+    # Index
+
+    def _index_identity(self):
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _load(self):
+        """Map the index and scan the tail after it."""
+        if self._positions is not None:
+            self._positions.release()
+            self._positions = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        self._last_indexed = (None, None)
+        self._count = 0
+        self._first_seg = 0
+        covered = (0, 0)
+        self._identity = self._index_identity()
+        if self._identity and self._identity[1] >= HEADER.size:
+            with open(self.index_path, mode='rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, count, seg, offset, first_seg = HEADER.unpack_from(self._mm, 0)
+            if magic != INDEX_MAGIC:
+                raise ValueError('Not a plaid2text segment index: %s' % self.index_path)
+            self._count = count
+            self._first_seg = first_seg
+            covered = (seg, offset)
+            base = HEADER.size + count * ENTRY.size
+            self._positions = memoryview(self._mm)[base:base + count * POSITION.size].cast('I')
+        for seg in list(self._files):
+            if seg < self._first_seg:
+                self._files.pop(seg).close()
+        self._tail = {}
+        self._end = covered
+        self._scan_tail()
+
+    def _scan_tail(self):
+        """Apply the complete lines written after self._end."""
+        end_seg, end_offset = self._end
+        for seg in self._segments():
+            if seg < end_seg:
+                continue
+            start = end_offset if seg == end_seg else 0
+            with open(self._segment_path(seg), mode='rb') as f:
+                f.seek(start)
+                data = f.read()
+            pos = 0
+            while True:
+                newline = data.find(b'\n', pos)
+                # A line cut short by a crash is left for the next writer to
+                # truncate
+                if newline < 0:
+                    break
+                self._apply(json.loads(data[pos:newline]), seg, start + pos, newline + 1 - pos)
+                pos = newline + 1
+            self._end = (seg, start + pos)
+
+    def _entry_at(self, i):
+        e = ENTRY.unpack_from(self._mm, HEADER.size + i * ENTRY.size)
+        return Entry(e[0].rstrip(b'\0').decode('utf-8'), *e[1:])
+
+    def _indexed(self, transaction_id):
+        """The index entry of a transaction, by binary search over the ids."""
+        if not self._count:
+            return None
+        # Saving looks each new id up twice in a row
+        if self._last_indexed[0] == transaction_id:
+            return self._last_indexed[1]
+        key = _id_key(transaction_id)
+        mm = self._mm
+        positions = self._positions
+        found = None
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER.size + positions[mid] * ENTRY.size
+            at = mm[offset:offset + ID_BYTES]
+            if at < key:
+                lo = mid + 1
+            elif at > key:
+                hi = mid
+            else:
+                found = self._entry_at(positions[mid])
+                break
+        self._last_indexed = (transaction_id, found)
+        return found
+
+    def _lookup(self, transaction_id):
+        e = self._tail.get(transaction_id) or self._indexed(transaction_id)
+        return e if e and e.tlen else None
+
+    def _apply(self, line, seg, offset, length):
+        """Point the in-memory tail at a line just read or written."""
+        transaction_id = line['id']
+        current = self._tail.get(transaction_id) or self._indexed(transaction_id)
+        updated = _epoch(line['u'])
+        if current:
+            updated = max(updated, current.updated)
+        if line['k'] == 't':
+            e = Entry(transaction_id, _date_int(line['t']['date']),
+                      current.pulled if current else 0, updated, seg, offset, length,
+                      current.mseg if current else 0, current.moff if current else 0,
+                      current.mlen if current else 0)
+        else:
+            pulled = 1 if (line['m'] or {}).get('pulled_to_file') else 0
+            if current:
+                e = current._replace(pulled=pulled, updated=updated, mseg=seg, moff=offset, mlen=length)
+            else:
+                e = Entry(transaction_id, 0, pulled, updated, 0, 0, 0, seg, offset, length)
+        self._tail[transaction_id] = e
+
+    def _entries(self, lo=None, hi=None):
+        """Live entries dated within [lo, hi] (YYYYMMDD), in (date, id) order."""
+        start, stop = 0, self._count
+        if self._count and lo is not None:
+            start = bisect.bisect_left(_Dates(self), lo)
+        if self._count and hi is not None:
+            stop = bisect.bisect_right(_Dates(self), hi)
+        tail = self._tail
+        indexed = (self._entry_at(i) for i in range(start, stop))
+        indexed = (e for e in indexed if e.id not in tail)
+        recent = sorted(
+            (e for e in tail.values()
+             if e.tlen and (lo is None or e.date >= lo) and (hi is None or e.date <= hi)),
+            key=lambda e: (e.date, e.id)
+        )
+        return heapq.merge(indexed, recent, key=lambda e: (e.date, e.id))
+
+    def _write_index(self, entries, covered, first_seg):
+        """Replace the index file; the caller holds the lock file."""
+        entries = list(entries)
+        data = bytearray(HEADER.pack(INDEX_MAGIC, len(entries), covered[0], covered[1], first_seg))
+        keys = []
+        for e in entries:
+            key = _id_key(e.id)
+            keys.append(key)
+            data += ENTRY.pack(key, *e[1:])
+        for i in sorted(range(len(entries)), key=keys.__getitem__):
+            data += POSITION.pack(i)
+        tmp = self.index_path + '.tmp'
+        with open(tmp, mode='wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.index_path)
+        return entries
+
+    def _refresh(self):
+        """Catch up with what other processes wrote since the last call."""
+        if self._index_identity() != self._identity:
+            self._load()
+        else:
+            self._scan_tail()
+
+    @contextlib.contextmanager
+    def _reading(self):
+        """
+        Hold the lock file shared, so no other process compacts the segments
+        away while they are read, and the store lock, caught up with what
+        other processes wrote.
+        """
+        with cm.file_lock(self.lock_path, shared=True), self._lock:
+            self._refresh()
+            yield
+
+    def _checkpoint(self):
+        """
+        Fold the tail into a new index once it is large enough, and start a
+        compaction when dead lines outweigh live ones.
+        """
+        if len(self._tail) <= max(TAIL_MIN, self._count // 4):
+            return
+        entries = self._write_index(self._entries(), self._end, self._first_seg)
+        self._load()
+        live = sum(e.tlen + e.mlen for e in entries)
+        total = sum(os.path.getsize(self._segment_path(seg)) for seg in self._segments())
+        if total - live > max(live, COMPACT_MIN_BYTES):
+            self.compact(background=True)
+
+    # Writing
+
+    def _append(self, build):
+        """
+        Append the (kind, transaction_id, object) lines build() returns,
+        synced to disk before they are indexed. build runs under the lock,
+        against an up to date view of the store.
+        """
+        stamp = _stamp()
+        with cm.file_lock(self.lock_path), self._lock:
+            self._refresh()
+            lines = build()
+            if not lines:
+                return lines
+            segs = self._segments()
+            seg = segs[-1] if segs else max(self._first_seg, 1)
+            path = self._segment_path(seg)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if self._end[0] == seg and size > self._end[1]:
+                # Drop a line left incomplete by a crashed writer
+                os.truncate(path, self._end[1])
+                size = self._end[1]
+            if size >= SEGMENT_BYTES:
+                seg += 1
+                path = self._segment_path(seg)
+                size = 0
+            written = []
+            with open(path, mode='ab') as f:
+                for kind, transaction_id, obj in lines:
+                    line = {'k': kind, 'id': transaction_id, 'u': stamp, kind: obj}
+                    data = (json.dumps(line) + '\n').encode('utf-8')
+                    f.write(data)
+                    written.append((line, size, len(data)))
+                    size += len(data)
+                f.flush()
+                os.fsync(f.fileno())
+            for line, offset, length in written:
+                self._apply(line, seg, offset, length)
+            self._end = (seg, size)
+            self._checkpoint()
+        return lines
+
+    def _save_transactions(self, transactions):
+        payloads = []
+        for t in transactions:
+            t = t.to_dict()
+            # Can't json serialize date object
+            for field in ('date', 'authorized_date', 'authorized_datetime', 'datetime'):
+                if t.get(field) is not None:
+                    t[field] = t[field].isoformat()
+            payloads.append(t)
+        downloaded = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        def build():
+            lines = []
+            new = set()
+            for t in payloads:
+                transaction_id = t['transaction_id']
+                lines.append(('t', transaction_id, t))
+                if transaction_id not in new and self._lookup(transaction_id) is None:
+                    # Same defaults the other backends set on insert
+                    metadata = dict(TEXT_DOC['plaid2text'])
+                    metadata['date_downloaded'] = downloaded
+                    lines.append(('m', transaction_id, metadata))
+                    new.add(transaction_id)
+            return lines
+
+        self._append(build)
+        saved = len(payloads)
+        PROFILER.count('rows_saved', saved)
+        METRICS.inc('plaid2text_storage_rows_upserted_total', saved, backend='segments', account=self.account_name)
+
+    def save_transactions(self, transactions):
+        with PROFILER.stage('db_save'):
+            self._save_transactions(transactions)
+
+    def _store(self, account):
+        if account == self.account_name:
+            return self
+        if account not in self._siblings:
+            self._siblings[account] = SegmentStorage(self.root, account)
+        return self._siblings[account]
+
+    def _cursor_file(self):
+        return os.path.join(self.root, 'cursors.json')
+
+    def _read_cursors(self):
+        try:
+            with open(self._cursor_file(), mode='r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get_cursor(self, item_id):
+        cursor = self._read_cursors().get(item_id)
+        return cursor['cursor'] if cursor else None
+
+    def save_sync(self, item_id, cursor, transactions_by_account):
+        """
+        The rows are synced to disk before the cursor is written. If the
+        cursor write is lost the page is fetched and appended again on the
+        next sync, and the later lines simply win.
+        """
+        with PROFILER.stage('db_save'):
+            for account, transactions in transactions_by_account.items():
+                self._store(account)._save_transactions(transactions)
+            with cm.file_lock(self._cursor_file()):
+                cursors = self._read_cursors()
+                cursors[item_id] = {'cursor': cursor, 'updated': _stamp()}
+                cm.atomic_write(self._cursor_file(), json.dumps(cursors))
+
+    def update_transaction(self, update, mark_pulled=None):
+        changes = []
+        for txn in update:
+            transaction_id = txn.pop('transaction_id')
+            txn['pulled_to_file'] = mark_pulled
+            if mark_pulled:
+                txn['date_last_pulled'] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+            changes.append((transaction_id, txn))
+
+        def build():
+            lines = []
+            for transaction_id, txn in changes:
+                e = self._lookup(transaction_id)
+                if e is None:
+                    continue
+                # Merged over the current metadata, as SQLite's json_patch does
+                metadata = self._read_line(e.mseg, e.moff, e.mlen)['m'] if e.mlen else None
+                metadata = dict(metadata or {})
+                metadata.update(txn)
+                lines.append(('m', transaction_id, metadata))
+            return lines
+
+        lines = self._append(build)
+        PROFILER.count('rows_updated', len(lines))
+        METRICS.inc('plaid2text_storage_rows_modified_total', len(lines), backend='segments', account=self.account_name)
+
+    # Reading
+
+    def _read(self, e):
+        """The payload and metadata lines of an entry."""
+        t = self._read_line(e.tseg, e.toff, e.tlen)
+        m = self._read_line(e.mseg, e.moff, e.mlen) if e.mlen else None
+        return t, m
+
+    def get_transactions(self, from_date=None, to_date=None, only_new=True, fields=()):
+        lo = hi = None
+        if from_date and to_date and (from_date <= to_date):
+            lo, hi = _date_int(from_date), _date_int(to_date)
+        elif from_date and not to_date:
+            lo = _date_int(from_date)
+        elif not from_date and to_date:
+            hi = _date_int(to_date)
+        extra_fields = sorted(set(f.split('.')[0] for f in fields))
+
+        ret = []
+        with PROFILER.stage('db_query'), self._reading():
+            for e in self._entries(lo, hi):
+                if only_new and e.pulled:
+                    continue
+                t, m = self._read(e)
+                t = t['t']
+                extra = None
+                if extra_fields:
+                    extra = _decode_dates(dict((f, t.get(f)) for f in extra_fields))
+                ret.append(TransactionRecord(
+                    t['transaction_id'], t.get('account_id'), t['date'], t.get('name'),
+                    t.get('merchant_name'), t.get('amount'), t.get('iso_currency_code'),
+                    t.get('pending'),
+                    m['m'] if m and m['m'] else None,
+                    extra=extra or None,
+                    loader=self.get_raw_transaction
+                ))
+        PROFILER.count('rows_read', len(ret))
+        METRICS.inc('plaid2text_storage_rows_read_total', len(ret), backend='segments', account=self.account_name)
+        return ret
+
+    def get_raw_transaction(self, transaction_id):
+        """The full stored Plaid payload of one transaction, dates decoded."""
+        with self._reading():
+            e = self._lookup(transaction_id)
+            if e is None:
+                raise KeyError(transaction_id)
+            t, m = self._read(e)
+        t = t['t']
+        t['plaid2text'] = m['m'] if m else None
+        return _decode_dates(t)
+
+    def iter_transactions(self, account_id=None, changed_since=None, batch_size=1000):
+        since = _epoch(changed_since) if changed_since else None
+        with self._reading():
+            identity = self._identity
+            entries = [e for e in self._entries() if since is None or e.updated >= since]
+        for i in range(0, len(entries), batch_size):
+            batch = entries[i:i + batch_size]
+            with self._reading():
+                if self._identity != identity:
+                    # The index was rewritten or compacted: positions may have moved
+                    batch = [e for e in (self._lookup(e.id) for e in batch) if e]
+                rows = [self._read(e) for e in batch]
+            for t, m in rows:
+                ret = t['t']
+                ret['plaid2text'] = m['m'] if m else None
+                ret['updated'] = max(t['u'], m['u']) if m else t['u']
+                yield ret
+
+    def iter_stored(self, account_id=None, after=None, batch_size=1000):
+        """Keyed by [date, transaction_id], the index order."""
+        after = tuple(after) if after else None
+        while True:
+            with self._reading():
+                entries = self._entries(after[0] if after else None)
+                batch = []
+                for e in entries:
+                    if after and (e.date, e.id) <= after:
+                        continue
+                    batch.append(e)
+                    if len(batch) == batch_size:
+                        break
+                rows = [(e, self._read(e)) for e in batch]
+            if not rows:
+                break
+            for e, (t, m) in rows:
+                ret = t['t']
+                ret['plaid2text'] = m['m'] if m else None
+                yield [e.date, e.id], ret
+            after = (batch[-1].date, batch[-1].id)
+
+    def import_transactions(self, transactions):
+        docs = [dict(t) for t in transactions]
+
+        def build():
+            lines = []
+            for t in docs:
+                metadata = t.pop('plaid2text', None)
+                lines.append(('t', t['transaction_id'], t))
+                lines.append(('m', t['transaction_id'], metadata))
+            return lines
+
+        self._append(build)
+        PROFILER.count('rows_imported', len(docs))
+        METRICS.inc('plaid2text_storage_rows_upserted_total', len(docs), backend='segments', account=self.account_name)
+
+    def iter_history(self):
+        for account in sorted(os.listdir(self.root)):
+            if not os.path.isdir(os.path.join(self.root, account)):
+                continue
+            store = self._store(account)
+            with store._reading():
+                identity = store._identity
+                entries = [e for e in store._entries() if e.pulled]
+            for e in entries:
+                with store._reading():
+                    if store._identity != identity:
+                        # The index was rewritten or compacted: positions may have moved
+                        e = store._lookup(e.id)
+                        if e is None:
+                            continue
+                    t, m = store._read(e)
+                t, m = t['t'], (m['m'] if m else None) or {}
+                yield t.get('name'), t.get('merchant_name'), m.get('payee'), m.get('associated_account')
+
+    def aggregate(self, group_by, from_month=None, to_month=None, only_new=False, account_ids=None):
+        """A scan of the index date range, reading only the rows it keeps."""
+        lo = int(from_month.replace('-', '')) * 100 if from_month else None
+        hi = int(to_month.replace('-', '')) * 100 + 99 if to_month else None
+        groups = {}
+        with self._reading():
+            for e in self._entries(lo, hi):
+                if only_new and e.pulled:
+                    continue
+                t, m = self._read(e)
+                t, m = t['t'], (m['m'] if m else None) or {}
+                if account_ids and t.get('account_id') not in account_ids:
+                    continue
+                values = {
+                    'month': t['date'][:7],
+                    'account_id': t.get('account_id'),
+                    'category': _category(t),
+                    'associated_account': m.get('associated_account') or '',
+                }
+                key = tuple(values[k] for k in group_by) + (t.get('iso_currency_code') or '',)
+                group = groups.setdefault(key, [0, 0.0])
+                group[0] += 1
+                group[1] += t.get('amount') or 0
+        keys = list(group_by) + ['currency']
+        return [dict(zip(keys, key), count=n, total=total) for key, (n, total) in groups.items()]
+
+    def search(self, terms, from_date=None, to_date=None, min_amount=None, max_amount=None,
+               account_ids=None, limit=50):
+        """
+        A scan of the index date range: there is no text index, so a row
+        scores the number of words of its fields matching a term.
+        """
+        lo = _date_int(from_date) if from_date else None
+        hi = _date_int(to_date) if to_date else None
+        words = _search_terms(terms)
+        found = []
+        with self._reading():
+            for e in self._entries(lo, hi):
+                t, m = self._read(e)
+                t, m = t['t'], (m['m'] if m else None) or {}
+                amount = t.get('amount')
+                if min_amount is not None and (amount is None or amount < min_amount):
+                    continue
+                if max_amount is not None and (amount is None or amount > max_amount):
+                    continue
+                if account_ids and t.get('account_id') not in account_ids:
+                    continue
+                tags = _tags_text(m.get('tags'))
+                tokens = WORD_RE.findall(' '.join(
+                    (t.get('name') or '', t.get('merchant_name') or '', m.get('payee') or '', tags)).lower())
+                score = 0
+                for word, prefix in words:
+                    hits = sum(1 for token in tokens if token == word or (prefix and token.startswith(word)))
+                    if not hits:
+                        break
+                    score += hits
+                else:
+                    found.append((score, e.date, dict(zip(SEARCH_COLUMNS, (
+                        t['transaction_id'], t.get('account_id'), t['date'], t.get('name'),
+                        t.get('merchant_name'), amount, t.get('iso_currency_code'),
+                        m.get('payee'), m.get('associated_account'), tags, score
+                    )))))
+        return [row for _, _, row in heapq.nlargest(limit, found, key=lambda f: f[:2])]
+
+    def check_pending(self):
+        with self._reading():
+            return any(not e.pulled for e in self._entries())
+
+    def archive_payloads(self, batch_size=1000):
+        """Payloads already stay in the segments, off the index that reads go through."""
+        return 0
+
+    # Compaction
+
+    def compact(self, background=False):
+        """
+        Copy the live lines into a new segment and drop the old segments.
+        With background, run in a thread and return at once; the process
+        still waits for it to finish before exiting.
+        """
+        if background:
+            if self._compactor and self._compactor.is_alive():
+                return
+            self._compactor = threading.Thread(target=self._compact, name='segment-compaction')
+            self._compactor.start()
+        else:
+            self._compact()
+
+    def _compact(self):
+        with self._reading():
+            entries = list(self._entries())
+            snapshot_end = self._end
+            first_seg = self._first_seg
+            segs = self._segments()
+            # Opened while the lock keeps them from being dropped, they stay
+            # readable if another process compacts meanwhile
+            files = dict((s, open(self._segment_path(s), mode='rb')) for s in segs)
+        try:
+            if not segs:
+                return
+            seg = segs[-1] + 1
+            for stale in glob.glob(os.path.join(self.path, '.compact-*')):
+                os.remove(stale)
+            tmp = os.path.join(self.path, '.compact-%06d' % seg)
+
+            # Copy the live lines, date ordered, without holding any lock
+            compacted = []
+            offset = 0
+            with open(tmp, mode='wb') as out:
+                for e in entries:
+                    new = {}
+                    for kind, s, o, n in (('t', e.tseg, e.toff, e.tlen), ('m', e.mseg, e.moff, e.mlen)):
+                        if not n:
+                            new[kind] = (0, 0, 0)
+                            continue
+                        if s not in files:
+                            files[s] = open(self._segment_path(s), mode='rb')
+                        out.write(os.pread(files[s].fileno(), n, o))
+                        new[kind] = (seg, offset, n)
+                        offset += n
+                    compacted.append(e._replace(
+                        tseg=new['t'][0], toff=new['t'][1], tlen=new['t'][2],
+                        mseg=new['m'][0], moff=new['m'][1], mlen=new['m'][2]))
+                covered = (seg, offset)
+
+                with cm.file_lock(self.lock_path), self._lock:
+                    if self._current_first_seg() != first_seg:
+                        # Another process compacted meanwhile
+                        out.close()
+                        os.remove(tmp)
+                        return
+                    # Lines appended since the snapshot follow the compacted
+                    # ones, and are picked up as the new tail
+                    self._refresh()
+                    end_seg, end_offset = snapshot_end
+                    for s in self._segments():
+                        if s < end_seg:
+                            continue
+                        if s not in files:
+                            files[s] = open(self._segment_path(s), mode='rb')
+                        f = files[s]
+                        f.seek(end_offset if s == end_seg else 0)
+                        out.write(f.read())
+                    out.flush()
+                    os.fsync(out.fileno())
+                    os.replace(tmp, self._segment_path(seg))
+                    self._write_index(compacted, covered, seg)
+                    for s in segs:
+                        os.remove(self._segment_path(s))
+                    self._load()
+        finally:
+            for f in files.values():
+                f.close()
+        PROFILER.count('segments_compacted', len(segs))
+
+    def _current_first_seg(self):
+        try:
+            with open(self.index_path, mode='rb') as f:
+                header = f.read(HEADER.size)
+        except FileNotFoundError:
+            return 0
+        if len(header) < HEADER.size:
+            return 0
+        return HEADER.unpack(header)[4]
+
+
+class _Dates():
+    """The dates of the index entries, as a sequence for bisect."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store._count
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<I', self.store._mm, HEADER.size + i * ENTRY.size + ID_BYTES)[0]
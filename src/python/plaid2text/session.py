@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+
+"""
+Checkpoint log for interactive sessions.
+
+Every payee/account/tags decision is appended to
+~/.config/plaid2text/sessions/<account>.jsonl, together with the rendered
+entry, as soon as it is made. The log is removed when the session finishes;
+if it is still there at the start of the next run the session was
+interrupted, and its decisions can be replayed instead of asking again.
+Once the entries of some decisions are written to the output, a line listing
+their transactions is appended, so a resumed run knows which entries the
+output already holds.
+"""
+
+from collections import OrderedDict
+import json
+import os
+
+import plaid2text.config_manager as cm
+
+
+def session_file(account):
+    return os.path.join(cm.DEFAULT_CONFIG_DIR, 'sessions', account + '.jsonl')
+
+
+class Session():
+    def __init__(self, account):
+        self.path = session_file(account)
+        self.decisions = OrderedDict()
+        self._file = None
+
+    def read(self):
+        """
+        Load the decisions of an interrupted session. A line cut short by a
+        crash is ignored, as is everything after it.
+        """
+        if not os.path.exists(self.path):
+            return self.decisions
+        with open(self.path, mode='r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    d = json.loads(line)
+                except ValueError:
+                    break
+                if 'flushed' in d:
+                    for transaction_id in d['flushed']:
+                        if transaction_id in self.decisions:
+                            self.decisions[transaction_id]['flushed'] = True
+                else:
+                    self.decisions[d['transaction_id']] = d
+        return self.decisions
+
+    def start(self, resume=False):
+        """Open the log, keeping the previous decisions only when resuming."""
+        if not resume:
+            self.decisions = OrderedDict()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, mode='w', encoding='utf-8')
+        for d in self.decisions.values():
+            self._file.write(json.dumps(d) + '\n')
+        self._file.flush()
+
+    def record(self, transaction_id, payee, account, tags, text):
+        d = {
+            'transaction_id': transaction_id,
+            'payee': payee,
+            'account': account,
+            'tags': tags,
+            'text': text,
+        }
+        self.decisions[transaction_id] = d
+        self._file.write(json.dumps(d) + '\n')
+        self._file.flush()
+
+    def flushed(self, transaction_ids):
+        """The entries of these decisions were written to the output."""
+        for transaction_id in transaction_ids:
+            self.decisions[transaction_id]['flushed'] = True
+        self._file.write(json.dumps({'flushed': list(transaction_ids)}) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def finish(self):
+        """The session completed: drop the log."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
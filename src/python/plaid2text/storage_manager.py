@@ -1,14 +1,16 @@
 #! /usr/bin/env python3
 
 import datetime
-from dateutil import parser as date_parser
+import os
 import sqlite3
 import json
+import zlib
 
 from abc import ABCMeta, abstractmethod
-from pymongo import MongoClient, ASCENDING, DESCENDING
 
-from .renderers import Entry
+from .metrics import METRICS
+from .profiler import PROFILER
+from .records import RECORD_FIELDS, TransactionRecord
 
 TEXT_DOC = {
     'plaid2text': {
@@ -33,9 +35,13 @@ class StorageManager(metaclass=ABCMeta):
         pass
 
     @abstractmethod
-    def get_transactions(self, from_date=None, to_date=None, only_new=True):    
+    def get_transactions(self, from_date=None, to_date=None, only_new=True, fields=()):
         """
         Retrieve transactions for producing text file.
+
+        fields: dotted paths of the Plaid fields to fetch along with the
+                record ones (see renderers.payload_fields); anything else is
+                only loaded from the backend when asked for
         """
         pass
 
@@ -43,17 +49,289 @@ class StorageManager(metaclass=ABCMeta):
     def update_transaction(self, update):
         pass
 
+    @abstractmethod
+    def iter_transactions(self, account_id=None, changed_since=None, batch_size=1000):
+        """
+        Stream full stored transactions (Plaid fields, `plaid2text` metadata
+        and the `updated` change stamp) in date order, fetching batch_size
+        rows at a time. Only rows changed at or after the `changed_since`
+        stamp are returned when it is given.
+        """
+        pass
+
+    @abstractmethod
+    def iter_history(self):
+        """
+        Yield (name, merchant_name, payee, associated_account) for every
+        transaction already pulled to file, across all accounts.
+        """
+        pass
+
+    @abstractmethod
+    def archive_payloads(self, batch_size=1000):
+        """
+        Move the full Plaid payloads of rows still stored whole to the cold
+        store, leaving lean hot rows. Returns the number of rows moved.
+        """
+        pass
+
+    @abstractmethod
+    def aggregate(self, group_by, from_month=None, to_month=None, only_new=False, account_ids=None):
+        """
+        Count and sum the stored transactions in the backend, grouped by the
+        dimensions in group_by (REPORT_DIMENSIONS) and always by currency.
+        from_month, to_month: 'YYYY-MM' bounds, inclusive
+        only_new: only transactions not pulled to file yet
+        account_ids: only these Plaid account ids
+
+        Returns a list of dicts: the group_by keys, 'currency', 'count' and
+        'total' (the sum of Plaid amounts, positive for money out).
+        """
+        pass
+
+    @abstractmethod
+    def search(self, terms, from_date=None, to_date=None, min_amount=None, max_amount=None,
+               account_ids=None, limit=50):
+        """
+        Full-text search of the name, merchant name, payee and tags of the
+        stored transactions. Every term must match; a term ending in * matches
+        words starting with it.
+        from_date, to_date: datetime.date bounds, inclusive
+        min_amount, max_amount: Plaid amount bounds, inclusive
+        account_ids: only these Plaid account ids
+
+        Returns at most limit dicts (SEARCH_COLUMNS), best match first.
+        """
+        pass
+
+    @abstractmethod
+    def iter_stored(self, account_id=None, after=None, batch_size=1000):
+        """
+        Stream (key, transaction) for every stored transaction in the order
+        the backend keeps them, batch_size rows at a time. The transaction is
+        in the portable form import_transactions takes: the full Plaid fields
+        and `plaid2text` metadata, with dates as ISO strings. Keys increase
+        and are JSON values; the last one passed as `after` resumes after it.
+        """
+        pass
+
+    @abstractmethod
+    def import_transactions(self, transactions):
+        """
+        Upsert transactions in the portable form of iter_stored, metadata
+        included, replacing what is stored, in one bulk write.
+        """
+        pass
+
+    @abstractmethod
+    def get_cursor(self, item_id):
+        """The /transactions/sync cursor stored for a Plaid item, or None."""
+        pass
+
+    @abstractmethod
+    def save_sync(self, item_id, cursor, transactions_by_account):
+        """
+        Save one page of /transactions/sync results, given as
+        {account nickname: [transactions]}, together with the cursor that
+        follows the page.
+        """
+        pass
+
+
+def open_storage(options, account, posting_account=None):
+    """
+    Open the storage manager selected by options.dbtype for the given
+    account nickname.
+    """
+    cold_archive = getattr(options, 'cold_archive', False)
+    if not isinstance(cold_archive, bool):
+        cold_archive = cold_archive.lower() in ['true', 'yes', '1', 't']
+    if options.dbtype == 'segments':
+        from plaid2text.segment_storage import SegmentStorage
+        return SegmentStorage(
+            os.path.expanduser(options.segment_dir),
+            account,
+            posting_account
+        )
+    if options.dbtype == 'mongodb':
+        return MongoDBStorage(
+            options.mongo_db,
+            options.mongo_db_uri,
+            account,
+            posting_account,
+            cold_archive=cold_archive
+        )
+    return SQLiteStorage(
+        options.sqlite_db,
+        account,
+        posting_account,
+        cold_archive=cold_archive
+    )
+
+
+def add_storage_arguments(parser, defaults):
+    """
+    The storage options of the main parser for subcommands, defaulting to
+    the values in `defaults` (cm.get_defaults()).
+    """
+    parser.add_argument(
+        '--dbtype',
+        choices=['mongodb', 'sqlite', 'segments'],
+        default=defaults['dbtype'],
+        help='the type of database transactions are stored in'
+    )
+    parser.add_argument(
+        '--mongo-db',
+        metavar='STR',
+        default=defaults['mongo_db'],
+        help='the name of the Mongo database'
+    )
+    parser.add_argument(
+        '--mongo-db-uri',
+        metavar='STR',
+        default=defaults['mongo_db_uri'],
+        help='the URI of the Mongo database'
+    )
+    parser.add_argument(
+        '--sqlite-db',
+        metavar='STR',
+        default=os.path.expanduser(defaults['sqlite_db']),
+        help='the path of the SQLite database'
+    )
+    parser.add_argument(
+        '--segment-dir',
+        metavar='DIR',
+        default=os.path.expanduser(defaults['segment_dir']),
+        help='the directory of the append-only segment store'
+    )
+    parser.add_argument(
+        '--cold-archive',
+        action='store_true',
+        default=defaults['cold_archive'],
+        help='keep only lean rows in the database and the full Plaid payloads compressed on the side'
+    )
+
+
+# Dimensions aggregate() can group by
+REPORT_DIMENSIONS = ('month', 'account_id', 'category', 'associated_account')
+
+
+# The keys of the dicts search() returns
+SEARCH_COLUMNS = ('transaction_id', 'account_id', 'date', 'name', 'merchant_name', 'amount',
+                  'currency', 'payee', 'associated_account', 'tags', 'score')
+
+
+def _search_terms(terms):
+    """(word, prefix) pairs of the search terms, lowercased."""
+    ret = []
+    for term in terms:
+        for word in term.split():
+            prefix = word.endswith('*')
+            word = word.rstrip('*').lower()
+            if word:
+                ret.append((word, prefix))
+    return ret
+
+
+def _tags_text(tags):
+    if isinstance(tags, list):
+        return ' '.join(tags)
+    return tags or ''
+
+
+def _category(t):
+    """The category transactions are reported under."""
+    pfc = t.get('personal_finance_category') or {}
+    return pfc.get('primary') or (t.get('category') or [''])[0]
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+# How the SQLite and segment backends store the metadata dates
+METADATA_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def _portable(t):
+    """
+    A Mongo document in the portable form of iter_stored: backend fields
+    dropped and dates as the ISO strings the other backends store.
+    """
+    t = dict((k, v) for k, v in t.items() if k not in ('_id', 'cold', 'updated'))
+    for field in ('date', 'authorized_date'):
+        if isinstance(t.get(field), datetime.datetime):
+            t[field] = t[field].date().isoformat()
+    for field in ('datetime', 'authorized_datetime'):
+        if isinstance(t.get(field), datetime.datetime):
+            # pymongo returns naive UTC datetimes
+            t[field] = t[field].replace(tzinfo=datetime.timezone.utc).isoformat()
+    if t.get('plaid2text'):
+        t['plaid2text'] = dict(
+            (k, v.strftime(METADATA_DATE_FORMAT) if isinstance(v, datetime.datetime) else v)
+            for k, v in t['plaid2text'].items()
+        )
+    return t
+
+
+def _from_portable(t):
+    """The Mongo document of a portable transaction, _id and updated aside."""
+    t = dict(t)
+    for field in ('date', 'authorized_date'):
+        if t.get(field):
+            t[field] = datetime.datetime.combine(datetime.date.fromisoformat(t[field]), datetime.time())
+    for field in ('datetime', 'authorized_datetime'):
+        if t.get(field):
+            t[field] = datetime.datetime.fromisoformat(t[field])
+    if t.get('plaid2text'):
+        metadata = dict(t['plaid2text'])
+        for k, v in metadata.items():
+            if k.startswith('date_') and v:
+                try:
+                    metadata[k] = datetime.datetime.strptime(v, METADATA_DATE_FORMAT)
+                except (TypeError, ValueError):
+                    pass
+        t['plaid2text'] = metadata
+    return t
+
+# Mongo collection holding one sync cursor document per Plaid item
+CURSOR_COLLECTION = 'plaid2text_cursors'
+
+# Mongo collection holding the compressed payloads of cold archived rows
+PAYLOAD_COLLECTION = 'plaid2text_payloads'
+
+# The Plaid fields a cold archived row keeps: those the transaction records
+# carry, which covers rendering, mapping and the date filters, and the
+# categories reports group by
+HOT_FIELDS = tuple(f for f in RECORD_FIELDS if f != 'plaid2text') + ('category', 'personal_finance_category')
+
+
+def _compress(data):
+    return zlib.compress(data, 6)
+
+
 class MongoDBStorage(StorageManager):
     """
     Handles all Mongo related tasks
     """
-    def __init__(self, db, uri, account, posting_account):
+    def __init__(self, db, uri, account, posting_account, cold_archive=False):
+        from pymongo import MongoClient
         self.mc = MongoClient(uri)
         self.db_name = db
         self.db = self.mc[db]
         self.account = self.db[account]
+        self.account_name = account
+        self.cold_archive = cold_archive
+        self.payloads = self.db[PAYLOAD_COLLECTION]
 
     def save_transactions(self, transactions):
+        with PROFILER.stage('db_save'):
+            self._save_transactions(transactions)
+
+    def _save_transactions(self, transactions, account=None):
+        import bson
+        collection = self.db[account] if account else self.account
+        account = account or self.account_name
         for t in transactions:
             if not t['pending']:
                 t = t.to_dict()
@@ -63,12 +341,47 @@ class MongoDBStorage(StorageManager):
                     t['authorized_date'] = datetime.datetime.combine(t['authorized_date'],datetime.time())  #pymongo accepts only datetime, not date
                 except:                                                                                     # allowing for 'authorized_date' to be 'None' as in the case of ATM withdrawals
                     pass
-                doc = {'$set': t}
+                if self.cold_archive:
+                    # The payload goes first, so a hot row marked cold
+                    # always has one
+                    self.payloads.replace_one(
+                        {'_id': id}, {'_id': id, 'payload': _compress(bson.encode(t))}, upsert=True)
+                    doc = {
+                        '$set': dict((k, t[k]) for k in HOT_FIELDS if k in t),
+                        '$unset': dict((k, '') for k in t if k not in HOT_FIELDS),
+                    }
+                    doc['$set']['cold'] = True
+                else:
+                    doc = {'$set': t, '$unset': {'cold': ''}}
+                doc['$set']['updated'] = _utcnow()
                 # Add default plaid2text to new inserts
                 doc['$setOnInsert'] = TEXT_DOC
-                self.account.update_many({'_id': id}, doc, True)
+                collection.update_many({'_id': id}, doc, True)
+                PROFILER.count('rows_saved')
+                METRICS.inc('plaid2text_storage_rows_upserted_total', backend='mongodb', account=account)
 
-    def get_transactions(self, from_date=None, to_date=None, only_new=True):
+    def get_cursor(self, item_id):
+        doc = self.db[CURSOR_COLLECTION].find_one({'_id': item_id})
+        return doc['cursor'] if doc else None
+
+    def save_sync(self, item_id, cursor, transactions_by_account):
+        """
+        Multi-document transactions need a replica set, so the rows are
+        written first and the cursor last. If the cursor write is lost the
+        page is fetched again on the next sync, and the upserts make that
+        harmless.
+        """
+        with PROFILER.stage('db_save'):
+            for account, transactions in transactions_by_account.items():
+                self._save_transactions(transactions, account)
+            self.db[CURSOR_COLLECTION].update_one(
+                {'_id': item_id},
+                {'$set': {'cursor': cursor, 'updated': _utcnow()}},
+                upsert=True
+            )
+
+    def get_transactions(self, from_date=None, to_date=None, only_new=True, fields=()):
+        from pymongo import ASCENDING
         query = {}
         if only_new:
             query['plaid2text.pulled_to_file'] = {"$ne": True}
@@ -83,8 +396,182 @@ class MongoDBStorage(StorageManager):
         elif not from_date and to_date:
             query['date'] = {'$lte': to_date}
 
-        transactions = self.account.find(query).sort('date', ASCENDING)
-        return list(transactions)
+        projection = dict.fromkeys(RECORD_FIELDS, 1)
+        projection.update(dict.fromkeys(fields, 1))
+        with PROFILER.stage('db_query'):
+            transactions = [
+                TransactionRecord.from_dict(t, loader=self.get_raw_transaction)
+                for t in self.account.find(query, projection).sort('date', ASCENDING)
+            ]
+        PROFILER.count('rows_read', len(transactions))
+        METRICS.inc('plaid2text_storage_rows_read_total', len(transactions), backend='mongodb', account=self.account_name)
+        return transactions
+
+    def get_raw_transaction(self, transaction_id):
+        """The full stored Plaid payload of one transaction."""
+        doc = self.account.find_one({'_id': transaction_id})
+        if doc is None:
+            raise KeyError(transaction_id)
+        return self._with_payloads([doc])[0]
+
+    def _with_payloads(self, docs):
+        """
+        Complete the cold archived documents among docs with their payloads,
+        fetched in one query.
+        """
+        import bson
+        ids = [d['_id'] for d in docs if d.get('cold')]
+        if not ids:
+            return docs
+        payloads = dict(
+            (p['_id'], p['payload']) for p in self.payloads.find({'_id': {'$in': ids}})
+        )
+        ret = []
+        for d in docs:
+            if d.get('cold') and d['_id'] in payloads:
+                full = bson.decode(zlib.decompress(payloads[d['_id']]))
+                # The hot fields and metadata are the current ones
+                full.update(d)
+                del full['cold']
+                d = full
+            ret.append(d)
+        return ret
+
+    def archive_payloads(self, batch_size=1000):
+        from pymongo import UpdateOne, ReplaceOne
+        import bson
+        moved = 0
+        cursor = self.account.find({'cold': {'$ne': True}}, batch_size=batch_size)
+        while True:
+            docs = [d for _, d in zip(range(batch_size), cursor)]
+            if not docs:
+                break
+            payloads = []
+            updates = []
+            for d in docs:
+                t = dict((k, v) for k, v in d.items() if k not in ('_id', 'plaid2text', 'updated'))
+                payloads.append(ReplaceOne(
+                    {'_id': d['_id']}, {'_id': d['_id'], 'payload': _compress(bson.encode(t))}, upsert=True))
+                unset = dict((k, '') for k in t if k not in HOT_FIELDS)
+                updates.append(UpdateOne({'_id': d['_id']}, {'$set': {'cold': True}, '$unset': unset}))
+            self.payloads.bulk_write(payloads, ordered=False)
+            self.account.bulk_write(updates, ordered=False)
+            moved += len(docs)
+            PROFILER.count('rows_archived', len(docs))
+        return moved
+
+    def aggregate(self, group_by, from_month=None, to_month=None, only_new=False, account_ids=None):
+        match = {}
+        if only_new:
+            match['plaid2text.pulled_to_file'] = {'$ne': True}
+        if account_ids:
+            match['account_id'] = {'$in': list(account_ids)}
+        if from_month:
+            match.setdefault('date', {})['$gte'] = datetime.datetime.strptime(from_month, '%Y-%m')
+        if to_month:
+            # Before the first day of the following month
+            match.setdefault('date', {})['$lt'] = _next_month(to_month)
+        keys = {
+            'month': {'$dateToString': {'format': '%Y-%m', 'date': '$date'}},
+            'account_id': '$account_id',
+            'category': {'$ifNull': [
+                '$personal_finance_category.primary',
+                {'$ifNull': [{'$arrayElemAt': ['$category', 0]}, '']}
+            ]},
+            'associated_account': {'$ifNull': ['$plaid2text.associated_account', '']},
+        }
+        group = {'_id': dict((k, keys[k]) for k in group_by)}
+        group['_id']['currency'] = {'$ifNull': ['$iso_currency_code', '']}
+        group['count'] = {'$sum': 1}
+        group['total'] = {'$sum': '$amount'}
+        pipeline = [{'$match': match}, {'$group': group}]
+        rows = []
+        for doc in self.account.aggregate(pipeline):
+            row = doc['_id']
+            row['count'] = doc['count']
+            row['total'] = doc['total']
+            rows.append(row)
+        return rows
+
+    def search(self, terms, from_date=None, to_date=None, min_amount=None, max_amount=None,
+               account_ids=None, limit=50):
+        """
+        A $text query over a text index of the collection, created by the
+        first search and kept current by MongoDB from then on. Words are
+        quoted so that all must match; Mongo has no prefix matching, so a
+        trailing * is dropped.
+        """
+        from pymongo import DESCENDING
+        self.account.create_index(
+            [('name', 'text'), ('merchant_name', 'text'),
+             ('plaid2text.payee', 'text'), ('plaid2text.tags', 'text')],
+            name='plaid2text_search', default_language='none'
+        )
+        query = {'$text': {'$search': ' '.join(
+            '"{0}"'.format(word.replace('"', '')) for word, _ in _search_terms(terms))}}
+        if from_date:
+            query.setdefault('date', {})['$gte'] = datetime.datetime.combine(from_date, datetime.time())
+        if to_date:
+            query.setdefault('date', {})['$lte'] = datetime.datetime.combine(to_date, datetime.time())
+        if min_amount is not None:
+            query.setdefault('amount', {})['$gte'] = min_amount
+        if max_amount is not None:
+            query.setdefault('amount', {})['$lte'] = max_amount
+        if account_ids:
+            query['account_id'] = {'$in': list(account_ids)}
+        projection = {
+            '_id': 1, 'account_id': 1, 'date': 1, 'name': 1, 'merchant_name': 1, 'amount': 1,
+            'iso_currency_code': 1, 'plaid2text': 1, 'score': {'$meta': 'textScore'},
+        }
+        cursor = self.account.find(query, projection).sort(
+            [('score', {'$meta': 'textScore'}), ('date', DESCENDING)]).limit(limit)
+        rows = []
+        for t in cursor:
+            p2t = t.get('plaid2text') or {}
+            rows.append(dict(zip(SEARCH_COLUMNS, (
+                t['_id'], t.get('account_id'), t['date'].date().isoformat(), t.get('name'),
+                t.get('merchant_name'), t.get('amount'), t.get('iso_currency_code'),
+                p2t.get('payee'), p2t.get('associated_account'), _tags_text(p2t.get('tags')),
+                t['score']
+            ))))
+        return rows
+
+    def iter_stored(self, account_id=None, after=None, batch_size=1000):
+        """Keyed by _id, the transaction id."""
+        from pymongo import ASCENDING
+        query = {'_id': {'$gt': after}} if after is not None else {}
+        cursor = self.account.find(query, batch_size=batch_size).sort('_id', ASCENDING)
+        while True:
+            docs = [d for _, d in zip(range(batch_size), cursor)]
+            if not docs:
+                break
+            for d in self._with_payloads(docs):
+                yield d['_id'], _portable(d)
+
+    def import_transactions(self, transactions):
+        from pymongo import ReplaceOne
+        import bson
+        payloads = []
+        docs = []
+        for t in transactions:
+            t = _from_portable(t)
+            id = t['transaction_id']
+            metadata = t.pop('plaid2text', None)
+            if self.cold_archive:
+                payloads.append(ReplaceOne(
+                    {'_id': id}, {'_id': id, 'payload': _compress(bson.encode(t))}, upsert=True))
+                t = dict((k, t[k]) for k in HOT_FIELDS if k in t)
+                t['cold'] = True
+            t['_id'] = id
+            t['plaid2text'] = metadata
+            t['updated'] = _utcnow()
+            docs.append(ReplaceOne({'_id': id}, t, upsert=True))
+        if payloads:
+            self.payloads.bulk_write(payloads, ordered=False)
+        if docs:
+            self.account.bulk_write(docs, ordered=False)
+        PROFILER.count('rows_imported', len(docs))
+        METRICS.inc('plaid2text_storage_rows_upserted_total', len(docs), backend='mongodb', account=self.account_name)
 
     def update_transaction(self, update, mark_pulled=None):
         for txn in update:
@@ -95,10 +582,39 @@ class MongoDBStorage(StorageManager):
 
             self.account.update_one(
                 {'_id': id},
-                {'$set': {"plaid2text": txn}}
+                {'$set': {"plaid2text": txn, 'updated': _utcnow()}}
             )
+        PROFILER.count('rows_updated', len(update))
+        METRICS.inc('plaid2text_storage_rows_modified_total', len(update), backend='mongodb', account=self.account_name)
+
+    def iter_transactions(self, account_id=None, changed_since=None, batch_size=1000):
+        from pymongo import ASCENDING
+        query = {}
+        if changed_since:
+            query['updated'] = {'$gte': datetime.datetime.fromisoformat(changed_since)}
+        cursor = self.account.find(query, batch_size=batch_size).sort('date', ASCENDING)
+        while True:
+            docs = [d for _, d in zip(range(batch_size), cursor)]
+            if not docs:
+                break
+            for t in self._with_payloads(docs):
+                if t.get('updated'):
+                    t['updated'] = t['updated'].isoformat()
+                yield t
+
+    def iter_history(self):
+        query = {'plaid2text.pulled_to_file': True}
+        fields = {'_id': 0, 'name': 1, 'merchant_name': 1,
+                  'plaid2text.payee': 1, 'plaid2text.associated_account': 1}
+        for collection in self.db.list_collection_names():
+            if collection in (CURSOR_COLLECTION, PAYLOAD_COLLECTION):
+                continue
+            for t in self.db[collection].find(query, fields):
+                p2t = t.get('plaid2text') or {}
+                yield t.get('name'), t.get('merchant_name'), p2t.get('payee'), p2t.get('associated_account')
 
     def get_latest_transaction_date(self):
+        from pymongo import DESCENDING
         latest = list(self.account.find().sort("date", DESCENDING).limit(1))[0]['date']
         return latest
     
@@ -111,9 +627,86 @@ class MongoDBStorage(StorageManager):
 
 # SQLite is completely untested
 
+# Seconds a connection waits on a lock held by another process (a cron sync
+# and an interactive render, say) before giving up with "database is locked"
+SQLITE_BUSY_TIMEOUT = 30
+
+def _next_month(month):
+    """The first day of the month after 'YYYY-MM', as a datetime."""
+    d = datetime.datetime.strptime(month, '%Y-%m')
+    return d.replace(year=d.year + d.month // 12, month=d.month % 12 + 1)
+
+
+# The keys of the report_rollup table, as expressions over a transactions
+# row ({0} is new or old in the triggers)
+ROLLUP_KEYS = (
+    ('month', "substr(json_extract({0}plaid_json, '$.date'), 1, 7)"),
+    ('account_id', "{0}account_id"),
+    ('currency', "coalesce(json_extract({0}plaid_json, '$.iso_currency_code'), '')"),
+    ('category', "coalesce(json_extract({0}plaid_json, '$.personal_finance_category.primary'),"
+                 " json_extract({0}plaid_json, '$.category[0]'), '')"),
+    ('associated_account', "coalesce(json_extract({0}metadata, '$.associated_account'), '')"),
+    ('pulled', "coalesce(json_extract({0}metadata, '$.pulled_to_file'), 0)"),
+)
+
+
+def _rollup_change(row, sign):
+    """Trigger statement adding (sign 1) or removing (-1) a row."""
+    return """
+        insert into report_rollup values ({0}, {1}, {1} * coalesce(json_extract({2}plaid_json, '$.amount'), 0))
+            on conflict do update set count = count + excluded.count, total = total + excluded.total;
+        """.format(', '.join(expr.format(row) for _, expr in ROLLUP_KEYS), sign, row)
+
+
+# The columns of the transactions_search full-text index, as expressions
+# over a transactions row
+SEARCH_FIELDS = (
+    ('name', "coalesce(json_extract(plaid_json, '$.name'), '')"),
+    ('merchant_name', "coalesce(json_extract(plaid_json, '$.merchant_name'), '')"),
+    ('payee', "coalesce(json_extract(metadata, '$.payee'), '')"),
+    ('tags', "coalesce(case json_type(metadata, '$.tags')"
+             " when 'array' then (select group_concat(value, ' ') from json_each(metadata, '$.tags'))"
+             " else json_extract(metadata, '$.tags') end, '')"),
+)
+
+
+def _fts_query(terms):
+    """An FTS5 query matching every term, each quoted as a string."""
+    return ' '.join(
+        '"{0}"{1}'.format(word.replace('"', '""'), '*' if prefix else '')
+        for word, prefix in _search_terms(terms)
+    )
+
+
+def _decode_dates(t):
+    """Decode the ISO date strings of a stored Plaid payload in place."""
+    for field in ('date', 'authorized_date'):
+        if t.get(field) is not None:
+            t[field] = datetime.date.fromisoformat(t[field])
+    for field in ('datetime', 'authorized_datetime'):
+        if t.get(field) is not None:
+            t[field] = datetime.datetime.fromisoformat(t[field])
+    return t
+
+
+def _decode_payload(plaid_json, payload):
+    """A stored Plaid payload: the hot row over its archived payload, if any."""
+    t = json.loads(zlib.decompress(payload)) if payload else {}
+    t.update(json.loads(plaid_json))
+    return t
+
+
 class SQLiteStorage():
-    def __init__(self, dbpath, account, posting_account):
-        self.conn = sqlite3.connect(dbpath) 
+    def __init__(self, dbpath, account, posting_account, cold_archive=False):
+        self.conn = sqlite3.connect(dbpath, timeout=SQLITE_BUSY_TIMEOUT)
+        self.account_name = account
+        self.cold_archive = cold_archive
+        # WAL lets readers and a writer in other processes run at the same
+        # time; NORMAL sync is durable in WAL mode short of power loss.
+        self.conn.execute("pragma journal_mode = wal")
+        self.conn.execute("pragma synchronous = normal")
+        self.conn.execute("pragma busy_timeout = %d" % (SQLITE_BUSY_TIMEOUT * 1000))
+        self.conn.execute("pragma temp_store = memory")
 
         c = self.conn.cursor()
         c.execute("""
@@ -124,7 +717,25 @@ class SQLiteStorage():
             create unique index if not exists transactions_idx
                 ON transactions(account_id, transaction_id)
             """)
+        # Payload lookups and metadata updates go by transaction_id alone
+        c.execute("""
+            create index if not exists transactions_id_idx
+                ON transactions(transaction_id)
+            """)
+        c.execute("""
+            create table if not exists sync_cursors
+                (item_id text primary key, cursor, updated)
+            """)
+        # zlib compressed JSON payloads of cold archived rows, whose
+        # plaid_json only keeps HOT_FIELDS
+        c.execute("""
+            create table if not exists raw_payloads
+                (transaction_id text primary key, payload blob)
+            """)
         self.conn.commit()
+        self.has_payloads = c.execute("select exists(select 1 from raw_payloads)").fetchone()[0]
+        self._create_rollup()
+        self._create_search_index()
 
         # This might be needed if there's not consistent support for json_extract in sqlite3 installations
         # this will need to be modified to support the "$.prop" syntax
@@ -133,12 +744,132 @@ class SQLiteStorage():
         #    return ret
         #self.conn.create_function("json_extract", 2, json_extract)
 
+    def _create_rollup(self):
+        """
+        report_rollup holds the count and sum of the transactions per month,
+        account, currency, category, associated account and pulled flag. It
+        is kept current by triggers, so reports group a few hundred rows
+        instead of scanning the transactions. Filled from the existing rows
+        when it is first created.
+        """
+        exists = self.conn.execute(
+            "select 1 from sqlite_master where type = 'table' and name = 'report_rollup'").fetchone()
+        if exists:
+            return
+        keys = ', '.join(k for k, _ in ROLLUP_KEYS)
+        with self.conn:
+            # The sqlite3 module does not open a transaction for DDL
+            self.conn.execute("begin")
+            self.conn.execute("""
+                create table report_rollup ({0}, count, total,
+                    primary key ({0})) without rowid
+                """.format(keys))
+            self.conn.execute("""
+                create trigger report_rollup_insert after insert on transactions
+                begin {0} end
+                """.format(_rollup_change('new.', 1)))
+            self.conn.execute("""
+                create trigger report_rollup_delete after delete on transactions
+                begin {0} end
+                """.format(_rollup_change('old.', -1)))
+            self.conn.execute("""
+                create trigger report_rollup_update after update of account_id, plaid_json, metadata on transactions
+                begin {0} {1} end
+                """.format(_rollup_change('old.', -1), _rollup_change('new.', 1)))
+            self.conn.execute("""
+                insert into report_rollup
+                select {0}, count(*), sum(coalesce(json_extract(plaid_json, '$.amount'), 0))
+                from transactions group by {1}
+                """.format(', '.join(expr.format('') for _, expr in ROLLUP_KEYS),
+                           ', '.join(str(i + 1) for i in range(len(ROLLUP_KEYS)))))
+
+    def _create_search_index(self):
+        """
+        transactions_search is an FTS5 index of SEARCH_FIELDS keyed by the
+        transactions rowid, which the upserts keep. save_transactions and
+        update_transaction re-index the rows they write, in their
+        transaction. Filled from the existing rows when it is first created.
+        """
+        self.has_search = True
+        exists = self.conn.execute(
+            "select 1 from sqlite_master where type = 'table' and name = 'transactions_search'").fetchone()
+        if exists:
+            return
+        try:
+            with self.conn:
+                # The sqlite3 module does not open a transaction for DDL
+                self.conn.execute("begin")
+                self.conn.execute("""
+                    create virtual table transactions_search using fts5({0},
+                        tokenize = 'unicode61 remove_diacritics 2')
+                    """.format(', '.join(k for k, _ in SEARCH_FIELDS)))
+                self.conn.execute("""
+                    insert into transactions_search(rowid, {0})
+                    select rowid, {1} from transactions order by rowid
+                    """.format(', '.join(k for k, _ in SEARCH_FIELDS),
+                               ', '.join(expr for _, expr in SEARCH_FIELDS)))
+        except sqlite3.OperationalError as ex:
+            # Built without FTS5: everything but search still works
+            if 'fts5' not in str(ex):
+                raise
+            self.has_search = False
+
+    def _reindex(self, transaction_ids, names=None):
+        """
+        Index the current values of the given stored transactions.
+        names: {transaction_id: (name, merchant_name)}, saves parsing the
+               payloads again when the caller has them
+        """
+        if not self.has_search or not transaction_ids:
+            return
+        fields = SEARCH_FIELDS[2:] if names else SEARCH_FIELDS
+        rows = self.conn.execute("""
+            select rowid, transaction_id, {0} from transactions
+            where transaction_id in (select value from json_each(?))
+            order by rowid
+            """.format(', '.join(expr for _, expr in fields)),
+            [json.dumps(transaction_ids)]
+        ).fetchall()
+        # In rowid order FTS5 keeps the batch in memory until the commit;
+        # replace drops the old entries of the row
+        self.conn.executemany("""
+            insert or replace into transactions_search(rowid, {0}) values (?, ?, ?, ?, ?)
+            """.format(', '.join(k for k, _ in SEARCH_FIELDS)),
+            [(rowid,) + (names[trans_id] if names else ()) + tuple(values)
+             for rowid, trans_id, *values in rows])
+
     def save_transactions(self, transactions):
         """
         Saves the given transactions to the configured db.
 
         Occurs when using the --download-transactions option.
         """
+        with PROFILER.stage('db_save'):
+            with self.conn:
+                self._save_transactions(transactions)
+
+    def get_cursor(self, item_id):
+        row = self.conn.execute("select cursor from sync_cursors where item_id = ?", [item_id]).fetchone()
+        return row[0] if row else None
+
+    def save_sync(self, item_id, cursor, transactions_by_account):
+        """The page's rows and the item's cursor are committed in one transaction."""
+        with PROFILER.stage('db_save'):
+            with self.conn:
+                for transactions in transactions_by_account.values():
+                    self._save_transactions(transactions)
+                self.conn.execute("""
+                    insert into sync_cursors(item_id, cursor, updated)
+                        values(?, ?, strftime('%Y-%m-%dT%H:%M:%SZ', 'now'))
+                        on conflict(item_id) do update
+                            set cursor = excluded.cursor, updated = excluded.updated
+                    """, [item_id, cursor])
+
+    def _save_transactions(self, transactions):
+        """Upsert the transactions; the caller commits."""
+        rows = []
+        payloads = []
+        names = {}
         for t in transactions:
             t = t.to_dict()
             trans_id = t['transaction_id']
@@ -152,29 +883,89 @@ class SQLiteStorage():
             if t['datetime'] is not None:
                 t['datetime'] = t['datetime'].isoformat()
             metadata = t.get('plaid2text', None)
-            if metadata is not None:
-                metadata = json.dumps(metadata)
-
-            c = self.conn.cursor()
-            c.execute("""
-                insert into 
-                    transactions(account_id, transaction_id, created, updated, plaid_json, metadata)
-                    values(?,?,strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),?,?)
-                    on conflict(account_id, transaction_id) DO UPDATE
-                        set updated = strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),
-                            plaid_json = excluded.plaid_json,
-                            metadata   = excluded.metadata
-                """, [act_id, trans_id, json.dumps(t), metadata])
-            self.conn.commit()
-
-    def get_transactions(self, from_date=None, to_date=None, only_new=True):
-        query = "select plaid_json, metadata from transactions";
+            if metadata is None:
+                # Same defaults the Mongo backend sets on insert
+                metadata = dict(TEXT_DOC['plaid2text'])
+                metadata['date_downloaded'] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+            metadata = json.dumps(metadata)
+            names[trans_id] = (t.get('name') or '', t.get('merchant_name') or '')
+            if self.cold_archive:
+                payloads.append([trans_id, _compress(json.dumps(t).encode('utf-8'))])
+                t = dict((k, t.get(k)) for k in HOT_FIELDS)
+            rows.append([act_id, trans_id, json.dumps(t), metadata])
+        self._upsert(rows, payloads, names)
+        PROFILER.count('rows_saved', len(rows))
+        METRICS.inc('plaid2text_storage_rows_upserted_total', len(rows), backend='sqlite', account=self.account_name)
+
+    def _upsert(self, rows, payloads, names, replace_metadata=False):
+        """
+        Write [account_id, transaction_id, plaid_json, metadata] rows, the
+        archived payloads of cold ones and the search index; the caller
+        commits. The stored metadata is kept unless replace_metadata.
+        """
+        self.conn.executemany("""
+            insert into 
+                transactions(account_id, transaction_id, created, updated, plaid_json, metadata)
+                values(?,?,strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),?,?)
+                on conflict(account_id, transaction_id) DO UPDATE
+                    set updated = strftime('%Y-%m-%dT%H:%M:%SZ', 'now'),
+                        plaid_json = excluded.plaid_json{0}
+            """.format(',\n                        metadata = excluded.metadata' if replace_metadata else ''),
+            rows)
+        self._reindex(list(names), names)
+        if payloads:
+            self.conn.executemany("""
+                insert or replace into raw_payloads(transaction_id, payload) values(?, ?)
+                """, payloads)
+            self.has_payloads = True
+        elif self.has_payloads:
+            # Rows saved whole again are no longer archived
+            self.conn.executemany(
+                "delete from raw_payloads where transaction_id = ?", [r[1:2] for r in rows])
+
+    def import_transactions(self, transactions):
+        rows = []
+        payloads = []
+        names = {}
+        for t in transactions:
+            t = dict(t)
+            metadata = t.pop('plaid2text', None)
+            trans_id = t['transaction_id']
+            act_id = t['account_id']
+            names[trans_id] = (t.get('name') or '', t.get('merchant_name') or '')
+            if self.cold_archive:
+                payloads.append([trans_id, _compress(json.dumps(t).encode('utf-8'))])
+                t = dict((k, t.get(k)) for k in HOT_FIELDS)
+            rows.append([act_id, trans_id, json.dumps(t), json.dumps(metadata) if metadata is not None else None])
+        with self.conn:
+            self._upsert(rows, payloads, names, replace_metadata=True)
+        PROFILER.count('rows_imported', len(rows))
+        METRICS.inc('plaid2text_storage_rows_upserted_total', len(rows), backend='sqlite', account=self.account_name)
+
+    def get_transactions(self, from_date=None, to_date=None, only_new=True, fields=()):
+        # Whole top level fields are fetched, as JSON text so objects and
+        # strings decode alike. Archived rows take them from their payload.
+        extra_fields = sorted(set(f.split('.')[0] for f in fields))
+        columns = ''
+        if extra_fields:
+            columns = ", (select payload from raw_payloads p where p.transaction_id = transactions.transaction_id)"
+            columns += ''.join(", json_quote(json_extract(plaid_json, ?))" for _ in extra_fields)
+        query = """
+            select transaction_id, account_id,
+                json_extract(plaid_json, '$.date'),
+                json_extract(plaid_json, '$.name'),
+                json_extract(plaid_json, '$.merchant_name'),
+                json_extract(plaid_json, '$.amount'),
+                json_extract(plaid_json, '$.iso_currency_code'),
+                json_extract(plaid_json, '$.pending'),
+                metadata{0}
+            from transactions""".format(columns)
 
         conditions = []
         if only_new: 
-            conditions.append("coalesce(json_extract(plaid_json, '$.pulled_to_file'), false) = false")
+            conditions.append("coalesce(json_extract(metadata, '$.pulled_to_file'), false) = false")
 
-        params  = []
+        params  = ['$."{0}"'.format(f) for f in extra_fields]
         if from_date and to_date and (from_date <= to_date):
             conditions.append("json_extract(plaid_json, '$.date') between ? and ?")
             params += [from_date.strftime("%Y-%m-%d"), to_date.strftime("%Y-%m-%d")]
@@ -187,48 +978,236 @@ class SQLiteStorage():
 
         if len(conditions) > 0:
             query = "%s where %s" % ( query, " AND ".join( conditions ) )
+        query += " order by json_extract(plaid_json, '$.date'), transaction_id"
 
-        transactions = self.conn.cursor().execute(query, params).fetchall()
+        with PROFILER.stage('db_query'):
+            transactions = self.conn.cursor().execute(query, params).fetchall()
+            ret = self._decode_rows(transactions, extra_fields)
+        PROFILER.count('rows_read', len(ret))
+        METRICS.inc('plaid2text_storage_rows_read_total', len(ret), backend='sqlite', account=self.account_name)
+        return ret
 
+    def _decode_rows(self, transactions, extra_fields=()):
         ret = []
         for row in transactions:
-            t = json.loads(row[0])
-            if row[1]:
-                t['plaid2text'] = json.loads(row[1])
-            else:
-                t['plaid2text'] = {}
-
-            if ( len(t['plaid2text']) == 0 ):
-                # set empty objects ({}) to None to account for assumptions that None means not processed
-                t['plaid2text'] = None
-
-            t['date'] = date_parser.parse(t['date'])
-            if t['datetime'] is not None:
-                t['datetime'] = date_parser.parse(t['datetime'])
-            if t['authorized_date'] is not None:
-                t['authorized_date'] = date_parser.parse(t['authorized_date'])
-            if t['authorized_datetime'] is not None:
-                t['authorized_datetime'] = date_parser.parse(t['authorized_datetime'])
-
-            ret.append(t)
-
+            metadata = json.loads(row[8]) if row[8] else None
+            extra = None
+            if extra_fields and row[9]:
+                payload = json.loads(zlib.decompress(row[9]))
+                extra = _decode_dates(dict((f, payload.get(f)) for f in extra_fields))
+            elif extra_fields:
+                extra = _decode_dates(dict(
+                    (f, json.loads(v)) for f, v in zip(extra_fields, row[10:]) if v is not None
+                ))
+            # set empty objects ({}) to None to account for assumptions that None means not processed
+            ret.append(TransactionRecord(
+                row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7],
+                metadata or None,
+                extra=extra or None,
+                loader=self.get_raw_transaction
+            ))
         return ret
 
+    def get_raw_transaction(self, transaction_id):
+        """The full stored Plaid payload of one transaction, dates decoded."""
+        row = self.conn.execute("""
+            select plaid_json, metadata, payload
+            from transactions left join raw_payloads using (transaction_id)
+            where transaction_id = ?""",
+            [transaction_id]
+        ).fetchone()
+        if row is None:
+            raise KeyError(transaction_id)
+        t = _decode_payload(row[0], row[2])
+        t['plaid2text'] = json.loads(row[1]) if row[1] else None
+        return _decode_dates(t)
+
     def update_transaction(self, update, mark_pulled=None):
+        rows = []
         for txn in update:
             trans_id = txn.pop('transaction_id')
             txn['pulled_to_file'] = mark_pulled
             if mark_pulled:            
                 txn['date_last_pulled'] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
 
-            txn['archived'] = null
+            txn['archived'] = None
+            rows.append([json.dumps(txn), trans_id])
 
-            c = self.conn.cursor()
-            c.execute("""
-                update transactions set metadata = json_patch(coalesce(metadata, '{}'), ?) 
+        with self.conn:
+            self.conn.executemany("""
+                update transactions set metadata = json_patch(coalesce(metadata, '{}'), ?),
+                    updated = strftime('%Y-%m-%dT%H:%M:%SZ', 'now')
                 where transaction_id = ?
-            """, [json.dumps(txn), trans_id] )
-            self.conn.commit()
+            """, rows)
+            self._reindex([r[1] for r in rows])
+        PROFILER.count('rows_updated', len(update))
+        METRICS.inc('plaid2text_storage_rows_modified_total', len(update), backend='sqlite', account=self.account_name)
+
+    def iter_transactions(self, account_id=None, changed_since=None, batch_size=1000):
+        query = """
+            select plaid_json, metadata, updated, payload
+            from transactions left join raw_payloads using (transaction_id)"""
+        conditions = []
+        params = []
+        if account_id:
+            conditions.append("account_id = ?")
+            params.append(account_id)
+        if changed_since:
+            conditions.append("updated >= ?")
+            params.append(changed_since)
+        if conditions:
+            query += " where " + " and ".join(conditions)
+        query += " order by json_extract(plaid_json, '$.date'), transaction_id"
+        cursor = self.conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                t = _decode_payload(row[0], row[3])
+                t['plaid2text'] = json.loads(row[1]) if row[1] else None
+                t['updated'] = row[2]
+                yield t
+
+    def iter_stored(self, account_id=None, after=None, batch_size=1000):
+        """
+        Keyed by rowid. Each batch is a short query of its own, so no read
+        transaction stays open between them.
+        """
+        last = after or 0
+        while True:
+            query = """
+                select t.rowid, plaid_json, metadata, payload
+                from transactions t left join raw_payloads using (transaction_id)
+                where t.rowid > ?"""
+            params = [last]
+            if account_id:
+                # Unary + keeps the planner on the rowid range rather than
+                # sorting the account's rows for every batch
+                query += " and +account_id = ?"
+                params.append(account_id)
+            rows = self.conn.execute(query + " order by t.rowid limit ?", params + [batch_size]).fetchall()
+            if not rows:
+                break
+            for rowid, plaid_json, metadata, payload in rows:
+                t = _decode_payload(plaid_json, payload)
+                t['plaid2text'] = json.loads(metadata) if metadata else None
+                yield rowid, t
+            last = rows[-1][0]
+
+    def iter_history(self):
+        cursor = self.conn.execute("""
+            select json_extract(plaid_json, '$.name'),
+                json_extract(plaid_json, '$.merchant_name'),
+                json_extract(metadata, '$.payee'),
+                json_extract(metadata, '$.associated_account')
+            from transactions
+            where json_extract(metadata, '$.pulled_to_file') = true""")
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            yield from rows
+
+    def aggregate(self, group_by, from_month=None, to_month=None, only_new=False, account_ids=None):
+        """Grouped from report_rollup, never from the transactions."""
+        keys = list(group_by) + ['currency']
+        conditions = ['count != 0']
+        params = []
+        if only_new:
+            conditions.append('pulled = 0')
+        if from_month:
+            conditions.append('month >= ?')
+            params.append(from_month)
+        if to_month:
+            conditions.append('month <= ?')
+            params.append(to_month)
+        if account_ids:
+            conditions.append('account_id in ({0})'.format(', '.join('?' * len(account_ids))))
+            params.extend(account_ids)
+        query = """
+            select {0}, sum(count), sum(total) from report_rollup
+            where {1} group by {0} having sum(count) != 0
+            """.format(', '.join(keys), ' and '.join(conditions))
+        return [
+            dict(zip(keys + ['count', 'total'], row))
+            for row in self.conn.execute(query, params)
+        ]
+
+    def search(self, terms, from_date=None, to_date=None, min_amount=None, max_amount=None,
+               account_ids=None, limit=50):
+        """Ranked by FTS5's bm25; the filters apply to the matching rows only."""
+        if not self.has_search:
+            raise RuntimeError('this SQLite library was built without FTS5')
+        conditions = ['transactions_search match ?']
+        params = [_fts_query(terms)]
+        if from_date:
+            conditions.append("json_extract(t.plaid_json, '$.date') >= ?")
+            params.append(from_date.isoformat())
+        if to_date:
+            conditions.append("json_extract(t.plaid_json, '$.date') <= ?")
+            params.append(to_date.isoformat())
+        if min_amount is not None:
+            conditions.append("json_extract(t.plaid_json, '$.amount') >= ?")
+            params.append(min_amount)
+        if max_amount is not None:
+            conditions.append("json_extract(t.plaid_json, '$.amount') <= ?")
+            params.append(max_amount)
+        if account_ids:
+            conditions.append('t.account_id in ({0})'.format(', '.join('?' * len(account_ids))))
+            params.extend(account_ids)
+        params.append(limit)
+        query = """
+            select t.transaction_id, t.account_id,
+                json_extract(t.plaid_json, '$.date'),
+                json_extract(t.plaid_json, '$.name'),
+                json_extract(t.plaid_json, '$.merchant_name'),
+                json_extract(t.plaid_json, '$.amount'),
+                json_extract(t.plaid_json, '$.iso_currency_code'),
+                json_extract(t.metadata, '$.payee'),
+                json_extract(t.metadata, '$.associated_account'),
+                transactions_search.tags,
+                -bm25(transactions_search)
+            from transactions_search join transactions t on t.rowid = transactions_search.rowid
+            where {0}
+            order by bm25(transactions_search), json_extract(t.plaid_json, '$.date') desc
+            limit ?
+            """.format(' and '.join(conditions))
+        return [dict(zip(SEARCH_COLUMNS, row)) for row in self.conn.execute(query, params)]
+
+    def archive_payloads(self, batch_size=1000):
+        """
+        Rows are moved in rowid order, one transaction per batch, and the
+        file is vacuumed at the end to give the freed pages back.
+        """
+        moved = 0
+        last = 0
+        while True:
+            rows = self.conn.execute("""
+                select rowid, transaction_id, plaid_json from transactions t
+                where rowid > ? and not exists
+                    (select 1 from raw_payloads p where p.transaction_id = t.transaction_id)
+                order by rowid limit ?""", [last, batch_size]).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+            payloads = []
+            lean = []
+            for rowid, trans_id, plaid_json in rows:
+                t = json.loads(plaid_json)
+                payloads.append([trans_id, _compress(plaid_json.encode('utf-8'))])
+                lean.append([json.dumps(dict((k, t.get(k)) for k in HOT_FIELDS)), rowid])
+            with self.conn:
+                self.conn.executemany(
+                    "insert or replace into raw_payloads(transaction_id, payload) values(?, ?)", payloads)
+                self.conn.executemany(
+                    "update transactions set plaid_json = ? where rowid = ?", lean)
+            self.has_payloads = True
+            moved += len(rows)
+            PROFILER.count('rows_archived', len(rows))
+        if moved:
+            self.conn.execute("vacuum")
+        return moved
 
     def check_pending():
         print("This function has not been implemented for SQLite databases")
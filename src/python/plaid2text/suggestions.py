@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+
+"""
+Payee/account suggestions learned from transactions already pulled to file.
+
+Every pulled transaction keeps the payee and account that were chosen for it
+in its `plaid2text` metadata. SuggestionIndex builds inverted indexes over
+that history, from the normalized description, the merchant name and the
+description tokens to how often each (payee, account) choice was made, so a
+description the mapping file does not know still gets a likely default.
+
+The index is built once per run and each lookup only touches the handful of
+tokens in one description, so it stays fast with a large history.
+"""
+
+from collections import Counter, defaultdict
+import math
+import re
+
+
+# Candidates kept per token after the index is built
+TOP_PER_TOKEN = 8
+
+_TOKEN_RE = re.compile(r"[a-z0-9&']*[a-z][a-z0-9&']*")
+
+
+def tokenize(text):
+    """
+    Lower cased word tokens of a description, dropping store numbers,
+    reference ids and other tokens without letters, e.g.
+    'AMAZON MKTPLACE #4821 SEATTLE' -> ('amazon', 'mktplace', 'seattle').
+    """
+    if not text:
+        return ()
+    return tuple(t for t in _TOKEN_RE.findall(text.lower()) if len(t) > 1)
+
+
+class SuggestionIndex():
+    def __init__(self):
+        self.by_description = defaultdict(Counter)
+        self.by_merchant = defaultdict(Counter)
+        self.by_token = {}
+        self.size = 0
+        self._token_counts = defaultdict(Counter)
+
+    @classmethod
+    def from_history(cls, history):
+        """
+        Build the index from (name, merchant_name, payee, account) tuples.
+        """
+        index = cls()
+        for name, merchant, payee, account in history:
+            index.learn(name, merchant, payee, account)
+        index.finish()
+        return index
+
+    def learn(self, name, merchant, payee, account):
+        """Record one choice; usable straight away for exact lookups."""
+        if not account:
+            return
+        choice = (payee or name, account)
+        self.size += 1
+        tokens = tokenize(name)
+        if tokens:
+            self.by_description[tokens][choice] += 1
+        if merchant:
+            self.by_merchant[merchant.lower()][choice] += 1
+        for token in set(tokens):
+            self._token_counts[token][choice] += 1
+
+    def finish(self):
+        """
+        Turn the raw token counts into per token weights: each token keeps
+        its TOP_PER_TOKEN choices, scaled by how specific the token is
+        (inverse document frequency), so common words like 'payment' or
+        'purchase' count for little.
+        """
+        for token, counts in self._token_counts.items():
+            total = sum(counts.values())
+            idf = math.log(1 + self.size / total)
+            self.by_token[token] = [
+                (choice, idf * n / total) for choice, n in counts.most_common(TOP_PER_TOKEN)
+            ]
+        self._token_counts = defaultdict(Counter)
+
+    def suggest(self, name, merchant=None):
+        """
+        The most likely (payee, account) for a description, or None when
+        nothing in the history resembles it.
+        """
+        tokens = tokenize(name)
+        counts = self.by_description.get(tokens)
+        if counts:
+            return counts.most_common(1)[0][0]
+        if merchant:
+            counts = self.by_merchant.get(merchant.lower())
+            if counts:
+                return counts.most_common(1)[0][0]
+        scores = Counter()
+        for token in set(tokens):
+            for choice, weight in self.by_token.get(token, ()):
+                scores[choice] += weight
+        if not scores:
+            return None
+        return scores.most_common(1)[0][0]
@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+
+"""
+Pairing of internal transfers between configured accounts.
+
+A transfer between two of our accounts arrives as two Plaid transactions:
+the amount leaving one account (positive in Plaid) and the same amount
+arriving in the other (negative) within a few days. find_transfers() sorts
+the candidates of all accounts by amount and date once, so each amount is a
+run in which outflows are matched to inflows with a moving date window.
+"""
+
+from collections import namedtuple
+from itertools import groupby
+
+from plaid2text.records import to_date
+
+
+# counterpart: the transaction on the other side
+# account, posting_account: its account nickname and posting account
+Transfer = namedtuple('Transfer', 'counterpart account posting_account')
+
+
+def find_transfers(transactions, accounts, window=3):
+    """
+    Pair opposite amounts in different accounts at most `window` days
+    apart, each transaction at most once, nearest dates first.
+
+    transactions: transaction records of any of the accounts
+    accounts: {Plaid account_id: (nickname, posting_account)}
+
+    Returns {transaction_id: Transfer} holding both sides of every pair.
+    """
+    keyed = []
+    for t in transactions:
+        if not t['amount'] or t['account_id'] not in accounts:
+            continue
+        keyed.append((
+            round(abs(t['amount']) * 100),
+            t['iso_currency_code'] or '',
+            to_date(t['date']).toordinal(),
+            t['transaction_id'],
+            t
+        ))
+    keyed.sort(key=lambda k: k[:4])
+
+    pairs = {}
+    for _, run in groupby(keyed, key=lambda k: k[:2]):
+        run = list(run)
+        outflows = [k for k in run if k[4]['amount'] > 0]
+        inflows = [k for k in run if k[4]['amount'] < 0]
+        start = 0
+        for out_key in outflows:
+            day, out = out_key[2], out_key[4]
+            # Inflows are date ordered: skip those too old for this and any
+            # later outflow
+            while start < len(inflows) and inflows[start][2] < day - window:
+                start += 1
+            best = None
+            for in_key in inflows[start:]:
+                if in_key[2] > day + window:
+                    break
+                t = in_key[4]
+                if t['transaction_id'] in pairs or t['account_id'] == out['account_id']:
+                    continue
+                if best is None or abs(in_key[2] - day) < abs(best[2] - day):
+                    best = in_key
+            if best is None:
+                continue
+            inflow = best[4]
+            pairs[out['transaction_id']] = Transfer(inflow, *accounts[inflow['account_id']])
+            pairs[inflow['transaction_id']] = Transfer(out, *accounts[out['account_id']])
+    return pairs